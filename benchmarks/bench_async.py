@@ -0,0 +1,182 @@
+"""
+Concurrent connections served by `python -m www.asgi` with the OAuth
+callbacks on its event loop, versus the same server with every endpoint on
+its --threads threads (--sync, the synchronous request path).
+
+Starts a local mock provider (see benchmarks.mock_oauth) answering after
+--delay seconds, then for each number of --connections drives the Facebook
+login flow from --load-processes client processes. Only the callback
+(/login/facebook/authorized, two provider calls) is timed: on the threads,
+at most --threads callbacks wait for the provider at once, the others
+queue; on the event loop, every connection waits at once.
+
+    python -m benchmarks.bench_async --connections 8,64,256 --delay 0.2
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+from urllib.parse import urlparse, parse_qs
+from benchmarks import harness, mock_oauth
+from benchmarks.bench_scaling import free_port, stop_server
+
+MODES = ('sync', 'async')
+
+
+def _int_list(value: str) -> list[int]:
+    return [int(v) for v in value.split(',')]
+
+
+def start_server(mode: str, threads: int, port: int,
+                 timeout: float = 60) -> subprocess.Popen:
+    env = dict(os.environ, SERVER_NAME=f'127.0.0.1:{port}')
+    command = [sys.executable, '-m', 'www.asgi', '--port', str(port),
+               '--threads', str(threads)]
+    if mode == 'sync':
+        command.append('--sync')
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/login', timeout=1)
+            return server
+        except OSError:
+            if server.poll() is not None:
+                raise RuntimeError(f'The server exited with status {server.returncode}')
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError(f'The server did not start within {timeout} seconds')
+
+
+def drive(base_url: str, nb_clients: int, nb_requests: int, first_code: int,
+          nb_accounts: int, barrier, results) -> None:
+    # Runs in a load process. Each client has its own `nb_accounts` accounts
+    # (provider codes), signed up then logged in again in turn: concurrent
+    # callbacks would race to sign the same account up.
+    def callback(client, i):
+        code = client.first_code + client.callbacks % nb_accounts
+        client.callbacks += 1
+
+        client.request('GET', '/logout')
+        status, headers = client.request('GET', '/login/facebook')
+        if status != 302:
+            raise RuntimeError(f'GET /login/facebook returned {status}')
+
+        # The provider would redirect the browser to the callback
+        query = parse_qs(urlparse(headers['Location']).query)
+        return harness.timed(
+            client, 'GET', f"/login/facebook/authorized?code={code}"
+            f"&state={query['state'][0]}", expected=(302, ))
+
+    clients = [harness.HTTPClient(base_url) for _ in range(nb_clients)]
+    for k, client in enumerate(clients):
+        client.first_code = first_code + k * nb_accounts
+        client.callbacks = 0
+    barrier.wait()
+    results.put(harness.run_concurrent(clients, nb_requests, callback))
+
+
+def bench(base_url: str, connections: int, nb_requests: int,
+          nb_processes: int, first_code: int) -> dict:
+    ctx = multiprocessing.get_context('fork')
+    nb_processes = min(nb_processes, connections)
+    barrier = ctx.Barrier(nb_processes)
+    results = ctx.Queue()
+    per_process = nb_requests // nb_processes
+    nb_clients = connections // nb_processes
+    # Half of the callbacks sign up
+    nb_accounts = max(1, per_process // nb_clients // 2)
+
+    processes = [ctx.Process(target=drive, args=(
+        base_url, nb_clients, per_process,
+        first_code + i * nb_clients * nb_accounts, nb_accounts, barrier, results))
+        for i in range(nb_processes)]
+    for process in processes:
+        process.start()
+    summaries = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    return {
+        'requests': sum(s['requests'] for s in summaries),
+        'requests_per_sec': sum(s['requests_per_sec'] for s in summaries),
+        'p50_ms': max(s['p50_ms'] for s in summaries),
+        'p95_ms': max(s['p95_ms'] for s in summaries),
+        'p99_ms': max(s['p99_ms'] for s in summaries),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--connections', type=_int_list, default=[8, 64, 256],
+                        help='comma separated numbers of concurrent connections')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='threads of the server')
+    parser.add_argument('--delay', type=float, default=0.2,
+                        help='provider latency in seconds')
+    parser.add_argument('--requests', type=int, default=4,
+                        help='callbacks per connection, half of them sign up')
+    parser.add_argument('--load-processes', type=int, default=4,
+                        help='number of client processes')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    # The provider only sleeps: its threads don't compete with the clients
+    provider, provider_url = mock_oauth.serve(args.delay)
+    database = harness.setup_environment(
+        None,
+        OAUTH_PROVIDER_URL=provider_url,
+        FACEBOOK_OAUTH_CLIENT_ID='bench',
+        FACEBOOK_OAUTH_CLIENT_SECRET='bench',
+        OAUTHLIB_INSECURE_TRANSPORT=1,
+        OAUTHLIB_RELAX_TOKEN_SCOPE=1,
+        # Connections to the provider kept alive
+        OAUTH_POOL_SIZE=max(args.connections))
+    harness.create_app()
+
+    results = {
+        'meta': {
+            'threads': args.threads,
+            'provider_delay': args.delay,
+            'load_processes': args.load_processes,
+        },
+        'modes': {mode: {} for mode in MODES},
+    }
+    # Every run signs new accounts up, then logs them in again
+    first_code = 1000000
+    for mode in MODES:
+        port = free_port()
+        server = start_server(mode, args.threads, port)
+        try:
+            for connections in args.connections:
+                results['modes'][mode][connections] = bench(
+                    f'http://127.0.0.1:{port}', connections,
+                    connections * args.requests, args.load_processes, first_code)
+                first_code += 1000000
+        finally:
+            stop_server(server)
+    results['provider_calls'] = provider.calls
+    os.unlink(database)
+
+    print(f"{'mode':<6} {'conns':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8}")
+    for mode, levels in results['modes'].items():
+        for connections, r in levels.items():
+            print(f"{mode:<6} {connections:>6} {r['requests_per_sec']:>8.1f} "
+                  f"{r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f}")
+    print(f"provider calls: {provider.calls}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Breached passwords Bloom filter: build time, file size, false positive rate,
+lookup latency and memory per process.
+
+Writes a list of --entries SHA-1 hashes ("HASH:COUNT" lines, like Have I
+Been Pwned's) to a temporary file, builds the filter with www.breached
+(faster with numpy), then looks up --lookups listed and unlisted passwords.
+The resident memory of a process is read from /proc before and after the
+lookups: the mapped pages belong to the page cache, shared by the workers.
+
+    python -m benchmarks.bench_breached --entries 10000000 --fp-rate 0.001
+"""
+import argparse
+import hashlib
+import os
+import statistics
+import tempfile
+import time
+from www import breached
+from www.breached import BreachedPasswords
+
+
+def write_hashes(path: str, entries: int) -> None:
+    with open(path, 'w') as f:
+        for start in range(0, entries, 100000):
+            f.write(''.join(
+                f"{hashlib.sha1(f'breached-{i}'.encode()).hexdigest().upper()}:{i % 1000}\n"
+                for i in range(start, min(entries, start + 100000))))
+
+
+def memory_kib() -> dict:
+    # Resident memory of this process, private (anonymous) and file mapped
+    try:
+        with open('/proc/self/status') as f:
+            fields = dict(line.split(':', 1) for line in f)
+    except OSError:
+        return {}
+    return {key: int(fields[key].split()[0]) for key in ('RssAnon', 'RssFile')
+            if key in fields}
+
+
+def lookup_latencies(passwords, filter: BreachedPasswords) -> list[float]:
+    latencies = []
+    for password in passwords:
+        start = time.perf_counter()
+        password in filter
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=1000000)
+    parser.add_argument('--fp-rate', type=float, default=0.001)
+    parser.add_argument('--lookups', type=int, default=100000)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench-breached-')
+    hashes = os.path.join(directory, 'hashes.txt')
+    output = os.path.join(directory, 'breached.bloom')
+
+    start = time.perf_counter()
+    write_hashes(hashes, args.entries)
+    print(f"hash list: {os.path.getsize(hashes) / 2 ** 20:.1f} MiB, written in "
+          f"{time.perf_counter() - start:.1f} s")
+
+    start = time.perf_counter()
+    stats = breached.build(hashes, output, args.fp_rate)
+    elapsed = time.perf_counter() - start
+    print(f"build: {elapsed:.1f} s ({stats['entries'] / elapsed / 1e6:.2f} M entries/s), "
+          f"{stats['size'] / 2 ** 20:.1f} MiB ({stats['bits'] / stats['entries']:.1f} "
+          f"bits/entry), {stats['hashes']} hashes")
+
+    listed = [f'breached-{i}' for i in range(0, args.entries,
+                                              max(1, args.entries // args.lookups))]
+    unlisted = [f'safe-{i}' for i in range(args.lookups)]
+
+    # Opening the filter and looking passwords up, alone
+    before = memory_kib()
+    filter = BreachedPasswords(output)
+    false_positives = sum(password in filter for password in unlisted)
+    assert all(password in filter for password in listed)
+    after = memory_kib()
+
+    hits = lookup_latencies(listed, filter)
+    misses = lookup_latencies(unlisted, filter)
+
+    print(f"false positive rate: {false_positives / len(unlisted):.2e} "
+          f"(expected {stats['fp_rate']:.2e})")
+    for name, latencies in (('listed', hits), ('unlisted', misses)):
+        latencies.sort()
+        print(f"lookup {name:<8}: p50 {statistics.median(latencies) * 1e6:.1f} us, "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.1f} us")
+    if before and after:
+        print(f"memory: +{after['RssAnon'] - before['RssAnon']} KiB private, "
+              f"+{after['RssFile'] - before['RssFile']} KiB of shared file pages")
+
+    filter.close()
+    for path in (hashes, output):
+        os.unlink(path)
+    os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""
+Latency, throughput and SQL statements of the auth and dashboard endpoints.
+
+Seeds a fresh SQLite database with --users users and --sessions sessions,
+then drives /login, /signup, / and /profile with --clients concurrent
+clients, through the Flask test client or a local WSGI server (--wsgi).
+
+    python -m benchmarks.bench_endpoints --users 10000 --sessions 50000 \\
+        --output bench.json --baseline previous.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import uuid
+from benchmarks import harness
+
+
+def bench(app, clients: list, emails: list[str], nb_requests: int) -> dict:
+    for client, email in zip(clients, emails):
+        client.email = email
+
+    def login(client, i):
+        client.request('GET', '/logout')
+        return harness.timed(client, 'POST', '/login',
+                             {'email': client.email,
+                              'password': harness.PASSWORD},
+                             expected=(302, ))
+
+    def signup(client, i):
+        client.request('GET', '/logout')
+        return harness.timed(client, 'POST', '/signup',
+                             {'email': f'{uuid.uuid4().hex}@bench.example.com',
+                              'password': harness.PASSWORD,
+                              'confirm': harness.PASSWORD},
+                             expected=(302, ))
+
+    def logged_in():
+        for client in clients:
+            client.request('GET', '/logout')
+            client.request('POST', '/login', {'email': client.email,
+                                              'password': harness.PASSWORD})
+
+    results = {
+        'login': harness.run_concurrent(clients, nb_requests, login),
+        'signup': harness.run_concurrent(clients, nb_requests, signup),
+    }
+
+    logged_in()
+    results['dashboard'] = harness.run_concurrent(
+        clients, nb_requests, lambda client, i: harness.timed(client, 'GET', '/'))
+    results['profile'] = harness.run_concurrent(
+        clients, nb_requests, lambda client, i: harness.timed(client, 'GET', '/profile'))
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    for key in ('mode', 'users', 'sessions', 'clients', 'bcrypt_rounds'):
+        if results['meta'][key] != baseline['meta'].get(key):
+            print(f"WARNING baseline was run with {key}={baseline['meta'].get(key)}",
+                  file=sys.stderr)
+
+    regressions = []
+    for name, current in results['scenarios'].items():
+        previous = baseline['scenarios'].get(name)
+        if previous is None:
+            continue
+
+        if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {current['p95_ms']:.1f}ms, "
+                               f"was {previous['p95_ms']:.1f}ms")
+        # Averages, cache hits make them fluctuate a little
+        if (current['sql_statements_per_request'] or 0) > \
+                (previous['sql_statements_per_request'] or 0) + 0.5:
+            regressions.append(f"{name}: {current['sql_statements_per_request']:.1f} "
+                               f"statements/request, was {previous['sql_statements_per_request']:.1f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--sessions', type=int, default=5000)
+    parser.add_argument('--clients', type=int, default=4,
+                        help='number of concurrent clients')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='number of requests per endpoint')
+    parser.add_argument('--bcrypt-rounds', type=int,
+                        help='defaults to the application setting')
+    parser.add_argument('--wsgi', action='store_true',
+                        help='go through a local WSGI server instead of the test client')
+    parser.add_argument('--database', help='SQLite file (default: temporary file)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed p95 latency increase over the baseline')
+    args = parser.parse_args()
+
+    database = harness.setup_environment(args.database,
+                                         BCRYPT_ROUNDS=args.bcrypt_rounds)
+    app = harness.create_app()
+    from www.hashing import hasher
+
+    emails = harness.seed(app, args.users, args.sessions, args.clients)
+    if args.wsgi:
+        base_url = harness.serve(app)
+        clients = [harness.HTTPClient(base_url) for _ in range(args.clients)]
+    else:
+        clients = [harness.FlaskClient(app) for _ in range(args.clients)]
+
+    results = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'mode': 'wsgi' if args.wsgi else 'test_client',
+            'users': args.users,
+            'sessions': args.sessions,
+            'clients': args.clients,
+            'requests': args.requests,
+            'bcrypt_rounds': hasher.rounds,
+            'hash_pool_size': hasher.pool_size,
+        },
+        'scenarios': bench(app, clients, emails, args.requests),
+    }
+    hasher.shutdown()
+    if not args.database:
+        os.unlink(database)
+
+    print(f"{'endpoint':<10} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'SQL/req':>8}")
+    for name, r in results['scenarios'].items():
+        print(f"{name:<10} {r['requests_per_sec']:>8.1f} {r['p50_ms']:>8.1f} "
+              f"{r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f} "
+              f"{r['sql_statements_per_request'] or 0:>8.1f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Logins per second versus bcrypt cost and hashing pool size.
+
+    python -m benchmarks.bench_hashing --costs 4,10,12 --pools 0,2,4
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from www.hashing import PasswordHasher
+
+
+def _int_list(value: str) -> list[int]:
+    return [int(v) for v in value.split(',')]
+
+
+def bench(rounds: int, pool_size: int, logins: int, concurrency: int) -> float:
+    hasher = PasswordHasher(rounds, pool_size)
+    password = 'Abcdef1!'
+    hash = hasher.hash(password)
+
+    # Request threads all checking a password, as a login burst would
+    with ThreadPoolExecutor(concurrency) as requests:
+        start = time.perf_counter()
+        results = list(requests.map(lambda _: hasher.check(password, hash),
+                                    range(logins)))
+        elapsed = time.perf_counter() - start
+
+    hasher.shutdown()
+    assert all(results)
+    return logins / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--costs', type=_int_list, default=[4, 8, 10, 12])
+    parser.add_argument('--pools', type=_int_list,
+                        default=sorted({0, 1, 2, os.cpu_count() or 1}))
+    parser.add_argument('--logins', type=int, default=64)
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='number of concurrent request threads')
+    args = parser.parse_args()
+
+    print(f"{'cost':>4} {'pool':>4} {'logins/sec':>12}")
+    for rounds in args.costs:
+        for pool_size in args.pools:
+            rate = bench(rounds, pool_size, args.logins, args.concurrency)
+            print(f"{rounds:>4} {pool_size:>4} {rate:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Import time of the package and of the application factory.
+
+Each scenario runs in fresh interpreters under `python -X importtime`, the
+median of --runs is reported along with the slowest modules. Exits with an
+error when a scenario is over its budget (milliseconds), e.g. in CI:
+
+    python -m benchmarks.bench_import --budget www=50 --budget create_app=1500
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SCENARIOS = {
+    # What `flask` commands and scripts pay before doing anything
+    'www': 'import www',
+    'models': 'import www.models',
+    'create_app': 'from www import create_app; create_app()',
+}
+
+
+def parse_importtime(output: str) -> dict:
+    # {module: (self us, cumulative us)} of the `-X importtime` lines
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def measure(statement: str, env: dict) -> dict:
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            env=env, capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(f'{statement!r} failed:\n{result.stderr}')
+    return parse_importtime(result.stderr)
+
+
+def bench(statement: str, runs: int, env: dict) -> dict:
+    totals = []
+    for _ in range(runs):
+        modules = measure(statement, env)
+        totals.append(sum(self_us for self_us, _ in modules.values()) / 1000)
+
+    # The modules of the last run, by time spent in the module itself
+    slowest = sorted(modules.items(), key=lambda item: item[1][0], reverse=True)
+    return {
+        'median_ms': statistics.median(totals),
+        'min_ms': min(totals),
+        'modules': len(modules),
+        'slowest': [(name, self_us / 1000) for name, (self_us, _) in slowest[:10]],
+        'flask_dance': 'flask_dance' in modules,
+    }
+
+
+def _budget(value: str) -> tuple:
+    name, _, ms = value.partition('=')
+    if name not in SCENARIOS or not ms:
+        raise argparse.ArgumentTypeError(f'expected <scenario>=<ms>, scenarios: '
+                                         f'{", ".join(SCENARIOS)}')
+    return name, float(ms)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', type=_budget, action='append', default=[],
+                        help='maximum median import time of a scenario')
+    parser.add_argument('--top', action='store_true',
+                        help='print the slowest modules of each scenario')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault('DATABASE_URL', 'sqlite://')
+    env.setdefault('MAIL_WORKER', 'none')
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.getcwd(),
+                                                      env.get('PYTHONPATH')]))
+
+    results = {name: bench(statement, args.runs, env)
+               for name, statement in SCENARIOS.items()}
+
+    print(f"{'scenario':<12} {'median ms':>10} {'min ms':>8} {'modules':>8} "
+          f"{'flask_dance':>12}")
+    for name, r in results.items():
+        print(f"{name:<12} {r['median_ms']:>10.1f} {r['min_ms']:>8.1f} "
+              f"{r['modules']:>8} {'yes' if r['flask_dance'] else 'no':>12}")
+        if args.top:
+            for module, ms in r['slowest']:
+                print(f"    {module:<40} {ms:>8.1f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    over = [(name, budget) for name, budget in args.budget
+            if results[name]['median_ms'] > budget]
+    for name, budget in over:
+        print(f"{name}: {results[name]['median_ms']:.1f} ms, over the "
+              f"{budget:.0f} ms budget")
+    if over:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Latency, throughput and SQL statements of the OAuth callback.
+
+Starts a local mock provider (see benchmarks.mock_oauth) answering after
+--delay seconds, then drives the Facebook login flow with --clients
+concurrent clients. Only the callback (/login/facebook/authorized) is timed:
+it fetches the token and the userinfo from the provider, then creates,
+links or logs in the local user.
+
+    python -m benchmarks.bench_oauth --clients 8 --requests 400 --delay 0.02
+"""
+import argparse
+import json
+import os
+from urllib.parse import urlparse, parse_qs
+from benchmarks import harness, mock_oauth
+
+
+def bench(clients: list, nb_requests: int, nb_accounts: int) -> dict:
+    def callback(code):
+        def request(client, i):
+            client.request('GET', '/logout')
+            status, headers = client.request('GET', '/login/facebook')
+            if status != 302:
+                raise RuntimeError(f'GET /login/facebook returned {status}')
+
+            # The provider would redirect the browser to the callback
+            query = parse_qs(urlparse(headers['Location']).query)
+            return harness.timed(
+                client, 'GET', f"/login/facebook/authorized?code={code(i)}"
+                f"&state={query['state'][0]}", expected=(302, ))
+        return request
+
+    return {
+        # Every callback creates a new local user
+        'signup': harness.run_concurrent(
+            clients, nb_requests, callback(lambda i: 1000000 + i)),
+        # Callbacks of already linked accounts
+        'login': harness.run_concurrent(
+            clients, nb_requests, callback(lambda i: 1000000 + i % nb_accounts)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=4,
+                        help='number of concurrent clients')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='number of callbacks per scenario')
+    parser.add_argument('--delay', type=float, default=0.02,
+                        help='provider latency in seconds')
+    parser.add_argument('--wsgi', action='store_true',
+                        help='go through a local WSGI server instead of the test client')
+    parser.add_argument('--database', help='SQLite file (default: temporary file)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    provider, provider_url = mock_oauth.serve(args.delay)
+    database = harness.setup_environment(
+        args.database,
+        OAUTH_PROVIDER_URL=provider_url,
+        FACEBOOK_OAUTH_CLIENT_ID='bench',
+        FACEBOOK_OAUTH_CLIENT_SECRET='bench',
+        # The mock provider is plain HTTP
+        OAUTHLIB_INSECURE_TRANSPORT=1,
+        OAUTHLIB_RELAX_TOKEN_SCOPE=1)
+    app = harness.create_app()
+
+    if args.wsgi:
+        base_url = harness.serve(app)
+        clients = [harness.HTTPClient(base_url) for _ in range(args.clients)]
+    else:
+        clients = [harness.FlaskClient(app) for _ in range(args.clients)]
+
+    results = {
+        'meta': {
+            'mode': 'wsgi' if args.wsgi else 'test_client',
+            'clients': args.clients,
+            'requests': args.requests,
+            'provider_delay': args.delay,
+        },
+        'scenarios': bench(clients, args.requests, max(1, args.requests // 10)),
+        'provider_calls': provider.calls,
+    }
+    if not args.database:
+        os.unlink(database)
+
+    print(f"{'callback':<10} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'SQL/req':>8}")
+    for name, r in results['scenarios'].items():
+        print(f"{name:<10} {r['requests_per_sec']:>8.1f} {r['p50_ms']:>8.1f} "
+              f"{r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f} "
+              f"{r['sql_statements_per_request'] or 0:>8.1f}")
+    print(f"provider calls: {provider.calls}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
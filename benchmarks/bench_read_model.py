@@ -0,0 +1,109 @@
+"""
+Dashboard pages and statistics: SQL versus the columnar read model.
+
+Inserts --users users with random sign-in counters straight into a temporary
+database, then times User.FetchAll()/GetStatistics() against the read model
+(www.readmodel, requires numpy) for the first and a deep page of every sort,
+the full load of the model, its refresh after --logins logins, and compares
+its memory per user with ORM User instances.
+
+    python -m benchmarks.bench_read_model --users 100000
+"""
+import argparse
+import os
+import random
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from benchmarks import harness
+
+
+def timed(fn, repeat: int = 20) -> float:
+    # Best of `repeat` runs, in milliseconds
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def insert_users(nb_users: int) -> None:
+    from www.models import db, User
+
+    now = datetime.utcnow()
+    for start in range(0, nb_users, 10000):
+        db.session.execute(User.__table__.insert(), [{
+            'created_at': now - timedelta(days=random.randint(0, 365)),
+            'email': f'user{i}@bench.example.com',
+            'nickname': f'user{i}',
+            'signin_count': random.randint(1, 50),
+            'last_signin_at': now - timedelta(seconds=random.randint(0, 30 * 86400)),
+        } for i in range(start, min(nb_users, start + 10000))])
+    db.session.commit()
+
+
+def orm_bytes_per_user(nb_users: int) -> float:
+    from www.models import db, User
+
+    db.session.expunge_all()
+    tracemalloc.start()
+    users = User.query.limit(nb_users).all()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    db.session.expunge_all()
+    return size / len(users)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--size', type=int, default=50, help='page size')
+    parser.add_argument('--logins', type=int, default=100,
+                        help='logins between two refreshes of the model')
+    args = parser.parse_args()
+
+    database = harness.setup_environment(None)
+    app = harness.create_app()
+    from www.models import User
+    from www.readmodel import read_model
+
+    if not read_model.enabled:
+        raise SystemExit('The read model requires numpy')
+
+    with app.test_request_context():
+        insert_users(args.users)
+
+        load = timed(read_model._load, repeat=3)
+        print(f"load: {load:.1f} ms for {args.users} users")
+
+        print(f"{'sort':<12} {'page':<6} {'SQL ms':>8} {'model ms':>9}")
+        for sort in User.SORT_OPTIONS:
+            _, deep = User.FetchAll(sort, None, args.users // 2)
+            for page, after in (('first', None), ('deep', deep)):
+                sql = timed(lambda: User.FetchAll(sort, after, args.size))
+                model = timed(lambda: read_model.fetch(sort, after, args.size))
+                print(f"{sort:<12} {page:<6} {sql:>8.2f} {model:>9.2f}")
+
+        sql = timed(User.GetStatistics)
+        model = timed(read_model.statistics)
+        print(f"{'statistics':<19} {sql:>8.2f} {model:>9.2f}")
+
+        ids = random.sample(range(1, args.users + 1), args.logins)
+        for id in ids:
+            User.FindById(id).on_logged_in()
+        start = time.perf_counter()
+        read_model.fetch('logins', None, args.size)
+        print(f"refresh after {args.logins} logins (and sort): "
+              f"{(time.perf_counter() - start) * 1000:.1f} ms")
+
+        print(f"memory per user: model {read_model.nbytes() / args.users:.0f} B "
+              f"(columns and sorted orders), ORM User "
+              f"{orm_bytes_per_user(min(args.users, 10000)):.0f} B")
+    os.unlink(database)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+Requests per second of `/` and `/login` from 1 to N worker processes.
+
+Seeds a temporary database, then for each --workers count serves it with
+`python -m www.prefork` (caches, user snapshots and rate limit counters in
+the shared state directory) and drives it from --load-processes client
+processes with --clients connections each: a single Python process could
+not saturate several workers. `/` is the dashboard of a logged in user,
+`/login` a successful login hashing the password with --bcrypt-rounds.
+
+    python -m benchmarks.bench_scaling --workers 1,2,4,8 --requests 2000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from benchmarks import harness
+
+
+def _int_list(value: str) -> list[int]:
+    return [int(v) for v in value.split(',')]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workers: int, port: int, timeout: float = 60) -> subprocess.Popen:
+    env = dict(os.environ, SERVER_NAME=f'localhost:{port}')
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'www.prefork', '--workers', str(workers),
+         '--port', str(port)], env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f'http://localhost:{port}/login', timeout=1)
+            return server
+        except OSError:
+            if server.poll() is not None:
+                raise RuntimeError(f'The server exited with status {server.returncode}')
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError(f'The server did not start within {timeout} seconds')
+
+
+def stop_server(server: subprocess.Popen) -> None:
+    server.terminate()
+    server.wait(30)
+
+
+def login_data(client) -> dict:
+    return {'email': client.email, 'password': harness.PASSWORD,
+            'csrf_token': client.csrf}
+
+
+def login(client, i):
+    client.request('GET', '/logout')
+    return harness.timed(client, 'POST', '/login', login_data(client),
+                         expected=(302, ))
+
+
+def dashboard(client, i):
+    return harness.timed(client, 'GET', '/')
+
+
+SCENARIOS = {'/': dashboard, '/login': login}
+
+
+def drive(base_url: str, scenario: str, emails: list[str], nb_requests: int,
+          barrier, results) -> None:
+    # Runs in a load process: connects and logs the clients in, then waits
+    # for the other load processes before sending the requests
+    clients = [harness.HTTPClient(base_url) for _ in emails]
+    for client, email in zip(clients, emails):
+        client.email = email
+        client.csrf = client.csrf_token('/login')
+        if scenario == '/':
+            client.request('POST', '/login', login_data(client))
+
+    barrier.wait()
+    results.put(harness.run_concurrent(clients, nb_requests,
+                                       SCENARIOS[scenario]))
+
+
+def bench(base_url: str, scenario: str, emails: list[str], nb_requests: int,
+          nb_processes: int) -> dict:
+    ctx = multiprocessing.get_context('fork')
+    barrier = ctx.Barrier(nb_processes)
+    results = ctx.Queue()
+    per_process = len(emails) // nb_processes
+
+    processes = [ctx.Process(target=drive, args=(
+        base_url, scenario, emails[i * per_process:(i + 1) * per_process],
+        nb_requests // nb_processes, barrier, results))
+        for i in range(nb_processes)]
+    for process in processes:
+        process.start()
+    summaries = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    # The load processes run side by side: their throughputs add up, the
+    # latencies are those of the slowest one
+    return {
+        'requests': sum(s['requests'] for s in summaries),
+        'requests_per_sec': sum(s['requests_per_sec'] for s in summaries),
+        'p50_ms': max(s['p50_ms'] for s in summaries),
+        'p95_ms': max(s['p95_ms'] for s in summaries),
+        'p99_ms': max(s['p99_ms'] for s in summaries),
+    }
+
+
+def main():
+    cpus = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=_int_list,
+                        default=sorted({1, 2, 4, cpus} - {n for n in (2, 4) if n > cpus}),
+                        help='comma separated numbers of worker processes')
+    parser.add_argument('--load-processes', type=int, default=max(2, cpus),
+                        help='number of client processes')
+    parser.add_argument('--clients', type=int, default=4,
+                        help='concurrent clients per load process')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='number of requests per scenario')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--sessions', type=int, default=5000)
+    parser.add_argument('--bcrypt-rounds', type=int, default=10)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    nb_clients = args.load_processes * args.clients
+    database = harness.setup_environment(None, BCRYPT_ROUNDS=args.bcrypt_rounds)
+    app = harness.create_app()
+    emails = harness.seed(app, max(args.users, nb_clients), args.sessions,
+                          nb_clients)
+
+    results = {
+        'meta': {
+            'cpus': cpus,
+            'load_processes': args.load_processes,
+            'clients': nb_clients,
+            'requests': args.requests,
+            'bcrypt_rounds': args.bcrypt_rounds,
+        },
+        'workers': {},
+    }
+    for workers in args.workers:
+        port = free_port()
+        server = start_server(workers, port)
+        try:
+            results['workers'][workers] = {
+                scenario: bench(f'http://localhost:{port}', scenario, emails,
+                                args.requests, args.load_processes)
+                for scenario in SCENARIOS}
+        finally:
+            stop_server(server)
+    os.unlink(database)
+
+    print(f"{'workers':>7} {'endpoint':<8} {'req/s':>8} {'speedup':>8} "
+          f"{'p50 ms':>8} {'p95 ms':>8}")
+    baseline = results['workers'][args.workers[0]]
+    for workers, scenarios in results['workers'].items():
+        for scenario, r in scenarios.items():
+            speedup = r['requests_per_sec'] / baseline[scenario]['requests_per_sec']
+            print(f"{workers:>7} {scenario:<8} {r['requests_per_sec']:>8.1f} "
+                  f"{speedup:>7.2f}x {r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+Shared helpers of the benchmarks: environment setup, seeding through the
+models, concurrent load generation and latency statistics.
+
+`www` reads its configuration from the environment when the application is
+created, so `setup_environment()` must be called before `create_app()`.
+"""
+import logging
+import os
+import random
+import re
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+PASSWORD = 'Abcdef1!'
+
+
+def setup_environment(database: str = None, **config) -> str:
+    if database is None:
+        fd, database = tempfile.mkstemp(prefix='bench-', suffix='.db')
+        os.close(fd)
+
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.abspath(database)}'
+    # Emails are only queued, statements are counted per response
+    os.environ.setdefault('MAIL_WORKER', 'none')
+    # Every client comes from the same address
+    os.environ.setdefault('RATELIMIT_ENABLED', '0')
+    os.environ['DEBUG_HEADERS'] = '1'
+    for key, value in config.items():
+        if value is not None:
+            os.environ[key] = str(value)
+    return database
+
+
+def create_app():
+    from www import create_app, migrations
+    from www.models import db
+
+    app = create_app()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['SESSION_COOKIE_DOMAIN'] = False
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        migrations.stamp()
+    return app
+
+
+def seed(app, nb_users: int, nb_sessions: int, nb_logins: int = 1) -> list[str]:
+    # Users and sessions go through User.Create()/add_session(), so that the
+    # rollups and counters are maintained as in production. Only the emails
+    # of the first `nb_logins` users, hashed with the configured cost, can be
+    # used to log in. The others are hashed with the minimal cost.
+    from www.hashing import hasher
+    from www.models import db, User
+
+    emails = []
+    with app.app_context():
+        rounds = hasher.rounds
+        ids = []
+        for i in range(nb_users):
+            hasher.rounds = rounds if i < nb_logins else 4
+            user = User.Create(f'user{i}@bench.example.com', PASSWORD)
+            user.activated_at = db.func.current_timestamp()
+            ids.append(user.id)
+            if i < nb_logins:
+                emails.append(user.email)
+        hasher.rounds = rounds
+        db.session.commit()
+
+        for i in range(nb_sessions):
+            User.FindById(random.choice(ids)).add_session()
+            if i % 500 == 499:
+                db.session.commit()
+        db.session.commit()
+    return emails
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    return statistics.quantiles(sorted_values, n=100,
+                                 method='inclusive')[int(p) - 1]
+
+
+def summarize(latencies: list[float], statements: list[int],
+              elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'requests_per_sec': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'sql_statements_per_request': statistics.mean(statements)
+        if statements else None,
+    }
+
+
+def run_concurrent(clients: list, nb_requests: int, request) -> dict:
+    # `request(client, i)` performs the i-th request with one of the
+    # `clients` and returns its (latency in seconds, number of statements)
+    latencies = []
+    statements = []
+    lock = threading.Lock()
+    counter = iter(range(nb_requests))
+
+    def worker(client):
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+
+            latency, count = request(client, i)
+            with lock:
+                latencies.append(latency)
+                if count is not None:
+                    statements.append(count)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(len(clients)) as executor:
+        list(executor.map(worker, clients))
+    return summarize(latencies, statements, time.perf_counter() - start)
+
+
+class FlaskClient:
+    def __init__(self, app) -> None:
+        self._client = app.test_client()
+
+    def request(self, method: str, path: str, data: dict = None) -> tuple:
+        response = self._client.open(path, method=method, data=data)
+        return response.status_code, response.headers
+
+
+class HTTPClient:
+    def __init__(self, base_url: str) -> None:
+        import requests
+        self.base_url = base_url
+        self._session = requests.Session()
+
+    def request(self, method: str, path: str, data: dict = None) -> tuple:
+        response = self._session.request(method, self.base_url + path,
+                                         data=data, allow_redirects=False)
+        return response.status_code, response.headers
+
+    def csrf_token(self, path: str) -> str:
+        # Token of the form at `path`, for servers with CSRF protection
+        html = self._session.get(self.base_url + path).text
+        match = re.search(r'name="csrf_token"[^>]* value="([^"]+)"', html)
+        if match is None:
+            raise RuntimeError(f'No CSRF token in {path}')
+        return match.group(1)
+
+
+def serve(app) -> str:
+    # Serves the app from a local threaded WSGI server, returns its base URL
+    from werkzeug.serving import make_server
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    app.config['SERVER_NAME'] = f'127.0.0.1:{server.port}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.port}'
+
+
+def timed(client, method: str, path: str, data: dict = None,
+          expected: tuple = (200, )) -> tuple:
+    start = time.perf_counter()
+    status, headers = client.request(method, path, data)
+    latency = time.perf_counter() - start
+
+    if status not in expected:
+        raise RuntimeError(f'{method} {path} returned {status}')
+    count = headers.get('X-Query-Count')
+    return latency, int(count) if count is not None else None
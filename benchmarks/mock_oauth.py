@@ -0,0 +1,108 @@
+"""
+Local OAuth 2 provider standing in for Google and Facebook.
+
+Authorizes every request: the code sent back to the application is the one
+given to /authorize (default: 1), and the userinfo of an access token is the
+one of the `oauth<code>@bench.example.com` account. Every response is
+delayed by --delay seconds to simulate the provider's latency.
+
+Point the application to it with OAUTH_PROVIDER_URL=http://127.0.0.1:<port>
+
+    python -m benchmarks.mock_oauth --port 8001 --delay 0.05
+"""
+import argparse
+import json
+import logging
+import threading
+import time
+import uuid
+from urllib.parse import urlencode
+from werkzeug.serving import make_server
+from werkzeug.wrappers import Request, Response
+
+
+class MockProvider:
+    def __init__(self, delay: float = 0.0) -> None:
+        self.delay = delay
+        self.calls = {'authorize': 0, 'token': 0, 'userinfo': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.calls[name] += 1
+
+    @staticmethod
+    def _json(data: dict, status: int = 200) -> Response:
+        return Response(json.dumps(data), status=status,
+                        content_type='application/json')
+
+    def authorize(self, request: Request) -> Response:
+        self._count('authorize')
+        query = urlencode({'code': request.args.get('code', '1'),
+                           'state': request.args.get('state', '')})
+        return Response(status=302, headers={
+            'Location': f"{request.args['redirect_uri']}?{query}"})
+
+    def token(self, request: Request) -> Response:
+        self._count('token')
+        code = request.form.get('code', '')
+        if not code.isdigit():
+            return self._json({'error': 'invalid_grant'}, 400)
+
+        return self._json({'access_token': f'{code}.{uuid.uuid4().hex}',
+                           'token_type': 'Bearer', 'expires_in': 3600})
+
+    def userinfo(self, request: Request) -> Response:
+        self._count('userinfo')
+        scheme, _, access_token = request.headers.get(
+            'Authorization', '').partition(' ')
+        code = access_token.partition('.')[0]
+        if scheme.lower() != 'bearer' or not code.isdigit():
+            return self._json({'error': 'invalid_token'}, 401)
+
+        return self._json({'id': code, 'name': f'OAuth user {code}',
+                           'email': f'oauth{code}@bench.example.com'})
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        if self.delay:
+            time.sleep(self.delay)
+
+        if request.path == '/authorize':
+            response = self.authorize(request)
+        elif request.path == '/token':
+            response = self.token(request)
+        elif request.path in ('/me', '/oauth2/v1/userinfo'):
+            response = self.userinfo(request)
+        else:
+            response = Response(status=404)
+        return response(environ, start_response)
+
+
+def serve(delay: float = 0.0, port: int = 0) -> tuple:
+    # Runs the provider in a background thread, returns it with its base URL
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    provider = MockProvider(delay)
+    server = make_server('127.0.0.1', port, provider, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return provider, f'http://127.0.0.1:{server.port}'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--delay', type=float, default=0.0,
+                        help='seconds added to every response')
+    args = parser.parse_args()
+
+    _, base_url = serve(args.delay, args.port)
+    print(f'Mock OAuth provider on {base_url}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+import pytest
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    # One application and database for the session: the extensions are
+    # module singletons configured by the latest create_app() call
+    database = tmp_path_factory.mktemp('db') / 'test.db'
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv('DATABASE_URL', f'sqlite:///{database}')
+        mp.setenv('SERVER_NAME', 'localhost.localdomain')
+        mp.setenv('DEBUG_HEADERS', '1')
+        mp.setenv('MAIL_WORKER', 'none')
+        mp.setenv('RATELIMIT_ENABLED', '0')
+        mp.setenv('BCRYPT_ROUNDS', '4')
+        mp.setenv('HASH_POOL_SIZE', '0')
+
+        from www import create_app, migrations
+        from www.models import db
+
+        app = create_app()
+        app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+        with app.app_context():
+            db.create_all()
+            migrations.stamp()
+        yield app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture(autouse=True)
+def cold_read_model():
+    # The read model is process-wide: each test loads it afresh
+    yield
+    from www.readmodel import read_model
+    read_model.reset()
@@ -0,0 +1,67 @@
+import json
+import uuid
+from base64 import urlsafe_b64encode
+from datetime import datetime
+import pytest
+from www.models import db, User, _encode_cursor, _decode_cursor
+from www.readmodel import read_model
+
+
+def cursor(key, id: int) -> str:
+    return urlsafe_b64encode(json.dumps([key, id]).encode()).decode()
+
+
+def pages(fetch, sort: str) -> list:
+    ids, after = [], None
+    while True:
+        rows, after = fetch(sort, after, 3)
+        ids += [row.id for row in rows]
+        if after is None:
+            return ids
+
+
+@pytest.fixture
+def users(app):
+    # Users who never signed in, between users who did
+    with app.app_context():
+        for i in range(4):
+            User.Create(f'{uuid.uuid4().hex}@test.example.com', 'Abcdef1!')
+            db.session.execute(User.__table__.insert().values(
+                email=f'{uuid.uuid4().hex}@test.example.com', nickname='never'))
+            db.session.commit()
+        yield
+        db.session.remove()
+
+
+@pytest.mark.parametrize('sort', User.SORT_OPTIONS)
+def test_pages(users, sort):
+    ids = pages(User.FetchAll, sort)
+    assert sorted(ids) == sorted(id for id, in db.session.query(User.id))
+    if read_model.enabled:
+        assert pages(read_model.fetch, sort) == ids
+
+
+def test_null_keys_come_last(users):
+    ids = pages(User.FetchAll, 'last_signin')
+    never = [id for id, in db.session.query(User.id)
+             .filter(User.last_signin_at.is_(None)).order_by(User.id.desc())]
+    assert ids[-len(never):] == never
+
+
+@pytest.mark.parametrize('key', [{}, [1], 1.5, True])
+def test_invalid_cursor_keys(app, key):
+    with pytest.raises(ValueError):
+        _decode_cursor(cursor(key, 1))
+
+
+@pytest.mark.parametrize('sort, key', [('logins', 'a'), ('logins', None),
+                                       ('last_signin', 1), ('last_signin', 'a')])
+def test_cursor_key_types(app, sort, key):
+    with app.app_context(), pytest.raises(ValueError):
+        User.FetchAll(sort, cursor(key, 1))
+
+
+def test_datetime_keys():
+    # Non-SQLite databases return datetimes for the sort keys
+    key, id = _decode_cursor(_encode_cursor(datetime(2022, 7, 1, 12, 30), 7))
+    assert (key, id) == ('2022-07-01 12:30:00.000000', 7)
@@ -0,0 +1,19 @@
+from www.models import User
+from test_query_counts import PASSWORD, new_email
+
+
+def test_bulk_create_batches(app):
+    # The lookups of the emails span several queries
+    with app.app_context():
+        existing = new_email()
+        User.Create(existing, PASSWORD)
+
+        emails = [new_email() for _ in range(4)]
+        records = [{'email': email, 'password': PASSWORD}
+                   for email in [emails[0], existing, *emails, emails[3]]]
+        assert User.BulkCreate(records, batch_size=2) == 4
+
+        for email in emails:
+            user = User.FindByEmail(email)
+            assert user.signin_count == 1
+            assert len(user.sessions) == 1
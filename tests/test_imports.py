@@ -0,0 +1,49 @@
+import os
+import subprocess
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only imported by the features using them (read model, Redis backends, OAuth,
+# async server)
+LAZY = {'numpy', 'redis', 'httpx', 'requests', 'flask_dance', 'uvicorn',
+        'aiosqlite', 'aiosmtplib'}
+
+
+def imported_modules(code: str) -> set:
+    # Top-level packages imported by `code` in a fresh interpreter, read
+    # from its -X importtime report
+    env = dict(os.environ, PYTHONPATH=ROOT, DATABASE_URL='sqlite://',
+               MAIL_WORKER='none', GOOGLE_OAUTH_CONFIG=os.path.join(ROOT, 'missing.json'))
+    for name in ('FACEBOOK_OAUTH_CLIENT_ID', 'FACEBOOK_OAUTH_CLIENT_SECRET',
+                 'OAUTH_PROVIDER_URL'):
+        env.pop(name, None)
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                             cwd=ROOT, env=env, capture_output=True, text=True,
+                             check=True)
+    modules = set()
+    for line in process.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            name = line.rpartition('|')[2].strip()
+            modules.add(name.split('.')[0])
+    return modules
+
+
+@pytest.mark.parametrize('code', ['import www', 'import www.models'])
+def test_import_is_lazy(code):
+    assert not imported_modules(code) & LAZY
+
+
+def test_create_app_is_lazy():
+    # dnspython (email validation) imports httpx and requests when installed
+    modules = imported_modules('from www import create_app; create_app()')
+    assert not modules & (LAZY - {'httpx', 'requests'})
+
+
+def test_create_app_returns_new_app(app):
+    from www import create_app
+
+    other = create_app()
+    assert other is not app
+    assert other.view_functions.keys() == app.view_functions.keys()
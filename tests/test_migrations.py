@@ -0,0 +1,38 @@
+from datetime import datetime
+from www import migrations
+from www.models import db, User, UserSession, DailyUserActivity, \
+    DailyActivity, HourlyActivity, Counters
+from test_query_counts import PASSWORD, new_email
+
+ROLLUPS = (DailyUserActivity, DailyActivity, HourlyActivity, Counters)
+
+
+def test_upgrade_fills_rollups(app):
+    # A database from before the rollups: `flask db upgrade` alone gives
+    # the statistics of its users and sessions
+    with app.app_context():
+        User.Create(new_email(), PASSWORD)
+        today = datetime.utcnow().date()
+        users = User.query.count()
+        signups = User.query.filter(db.func.date(User.created_at) == today).count()
+        logins = UserSession.query \
+            .filter(db.func.date(UserSession.logged_at) == today).count()
+
+        with db.engine.begin() as conn:
+            for model in ROLLUPS:
+                model.__table__.drop(conn)
+            conn.execute(migrations.schema_migration.delete().where(
+                migrations.schema_migration.c.id.in_([
+                    '0003_activity_buckets', '0004_daily_user_last_logged_at',
+                    '0007_activity_rollups'])))
+        db.session.remove()
+
+        assert migrations.upgrade() == [
+            '0003_activity_buckets', '0004_daily_user_last_logged_at',
+            '0007_activity_rollups']
+
+        assert db.session.get(Counters, 1).total_users == users
+        daily = db.session.get(DailyActivity, today)
+        assert (daily.signups, daily.login_count) == (signups, logins)
+        assert db.session.query(db.func.sum(HourlyActivity.login_count)) \
+            .filter(HourlyActivity.day == today).scalar() == logins
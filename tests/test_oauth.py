@@ -0,0 +1,69 @@
+import threading
+import uuid
+from www.models import db, User, OAuth
+
+TOKEN = {'access_token': 'token', 'token_type': 'Bearer'}
+
+
+def callback(app, provider_user_id: str, email: str) -> int:
+    # A callback of another request, committed meanwhile
+    result = []
+
+    def run():
+        with app.test_request_context():
+            result.append(User.UpsertWithOAuth('facebook', provider_user_id,
+                                               email, 'Winner', TOKEN).id)
+            db.session.remove()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+def racing(app, monkeypatch, provider_user_id: str) -> list:
+    # Another callback of the account commits right after the email lookup
+    find_by_email = User.FindByEmail
+    winner = []
+
+    def racing_find_by_email(email):
+        user = find_by_email(email)
+        if not winner:
+            winner.append(None)
+            winner[0] = callback(app, provider_user_id, email)
+        return user
+
+    monkeypatch.setattr(User, 'FindByEmail', staticmethod(racing_find_by_email))
+    return winner
+
+
+def accounts(email: str) -> tuple:
+    return (User.query.filter_by(email=email).count(),
+            OAuth.query.filter_by(provider='facebook').join(User)
+            .filter(User.email == email).count())
+
+
+def test_concurrent_signups(app, monkeypatch):
+    provider_user_id, email = uuid.uuid4().hex, f'{uuid.uuid4().hex}@test.example.com'
+    winner = racing(app, monkeypatch, provider_user_id)
+    with app.test_request_context():
+        user = User.UpsertWithOAuth('facebook', provider_user_id, email,
+                                    'Loser', TOKEN)
+        assert user.id == winner[0]
+        assert accounts(email) == (1, 1)
+        db.session.remove()
+
+
+def test_concurrent_links(app, monkeypatch):
+    provider_user_id, email = uuid.uuid4().hex, f'{uuid.uuid4().hex}@test.example.com'
+    with app.test_request_context():
+        User.Create(email, 'Abcdef1!')
+        db.session.remove()
+
+    winner = racing(app, monkeypatch, provider_user_id)
+    with app.test_request_context():
+        user = User.UpsertWithOAuth('facebook', provider_user_id, email,
+                                    'Loser', TOKEN)
+        assert user.id == winner[0]
+        assert accounts(email) == (1, 1)
+        db.session.remove()
@@ -0,0 +1,41 @@
+import pytest
+from www.models import db, User, OutboxEmail
+from test_query_counts import PASSWORD, new_email, signup
+
+
+def test_signup_queues_email(app, client):
+    email = new_email()
+    signup(client, email)
+
+    with app.app_context():
+        assert User.FindByEmail(email) is not None
+        assert OutboxEmail.query.filter_by(recipient=email).count() == 1
+
+
+def test_signup_rolled_back_without_email(app, client, monkeypatch):
+    # The user isn't saved when its verification email can't be queued
+    def fail(*args):
+        raise RuntimeError('outbox unavailable')
+    monkeypatch.setattr(OutboxEmail, 'Enqueue', fail)
+
+    email = new_email()
+    with pytest.raises(RuntimeError):
+        signup(client, email)
+
+    with app.app_context():
+        db.session.rollback()
+        assert User.FindByEmail(email) is None
+
+
+def test_claim_due(app):
+    with app.app_context():
+        email = new_email()
+        User.Create(email, PASSWORD)
+        OutboxEmail.Enqueue(email, 'Subject', 'text', 'html')
+
+        claimed = OutboxEmail.ClaimDue(1000, 300)
+        assert email in {e.recipient for e in claimed}
+        assert len({e.claim for e in claimed}) == 1
+
+        # Leased to the first worker, the other ones skip them
+        assert OutboxEmail.ClaimDue(1000, 300) == []
@@ -0,0 +1,67 @@
+import re
+import uuid
+from www.models import OutboxEmail
+
+PASSWORD = 'Abcdef1!'
+
+
+def new_email() -> str:
+    return f'{uuid.uuid4().hex}@test.example.com'
+
+
+def query_count(response) -> int:
+    return int(response.headers['X-Query-Count'])
+
+
+def signup(client, email: str):
+    client.get('/logout')
+    return client.post('/signup', data={'email': email, 'password': PASSWORD,
+                                        'confirm': PASSWORD})
+
+
+def login(client, email: str):
+    client.get('/logout')
+    return client.post('/login', data={'email': email, 'password': PASSWORD})
+
+
+def activation_path(app, email: str) -> str:
+    # The key is only known from the verification email
+    with app.app_context():
+        outbox = OutboxEmail.query.filter_by(recipient=email) \
+            .order_by(OutboxEmail.id.desc()).first()
+        return re.search(r'/activate/[^\s"]+', outbox.text).group(0)
+
+
+def test_signup(client):
+    response = signup(client, new_email())
+    assert response.status_code == 302
+    assert query_count(response) == 9
+
+
+def test_login(client):
+    email = new_email()
+    signup(client, email)
+
+    response = login(client, email)
+    assert response.status_code == 302
+    assert query_count(response) == 6
+
+
+def test_activate(app, client):
+    email = new_email()
+    signup(client, email)
+    client.get('/logout')
+
+    response = client.get(activation_path(app, email))
+    assert response.status_code == 302
+    assert query_count(response) == 7
+
+
+def test_dashboard(app, client):
+    email = new_email()
+    signup(client, email)
+    client.get(activation_path(app, email))
+
+    response = client.get('/')
+    assert response.status_code == 200
+    assert query_count(response) == 4
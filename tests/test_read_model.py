@@ -0,0 +1,28 @@
+import uuid
+import pytest
+from www.models import db, User
+from www.readmodel import read_model
+
+pytest.importorskip('numpy')
+
+
+def insert_user() -> None:
+    # As signed up by another process: the version of this process' cache
+    # is not bumped
+    db.session.execute(User.__table__.insert().values(
+        email=f'{uuid.uuid4().hex}@test.example.com', nickname='other'))
+    db.session.commit()
+
+
+def test_refreshed_with_in_process_cache(app, monkeypatch):
+    assert read_model.enabled
+    assert read_model.refresh_interval == app.config['CACHE_TTL']
+
+    with app.test_request_context():
+        total = read_model.statistics()['total_users']
+        insert_user()
+        assert read_model.statistics()['total_users'] == total
+
+        # CACHE_TTL seconds later
+        monkeypatch.setattr(read_model, 'refresh_interval', 0)
+        assert read_model.statistics()['total_users'] == total + 1
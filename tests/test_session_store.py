@@ -0,0 +1,47 @@
+from types import SimpleNamespace
+from test_query_counts import PASSWORD, new_email, signup, activation_path
+from www import cache as cache_module
+from www.cache import SQLiteCache
+from www.models import db, User
+from www.session_store import SessionStore, session_store
+
+
+def test_versions_outlive_snapshots(tmp_path, monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(cache_module, 'time', SimpleNamespace(time=lambda: clock.now))
+    store = SessionStore()
+    store.backend = SQLiteCache(str(tmp_path / 'sessions.db'))
+    store.ttl = 10
+
+    store.invalidate(1)
+    clock.now += 2 * store.ttl - 1
+    store.set(1, store.version(1), ('old', ))
+    # Past twice the TTL of the first invalidation, expired entries purged
+    clock.now += 2
+    for i in range(100):
+        store.backend.set(f'key:{i}', i, store.ttl)
+
+    store.invalidate(1)
+    assert store.get(1, store.version(1)) is None
+
+
+def test_snapshot_without_password_hash(app, client):
+    email = new_email()
+    signup(client, email)
+    client.get(activation_path(app, email))
+    client.get('/')
+
+    with app.app_context():
+        user = User.FindByEmail(email)
+        snapshot = session_store.get(user.id, session_store.version(user.id))
+        assert user.password not in snapshot
+        db.session.remove()
+
+    # The hash is loaded to check the current password
+    new_password = 'Ghijkl2@'
+    response = client.post('/', data={'old_pwd': PASSWORD, 'password': new_password,
+                                      'confirm': new_password})
+    assert response.status_code == 302
+    client.get('/logout')
+    response = client.post('/login', data={'email': email, 'password': new_password})
+    assert response.status_code == 302
@@ -0,0 +1,13 @@
+from www.tokens import tokens, hash_token
+
+
+def test_hash_token():
+    token = tokens.generate(32)
+    assert hash_token(token) == hash_token(token)
+    assert hash_token('é') != hash_token('e')
+
+
+def test_activate_unknown_key(client):
+    # Not a base62 key: no user, like any other unknown key
+    response = client.get('/activate/a@x.com/%C3%A9')
+    assert response.status_code == 302
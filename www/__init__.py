@@ -1,36 +1,199 @@
 import os
-from flask import Flask
-from flask_login import LoginManager
-from www.models import db, User
-from www.mailer import Mailer
-from www.oauth import google_blueprint, facebook_blueprint
 
 
-app = Flask(__name__)
+def engine_options(url: str) -> dict:
+    options = {
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', '1') == '1',
+    }
+    if url.startswith('sqlite'):
+        # An in-memory database is bound to a single static connection
+        if url in ('sqlite://', 'sqlite:///:memory:'):
+            return options
+        # SQLAlchemy doesn't pool SQLite file connections by default. Pooled
+        # connections are handed over between threads, one at a time.
+        from sqlalchemy.pool import QueuePool
+        options['poolclass'] = QueuePool
+        options['connect_args'] = {
+            'check_same_thread': False,
+            'timeout': float(os.getenv('SQLITE_BUSY_TIMEOUT', 5)),
+        }
 
-app.config['SERVER_NAME'] = os.getenv('SERVER_NAME', 'localhost:5000')
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your secret key')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///../database.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    options['pool_size'] = int(os.getenv('DB_POOL_SIZE', 5))
+    options['max_overflow'] = int(os.getenv('DB_MAX_OVERFLOW', 10))
+    return options
 
 
-app.register_blueprint(google_blueprint, url_prefix="/login")
-app.register_blueprint(facebook_blueprint, url_prefix="/login")
-db.init_app(app)
+def state_url(app, name: str) -> str:
+    state_dir = app.config['STATE_DIR']
+    if not state_dir:
+        return 'memory://'
+    return 'sqlite:///' + os.path.join(os.path.abspath(state_dir), f'{name}.db')
 
-login_manager = LoginManager(app)
-login_manager.login_view = 'login'
-login_manager.login_message_category = 'info'
 
-mailer = Mailer('smtp.gmail.com', 465,
-    os.getenv('GMAIL_PASSWORD', '123456789'),
-    os.getenv('GMAIL_ADDRESS', 'my@example.com'),
-    app.logger)
+def configure(app) -> None:
+    app.config['SERVER_NAME'] = os.getenv('SERVER_NAME', 'localhost:5000')
+    app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your secret key')
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL',
+                                                      'sqlite:///../database.db')
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+        app.config['SQLALCHEMY_DATABASE_URI'])
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Replica the read-only (dashboard) queries are sent to, when set
+    app.config['DATABASE_REPLICA_URL'] = os.getenv('DATABASE_REPLICA_URL')
+    # Seconds of lag beyond which the replica reads fall back to the primary.
+    # A user also reads from the primary for that long after their writes.
+    app.config['REPLICA_MAX_LAG'] = float(os.getenv('REPLICA_MAX_LAG', 5))
+    # Seconds between two measures of the lag, in each process
+    app.config['REPLICA_LAG_CHECK'] = float(os.getenv('REPLICA_LAG_CHECK', 1))
+    # Async driver of the database for `python -m www.asgi`, derived from a
+    # SQLite DATABASE_URL (sqlite+aiosqlite) when unset
+    app.config['ASYNC_DATABASE_URL'] = os.getenv('ASYNC_DATABASE_URL')
+    # Threads of `python -m www.asgi` serving the endpoints not run on its
+    # event loop
+    app.config['ASGI_THREADS'] = int(os.getenv('ASGI_THREADS', 16))
+    app.config['BCRYPT_ROUNDS'] = int(os.getenv('BCRYPT_ROUNDS', 12))
+    # Bloom filter built by `flask passwords build`, the new passwords found
+    # in it are rejected
+    app.config['BREACHED_PASSWORDS_FILE'] = os.getenv('BREACHED_PASSWORDS_FILE')
+    # Number of processes computing bcrypt hashes, 0 to hash in the request thread
+    app.config['HASH_POOL_SIZE'] = int(os.getenv('HASH_POOL_SIZE',
+                                                 min(4, os.cpu_count() or 1)))
+    # Bytes drawn at once from the OS random generator for activation keys
+    app.config['TOKEN_BATCH_SIZE'] = int(os.getenv('TOKEN_BATCH_SIZE', 8192))
+    # Adds X-Query-Count (and other debug data) to the responses
+    app.config['DEBUG_HEADERS'] = os.getenv(
+        'DEBUG_HEADERS', '1' if app.debug else '0') == '1'
+    # Server-Timing headers, per-request timings and the /metrics endpoint
+    app.config['INSTRUMENTATION'] = os.getenv('INSTRUMENTATION', '0') == '1'
+    # Share of the requests profiled with cProfile, dumped into PROFILE_DIR
+    app.config['PROFILE_SAMPLE_RATE'] = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+    app.config['PROFILE_DIR'] = os.getenv('PROFILE_DIR', 'profiles')
+    # Directory of the SQLite files holding the state shared by the processes
+    # of a host. When set, it replaces memory:// as the default backend of
+    # the cache, the session store and the rate limiter.
+    app.config['STATE_DIR'] = os.getenv('STATE_DIR')
+    # memory://, sqlite:///<path>, redis://<host>:<port>/<db> or null://
+    app.config['CACHE_URL'] = os.getenv('CACHE_URL', state_url(app, 'cache'))
+    app.config['CACHE_TTL'] = int(os.getenv('CACHE_TTL', 60))
+    # Snapshots of the logged in users, same URLs as CACHE_URL
+    app.config['SESSION_STORE_URL'] = os.getenv('SESSION_STORE_URL',
+                                                state_url(app, 'sessions'))
+    app.config['SESSION_STORE_TTL'] = int(os.getenv('SESSION_STORE_TTL', 3600))
+    app.config['DASHBOARD_PAGE_SIZE'] = int(os.getenv('DASHBOARD_PAGE_SIZE', 50))
+    # Live dashboard (/events): seconds between two checks of the statistics
+    # and between two keepalive comments, events queued per connection
+    app.config['EVENTS_POLL_INTERVAL'] = float(os.getenv('EVENTS_POLL_INTERVAL', 2))
+    app.config['EVENTS_KEEPALIVE'] = float(os.getenv('EVENTS_KEEPALIVE', 15))
+    app.config['EVENTS_QUEUE_SIZE'] = int(os.getenv('EVENTS_QUEUE_SIZE', 1000))
+    # Dashboard pages and statistics served from in-memory columns (requires
+    # numpy), fully reloaded every READ_MODEL_RELOAD seconds
+    app.config['READ_MODEL'] = os.getenv('READ_MODEL', '1') == '1'
+    app.config['READ_MODEL_RELOAD'] = int(os.getenv('READ_MODEL_RELOAD', 600))
+    app.config['ANALYTICS_MAX_DAYS'] = int(os.getenv('ANALYTICS_MAX_DAYS', 366))
+    # Number of reverse proxies in front of the app: the client address and
+    # scheme are read from the X-Forwarded-For/Proto headers they set. 0 when
+    # the clients connect directly, the headers are then ignored.
+    app.config['TRUSTED_PROXIES'] = int(os.getenv('TRUSTED_PROXIES', 0))
+    # Throttling of the login/signup/verification endpoints, RATELIMIT_URL is
+    # memory:// (per process) or a shared CACHE_URL-like backend
+    app.config['RATELIMIT_ENABLED'] = os.getenv('RATELIMIT_ENABLED', '1') == '1'
+    app.config['RATELIMIT_URL'] = os.getenv('RATELIMIT_URL',
+                                            state_url(app, 'ratelimit'))
+    # Compiled templates are cached on disk, shared by the processes
+    app.config['TEMPLATE_BYTECODE_CACHE'] = os.getenv('TEMPLATE_BYTECODE_CACHE', '1') == '1'
+    app.config['TEMPLATE_CACHE_DIR'] = os.getenv('TEMPLATE_CACHE_DIR')
+    # Older user sessions are archived to files by `flask sessions compact`
+    app.config['SESSION_RETENTION_DAYS'] = int(os.getenv('SESSION_RETENTION_DAYS', 90))
+    app.config['SESSION_ARCHIVE_DIR'] = os.getenv(
+        'SESSION_ARCHIVE_DIR', os.path.join(app.root_path, '..', 'archive'))
+    # Google's client secrets file, Facebook is set by FACEBOOK_OAUTH_CLIENT_*
+    app.config['GOOGLE_OAUTH_CONFIG'] = os.getenv(
+        'GOOGLE_OAUTH_CONFIG', os.path.join(app.root_path, '..', 'google.json'))
+    # Points every OAuth provider to a single (mock) server
+    app.config['OAUTH_PROVIDER_URL'] = os.getenv('OAUTH_PROVIDER_URL')
+    app.config['MAIL_HOST'] = os.getenv('MAIL_HOST', 'smtp.gmail.com')
+    app.config['MAIL_PORT'] = int(os.getenv('MAIL_PORT', 465))
+    app.config['MAIL_USE_SSL'] = os.getenv('MAIL_USE_SSL', '1') == '1'
+    app.config['MAIL_POOL_SIZE'] = int(os.getenv('MAIL_POOL_SIZE', 2))
+    app.config['MAIL_BATCH_SIZE'] = int(os.getenv('MAIL_BATCH_SIZE', 50))
+    app.config['MAIL_MAX_ATTEMPTS'] = int(os.getenv('MAIL_MAX_ATTEMPTS', 5))
+    app.config['MAIL_RETRY_DELAY'] = int(os.getenv('MAIL_RETRY_DELAY', 30))
+    # Seconds the emails claimed by a worker are hidden from the others,
+    # longer than sending a batch takes
+    app.config['MAIL_LEASE'] = int(os.getenv('MAIL_LEASE', 300))
+    # 'thread' drains the outbox from a background thread of the web process,
+    # anything else expects a separate `flask mail worker` process
+    app.config['MAIL_WORKER'] = os.getenv('MAIL_WORKER', 'thread')
+    app.config['MAIL_PASSWORD'] = os.getenv('GMAIL_PASSWORD', '123456789')
+    app.config['MAIL_SENDER'] = os.getenv('GMAIL_ADDRESS', 'my@example.com')
 
 
-@login_manager.user_loader
-def load_user(user_id: str):
-    return User.FindById(int(user_id))
+# Default application, created on first access to `www.app`
+_app = None
 
 
-from www import routes
+def create_app():
+    # Each call creates a new application. The extensions (db, cache,
+    # mailer...) are module singletons though: they follow the configuration
+    # of the latest application created.
+    from flask import Flask
+    from flask_login import LoginManager
+    from www.models import db, User
+    from www.mailer import mailer
+    from www.hashing import hasher
+    from www.breached import breached_passwords
+    from www.tokens import tokens
+    from www.cache import cache
+    from www.session_store import session_store
+    from www import instrumentation, assets, oauth
+    from www.ratelimit import limiter
+    from www.readmodel import read_model
+    from www.replica import replica
+    from www.events import broker
+
+    app = Flask(__name__)
+    configure(app)
+
+    proxies = app.config['TRUSTED_PROXIES']
+    if proxies:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies)
+
+    oauth.init_app(app)
+    db.init_app(app)
+    replica.init_app(app)
+    hasher.init_app(app)
+    breached_passwords.init_app(app)
+    tokens.init_app(app)
+    cache.init_app(app)
+    session_store.init_app(app)
+    instrumentation.init_app(app)
+    limiter.init_app(app)
+    read_model.init_app(app)
+    broker.init_app(app)
+    assets.init_app(app)
+    mailer.init_app(app)
+
+    login_manager = LoginManager(app)
+    login_manager.login_view = 'login'
+    login_manager.login_message_category = 'info'
+
+    @login_manager.user_loader
+    def load_user(user_id: str):
+        return User.FindLoggedIn(int(user_id))
+
+    from www import routes, commands
+    routes.init_app(app)
+    commands.init_app(app)
+    return app
+
+
+def __getattr__(name: str):
+    # Importing www is cheap, `www.app` is created on first access
+    if name == 'app':
+        global _app
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,145 @@
+import asyncio
+import sys
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+# aiosqlite, httpx and aiosmtplib are only imported by the code running on
+# the event loop of www.asgi
+
+# Set while a request (or the outbox worker) runs on the event loop
+_in_event_loop = ContextVar('in_event_loop', default=False)
+
+
+def in_event_loop() -> bool:
+    # True in the code run by run(): its blocking calls must be awaited
+    return _in_event_loop.get()
+
+
+def _bridged(fn, *args):
+    token = _in_event_loop.set(True)
+    try:
+        return fn(*args)
+    finally:
+        _in_event_loop.reset(token)
+
+
+async def run(fn, *args):
+    # Runs the synchronous `fn` in a greenlet of the event loop. The views,
+    # forms and models are shared with the threaded servers: where they'd
+    # block (queries, provider calls, bcrypt), they await through wait()
+    # and the loop serves the other requests meanwhile.
+    from sqlalchemy.util import greenlet_spawn
+    return await greenlet_spawn(_bridged, fn, *args)
+
+
+def wait(awaitable):
+    # Awaits from the synchronous code run by run()
+    from sqlalchemy.util import await_only
+    return await_only(awaitable)
+
+
+def result(future):
+    # Result of a concurrent.futures.Future, without blocking the loop
+    if in_event_loop():
+        return wait(asyncio.wrap_future(future))
+    return future.result()
+
+
+def call_in_thread(fn, *args):
+    # CPU-bound calls which release the GIL (bcrypt) go to the default
+    # executor of the loop rather than stalling it
+    if in_event_loop():
+        return wait(asyncio.get_running_loop().run_in_executor(None, fn, *args))
+    return fn(*args)
+
+
+def is_aiosqlite(dbapi_connection) -> bool:
+    if 'sqlalchemy.dialects.sqlite.aiosqlite' not in sys.modules:
+        return False
+    from sqlalchemy.dialects.sqlite.aiosqlite import AsyncAdapt_aiosqlite_connection
+    return isinstance(dbapi_connection, AsyncAdapt_aiosqlite_connection)
+
+
+def async_url(url):
+    # aiosqlite URL of a SQLite file database, None for the other databases
+    # (ASYNC_DATABASE_URL names their async driver, e.g. postgresql+asyncpg)
+    url = make_url(url)
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+        return None
+    return url.set(drivername='sqlite+aiosqlite')
+
+
+class WriteQueue:
+    # SQLite has a single writer. The transaction holding its lock awaits
+    # the loop between two statements, while the requests it runs meanwhile
+    # poll for the lock from their aiosqlite threads, in no particular order:
+    # the slowest wait for seconds. The write transactions of the loop queue
+    # for this lock instead, in order. Taken by the first statement which
+    # isn't a read, released by the commit or rollback.
+    def __init__(self) -> None:
+        self._lock = asyncio.Lock()
+
+    def install(self, engine) -> None:
+        event.listen(engine, 'before_cursor_execute', self._acquire)
+        event.listen(engine, 'commit', self._release)
+        event.listen(engine, 'rollback', self._release)
+        # Connections closed in a transaction
+        event.listen(engine, 'checkin', self._checkin)
+
+    def _acquire(self, conn, cursor, statement: str, *args) -> None:
+        if conn.info.get('write_queue') or \
+                statement.lstrip()[:6].upper() in ('SELECT', 'PRAGMA'):
+            return
+        wait(self._lock.acquire())
+        conn.info['write_queue'] = True
+
+    def _release(self, conn) -> None:
+        if conn.info.pop('write_queue', False):
+            self._lock.release()
+
+    def _checkin(self, dbapi_connection, connection_record) -> None:
+        if connection_record is not None and \
+                connection_record.info.pop('write_queue', False):
+            self._lock.release()
+
+
+class AsyncDatabase:
+    # Engine of the sessions used on the event loop: RoutingSession binds
+    # them to its synchronous facade, whose connections await the driver
+    def __init__(self) -> None:
+        self.engine = None
+
+    def start(self, app, primary_engine) -> None:
+        from sqlalchemy.ext.asyncio import create_async_engine
+        from sqlalchemy.pool import AsyncAdaptedQueuePool
+        from www import engine_options
+
+        url = app.config.setdefault('ASYNC_DATABASE_URL', None)
+        url = make_url(url) if url else async_url(primary_engine.url)
+        if url is None:
+            app.logger.warning("No async driver for %s, the queries of the event "
+                               "loop block it", primary_engine.url.drivername)
+            return
+
+        options = engine_options(str(url))
+        if url.get_backend_name() == 'sqlite':
+            # aiosqlite runs each connection in a thread of its own, where the
+            # writers wait for the lock. Its holder shares the loop with every
+            # other request: the writers wait as long as for a pooled
+            # connection rather than SQLITE_BUSY_TIMEOUT.
+            options['poolclass'] = AsyncAdaptedQueuePool
+            options['connect_args'] = {
+                'timeout': max(options['connect_args']['timeout'],
+                               float(options.get('pool_timeout', 30)))}
+        self.engine = create_async_engine(url, **options)
+        if url.get_backend_name() == 'sqlite':
+            WriteQueue().install(self.engine.sync_engine)
+
+    async def dispose(self) -> None:
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.engine = None
+
+
+database = AsyncDatabase()
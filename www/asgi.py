@@ -0,0 +1,246 @@
+import argparse
+import asyncio
+import io
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RequestRedirect
+from www import aio
+
+# Endpoints run on the event loop: while they wait for the OAuth provider,
+# the database, bcrypt or the next dashboard event, the loop serves the
+# other requests. The others (dashboard, static files...) are served by a
+# pool of threads.
+ASYNC_ENDPOINTS = frozenset(('signup', 'login', 'resend', 'events',
+                             'google.authorized', 'facebook.authorized'))
+
+
+def build_environ(scope: dict, body: bytes) -> dict:
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+        value = value.decode('latin-1')
+        environ[name] = f'{environ[name]},{value}' if name in environ else value
+    return environ
+
+
+async def read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+class StartResponse:
+    def __init__(self) -> None:
+        self.message = None
+
+    def __call__(self, status: str, headers: list, exc_info=None):
+        self.message = {
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in headers],
+        }
+
+
+class Application:
+    # ASGI application serving the Flask app: ASYNC_ENDPOINTS on the event
+    # loop, through www.aio, the other endpoints from `threads` threads
+    def __init__(self, app, threads: int = 16, endpoints=ASYNC_ENDPOINTS,
+                 send_mail: bool = False, poll_interval: float = 1.0) -> None:
+        self.app = app
+        self.endpoints = endpoints
+        self.send_mail = send_mail
+        self.poll_interval = poll_interval
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='wsgi')
+        self._urls = app.url_map.bind(app.config.get('SERVER_NAME') or 'localhost')
+        self._mail_worker = None
+
+    def endpoint(self, scope: dict):
+        try:
+            endpoint, _ = self._urls.match(scope['path'], method=scope['method'])
+        except (HTTPException, RequestRedirect):
+            return None
+        return endpoint
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError(f"Unsupported {scope['type']} connection")
+
+        environ = build_environ(scope, await read_body(receive))
+        if self.endpoint(scope) in self.endpoints:
+            await self.serve_async(environ, receive, send)
+        else:
+            await self.serve_threaded(environ, receive, send)
+
+    def _respond(self, environ: dict, forward, disconnected) -> None:
+        # Responses are sent as they are produced: the dashboard and the
+        # event streams are streamed. Stops producing once the client is gone.
+        start_response = StartResponse()
+        iterable = self.app(environ, start_response)
+        started = False
+        try:
+            for chunk in iterable:
+                if disconnected.is_set():
+                    return
+                if not chunk:
+                    continue
+                body = {'type': 'http.response.body', 'body': chunk,
+                        'more_body': True}
+                if started:
+                    forward(body)
+                else:
+                    forward(start_response.message, body)
+                    started = True
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+        end = {'type': 'http.response.body'}
+        if started:
+            forward(end)
+        else:
+            forward(start_response.message, end)
+
+    @staticmethod
+    async def watch(receive, disconnected) -> None:
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+    async def serve_async(self, environ: dict, receive, send) -> None:
+        # The whole response is produced by a greenlet of the loop, which
+        # awaits the sending of each chunk
+        disconnected = threading.Event()
+
+        def forward(*messages) -> None:
+            for message in messages:
+                aio.wait(send(message))
+
+        watcher = asyncio.create_task(self.watch(receive, disconnected))
+        try:
+            await aio.run(self._respond, environ, forward, disconnected)
+        finally:
+            watcher.cancel()
+
+    async def serve_threaded(self, environ: dict, receive, send) -> None:
+        loop = asyncio.get_running_loop()
+        disconnected = threading.Event()
+
+        def forward(*messages) -> None:
+            async def send_all():
+                for message in messages:
+                    await send(message)
+            asyncio.run_coroutine_threadsafe(send_all(), loop).result()
+
+        watcher = asyncio.create_task(self.watch(receive, disconnected))
+        try:
+            await loop.run_in_executor(self.executor, self._respond, environ,
+                                       forward, disconnected)
+        finally:
+            watcher.cancel()
+
+    async def startup(self) -> None:
+        from www.models import db
+        from www.mailer import mailer
+
+        with self.app.app_context():
+            aio.database.start(self.app, db.engine)
+        if self.send_mail:
+            self._mail_worker = asyncio.create_task(
+                mailer.run_worker_async(self.app, self.poll_interval))
+
+    async def shutdown(self) -> None:
+        from www.httpclient import http_adapter
+        from www.mailer import mailer
+
+        if self._mail_worker is not None:
+            mailer.stop_worker()
+            await self._mail_worker
+        await http_adapter.async_http.close()
+        await aio.database.dispose()
+        self.executor.shutdown(wait=False)
+
+    async def lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def create_application(threads: int = None, poll_interval: float = 1.0,
+                       endpoints=ASYNC_ENDPOINTS) -> Application:
+    # The outbox is drained by a task of the event loop rather than by a
+    # thread (MAIL_WORKER=thread), other values expect a separate worker
+    send_mail = os.getenv('MAIL_WORKER', 'thread') == 'thread'
+    os.environ['MAIL_WORKER'] = 'asgi'
+
+    from www import create_app
+
+    app = create_app()
+    return Application(app, threads or app.config['ASGI_THREADS'], endpoints,
+                       send_mail=send_mail, poll_interval=poll_interval)
+
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog='python -m www.asgi',
+        description="Serves the app from an event loop (requires "
+                    "requirements-async.txt).")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--threads', type=int,
+                        help='threads serving the synchronous endpoints '
+                             '(default: ASGI_THREADS)')
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help='seconds between two outbox polls of the mail worker')
+    parser.add_argument('--sync', action='store_true',
+                        help='serve every endpoint from the threads, like a '
+                             'WSGI server with a fixed number of threads')
+    args = parser.parse_args(argv)
+
+    import uvicorn
+
+    endpoints = () if args.sync else ASYNC_ENDPOINTS
+    uvicorn.run(create_application(args.threads, args.poll_interval, endpoints),
+                host=args.host, port=args.port, loop='asyncio', lifespan='on')
+
+
+if __name__ == '__main__':
+    main()
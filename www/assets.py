@@ -0,0 +1,114 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+from flask import request, send_file, abort
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.security import safe_join
+
+# Pre-compressed variants of the static files, by preference order
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+COMPRESSED_TYPES = ('text/', 'application/javascript', 'application/json',
+                    'image/svg+xml')
+
+# Static file path -> short hash of its content
+manifest = {}
+
+
+def _hash_file(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+
+def _static_files(static_folder: str):
+    for root, _, files in os.walk(static_folder):
+        for name in files:
+            if name.endswith(tuple(suffix for _, suffix in ENCODINGS)):
+                continue
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, static_folder).replace(os.sep, '/'), path
+
+
+def build_manifest(static_folder: str) -> dict:
+    return {filename: _hash_file(path)
+            for filename, path in _static_files(static_folder)}
+
+
+def compress_static(static_folder: str) -> list[str]:
+    # Writes the .gz (and .br, with the optional brotli package) variants of
+    # the text files, returns the paths written
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+
+    written = []
+    for filename, path in _static_files(static_folder):
+        mimetype = mimetypes.guess_type(filename)[0] or ''
+        if not mimetype.startswith(COMPRESSED_TYPES):
+            continue
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        variants = [('.gz', gzip.compress(data, 9, mtime=0))]
+        if brotli is not None:
+            variants.append(('.br', brotli.compress(data)))
+
+        for suffix, compressed in variants:
+            with open(path + suffix, 'wb') as f:
+                f.write(compressed)
+            written.append(path + suffix)
+    return written
+
+
+def compile_templates(app) -> int:
+    # Fills the bytecode cache, so that new processes skip Jinja's compiler
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def _send_static(app, filename: str):
+    path = safe_join(app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    # A content-hashed URL never changes, other ones must be revalidated
+    version = request.args.get('v')
+    immutable = version is not None and version == manifest.get(filename)
+    max_age = app.config['STATIC_MAX_AGE'] if immutable else None
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding, suffix in ENCODINGS:
+        variant = path + suffix
+        if request.accept_encodings[encoding] and os.path.isfile(variant) \
+                and os.path.getmtime(variant) >= os.path.getmtime(path):
+            response = send_file(variant, mimetype=mimetype, max_age=max_age)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_file(path, mimetype=mimetype, max_age=max_age)
+
+    response.vary.add('Accept-Encoding')
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response
+
+
+def init_app(app) -> None:
+    if app.config.setdefault('TEMPLATE_BYTECODE_CACHE', True):
+        # None: a directory of the system's temporary folder
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+            app.config.setdefault('TEMPLATE_CACHE_DIR', None))
+
+    app.config.setdefault('STATIC_MAX_AGE', 365 * 24 * 3600)
+    manifest.update(build_manifest(app.static_folder))
+
+    @app.url_defaults
+    def hashed_static_url(endpoint, values):
+        if endpoint == 'static' and values.get('filename') in manifest:
+            values.setdefault('v', manifest[values['filename']])
+
+    app.view_functions['static'] = lambda filename: _send_static(app, filename)
@@ -0,0 +1,215 @@
+import binascii
+import gzip
+import hashlib
+import importlib.util
+import math
+import mmap
+import os
+import struct
+import threading
+
+# Filter files: this header (magic, number of bits, number of entries,
+# number of hashes), then the bits, 8 per byte, least significant first
+HEADER = struct.Struct('<8sQQI')
+MAGIC = b'BLOOMv1\0'
+
+# Each entry only needs the first 16 bytes of its SHA-1
+PREFIX_SIZE = 16
+_MASK64 = 2 ** 64 - 1
+
+
+def parameters(entries: int, fp_rate: float) -> tuple[int, int]:
+    # Number of bits and of hashes of a filter holding `entries` with the
+    # given false positive rate
+    entries = max(1, entries)
+    bits = math.ceil(-entries * math.log(fp_rate) / math.log(2) ** 2)
+    hashes = max(1, round(bits / entries * math.log(2)))
+    return bits, hashes
+
+
+def false_positive_rate(bits: int, entries: int, hashes: int) -> float:
+    return (1 - math.exp(-hashes * entries / bits)) ** hashes
+
+
+def _indexes(prefix: bytes, bits: int, hashes: int) -> list[int]:
+    # Double hashing: the k indexes are h1 + i * h2 (mod 2^64, then mod the
+    # number of bits), both halves being taken from the SHA-1 itself
+    h1 = int.from_bytes(prefix[:8], 'big')
+    h2 = int.from_bytes(prefix[8:16], 'big')
+    return [((h1 + i * h2) & _MASK64) % bits for i in range(hashes)]
+
+
+def _open_input(path: str):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+
+def count_lines(path: str) -> int:
+    count = 0
+    with _open_input(path) as f:
+        while chunk := f.read(1 << 24):
+            count += chunk.count(b'\n')
+            last = chunk
+    # A last line without a line feed
+    if count and not last.endswith(b'\n'):
+        count += 1
+    return count
+
+
+def _prefixes(path: str, format: str, batch_size: int):
+    # Yields the SHA-1 prefixes of the entries, by batches, concatenated.
+    # 'sha1' lines start with the hexadecimal SHA-1 (Have I Been Pwned's
+    # "HASH:COUNT" lists), 'plain' lines are passwords.
+    with _open_input(path) as f:
+        tail = b''
+        while True:
+            chunk = f.read(batch_size * 48)
+            lines = (tail + chunk).split(b'\n')
+            tail = lines.pop() if chunk else b''
+            if format == 'plain':
+                yield b''.join(hashlib.sha1(line.rstrip(b'\r')).digest()[:PREFIX_SIZE]
+                               for line in lines if line)
+            else:
+                try:
+                    yield binascii.a2b_hex(b''.join(
+                        [line[:PREFIX_SIZE * 2] for line in lines if line]))
+                except binascii.Error:
+                    raise ValueError(f'{path} is not a list of SHA-1 hashes')
+            if not chunk:
+                break
+
+
+def _add_numpy(bits_view, prefixes: bytes, bits: int, hashes: int) -> None:
+    import numpy as np
+
+    halves = np.frombuffer(prefixes, dtype='>u8').reshape(-1, 2).astype(np.uint64)
+    h1, h2 = halves[:, 0], halves[:, 1]
+    for i in range(hashes):
+        # uint64 arithmetic wraps around like _indexes() does
+        indexes = (h1 + np.uint64(i) * h2) % np.uint64(bits)
+        masks = np.left_shift(1, indexes & np.uint64(7)).astype(np.uint8)
+        np.bitwise_or.at(bits_view, indexes >> np.uint64(3), masks)
+
+
+def _add_python(bits_view, prefixes: bytes, bits: int, hashes: int) -> None:
+    for start in range(0, len(prefixes), PREFIX_SIZE):
+        for index in _indexes(prefixes[start:start + PREFIX_SIZE], bits, hashes):
+            bits_view[index >> 3] |= 1 << (index & 7)
+
+
+def _fill(mm, input: str, format: str, batch_size: int, bits: int,
+          hashes: int, progress=None, entries: int = None) -> int:
+    if importlib.util.find_spec('numpy') is not None:
+        import numpy as np
+        bits_view, add = np.frombuffer(mm, dtype=np.uint8,
+                                       offset=HEADER.size), _add_numpy
+    else:
+        bits_view, add = memoryview(mm)[HEADER.size:], _add_python
+
+    added = 0
+    try:
+        for prefixes in _prefixes(input, format, batch_size):
+            if not prefixes:
+                continue
+            add(bits_view, prefixes, bits, hashes)
+            added += len(prefixes) // PREFIX_SIZE
+            if progress:
+                progress(added, entries)
+    finally:
+        # The mapping can't be closed while it's exported
+        if isinstance(bits_view, memoryview):
+            bits_view.release()
+        del bits_view
+    return added
+
+
+def build(input: str, output: str, fp_rate: float = 0.001,
+          entries: int = None, format: str = 'sha1',
+          batch_size: int = 1000000, progress=None) -> dict:
+    # Builds the filter in a temporary file mapped in memory, which then
+    # replaces `output`: the processes which mapped the previous filter keep
+    # reading it until they reopen the file
+    if entries is None:
+        entries = count_lines(input)
+    bits, hashes = parameters(entries, fp_rate)
+    size = HEADER.size + (bits + 7) // 8
+
+    tmp = f'{output}.tmp'
+    try:
+        with open(tmp, 'w+b') as f:
+            f.truncate(size)
+            with mmap.mmap(f.fileno(), size) as mm:
+                added = _fill(mm, input, format, batch_size, bits, hashes,
+                              progress, entries)
+                HEADER.pack_into(mm, 0, MAGIC, bits, added, hashes)
+                mm.flush()
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    os.replace(tmp, output)
+
+    return {
+        'entries': added,
+        'bits': bits,
+        'hashes': hashes,
+        'size': size,
+        'fp_rate': false_positive_rate(bits, max(1, added), hashes),
+    }
+
+
+class BreachedPasswords:
+    # Bloom filter of the SHA-1 of breached passwords. The file is mapped
+    # read-only: its pages are shared by all the processes through the page
+    # cache, and only the bytes probed by the lookups are ever read.
+    def __init__(self, path: str = None) -> None:
+        self.path = path
+        self._map = None
+        self._lock = threading.Lock()
+        self.bits = self.entries = self.hashes = 0
+
+    def init_app(self, app) -> None:
+        path = app.config.setdefault('BREACHED_PASSWORDS_FILE', None)
+        if path and not os.path.exists(path):
+            app.logger.error("%s doesn't exist, passwords aren't screened", path)
+            path = None
+        self.path = path
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def open(self) -> None:
+        if self._map is not None or not self.path:
+            return
+        with self._lock:
+            if self._map is not None:
+                return
+            with open(self.path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, self.bits, self.entries, self.hashes = HEADER.unpack_from(mm)
+            if magic != MAGIC:
+                mm.close()
+                raise ValueError(f'{self.path} is not a breached passwords filter')
+            # Lookups probe a few scattered bytes, reading ahead is wasted
+            if hasattr(mmap, 'MADV_RANDOM'):
+                mm.madvise(mmap.MADV_RANDOM)
+            self._map = mm
+
+    def __contains__(self, password: str) -> bool:
+        if not self.path:
+            return False
+        self.open()
+
+        mm = self._map
+        prefix = hashlib.sha1(password.encode('utf-8')).digest()
+        for index in _indexes(prefix, self.bits, self.hashes):
+            if not mm[HEADER.size + (index >> 3)] & (1 << (index & 7)):
+                return False
+        return True
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+breached_passwords = BreachedPasswords()
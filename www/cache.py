@@ -0,0 +1,218 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+
+class NullCache:
+    def get(self, key: str):
+        return None
+
+    def set(self, key: str, value, ttl: int = None) -> None:
+        pass
+
+    def delete(self, key: str) -> None:
+        pass
+
+    def incr(self, key: str, delta: int = 1, ttl: int = None) -> int:
+        return 0
+
+
+class MemoryCache:
+    # In-process LRU, entries expire after their TTL
+    def __init__(self, max_entries: int = 1024) -> None:
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        # Counters are kept apart so that they are never evicted
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+
+            expires_at, value = item
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                return None
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value, ttl: int = None) -> None:
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key: str, delta: int = 1, ttl: int = None) -> int:
+        # In-process counters are only namespace versions, they never expire
+        with self._lock:
+            value = self._counters.get(key, 0) + delta
+            self._counters[key] = value
+            return value
+
+
+class SQLiteCache:
+    # Shared by every process using the same file
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+        self._sets = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache ("
+                         "key TEXT PRIMARY KEY, value BLOB, expires_at REAL)")
+        # A connection must not be used by two processes: forked ones open
+        # their own. Inherited ones are kept, closing them could affect the
+        # parent's locks.
+        self._inherited = []
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._forget_connections)
+
+    def _forget_connections(self) -> None:
+        self._inherited.append(self._local)
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str):
+        row = self._connect().execute(
+            "SELECT value FROM cache WHERE key = ? "
+            "AND (expires_at IS NULL OR expires_at >= ?)",
+            (key, time.time())).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def set(self, key: str, value, ttl: int = None) -> None:
+        conn = self._connect()
+        conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                     (key, pickle.dumps(value), time.time() + ttl if ttl else None))
+
+        self._purge_expired(conn)
+
+    def _purge_expired(self, conn: sqlite3.Connection) -> None:
+        # Expired entries are only purged from time to time
+        self._sets += 1
+        if self._sets % 100 == 0:
+            conn.execute("DELETE FROM cache WHERE expires_at < ?",
+                         (time.time(), ))
+
+    def delete(self, key: str) -> None:
+        self._connect().execute("DELETE FROM cache WHERE key = ?", (key, ))
+
+    def incr(self, key: str, delta: int = 1, ttl: int = None) -> int:
+        # Counters are stored as plain integers, not pickled. Their TTL
+        # starts with their first increment.
+        conn = self._connect()
+        if not delta:
+            row = conn.execute("SELECT value FROM cache WHERE key = ?",
+                               (key, )).fetchone()
+            return row[0] if row else 0
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT INTO cache VALUES (?, ?, ?) ON CONFLICT(key) "
+                         "DO UPDATE SET value = value + excluded.value",
+                         (key, delta, time.time() + ttl if ttl else None))
+            value = conn.execute("SELECT value FROM cache WHERE key = ?",
+                                 (key, )).fetchone()[0]
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+        if ttl:
+            self._purge_expired(conn)
+        return value
+
+
+class RedisCache:
+    def __init__(self, url: str) -> None:
+        # Optional dependency, only required when CACHE_URL is redis://
+        import redis
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key: str):
+        value = self._client.get(key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key: str, value, ttl: int = None) -> None:
+        self._client.set(key, pickle.dumps(value), ex=ttl)
+
+    def delete(self, key: str) -> None:
+        self._client.delete(key)
+
+    def incr(self, key: str, delta: int = 1, ttl: int = None) -> int:
+        value = self._client.incrby(key, delta)
+        if ttl and value == delta:
+            self._client.expire(key, ttl)
+        return value
+
+
+def create_backend(url: str, max_entries: int = 1024):
+    scheme = urlparse(url).scheme
+    if scheme == 'memory':
+        return MemoryCache(max_entries)
+    elif scheme == 'sqlite':
+        return SQLiteCache(url[len('sqlite:///'):])
+    elif scheme in ('redis', 'rediss', 'unix'):
+        return RedisCache(url)
+    elif scheme == 'null':
+        return NullCache()
+    raise ValueError(f"Unsupported cache URL '{url}'")
+
+
+class Cache:
+    def __init__(self) -> None:
+        self.backend = MemoryCache()
+        self.default_ttl = 60
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app) -> None:
+        self.default_ttl = app.config.setdefault('CACHE_TTL', 60)
+        self.backend = create_backend(
+            app.config.setdefault('CACHE_URL', 'memory://'),
+            app.config.setdefault('CACHE_MAX_ENTRIES', 1024))
+
+    def key(self, namespace: str, *parts) -> str:
+        # Keys embed the namespace version, so bump() invalidates them all
+        version = self.backend.incr(f'{namespace}:version', 0)
+        return ':'.join([namespace, str(version), *map(str, parts)])
+
+    def bump(self, namespace: str) -> None:
+        self.backend.incr(f'{namespace}:version')
+
+    def get_or_set(self, key: str, fn, ttl: int = None):
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        value = fn()
+        self.backend.set(key, value, ttl or self.default_ttl)
+        return value
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+cache = Cache()
@@ -0,0 +1,238 @@
+import csv
+import json
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from www.mailer import mailer
+from www.models import db, User, DailyUserActivity
+from www.hashing import hasher
+from www import migrations, retention, assets
+from www.replica import replica, sync
+from www import breached
+
+
+stats_cli = AppGroup('stats', help='Dashboard statistics maintenance.')
+users_cli = AppGroup('users', help='User accounts maintenance.')
+mail_cli = AppGroup('mail', help='Email outbox.')
+sessions_cli = AppGroup('sessions', help='User sessions retention.')
+assets_cli = AppGroup('assets', help='Templates and static files.')
+db_cli = AppGroup('db', help='Database schema.')
+passwords_cli = AppGroup('passwords', help='Breached passwords screening.')
+
+
+@stats_cli.command('backfill')
+def backfill():
+    """Rebuild the daily activity rollup from the user sessions."""
+    db.create_all()
+    with db.engine.begin() as conn:
+        DailyUserActivity.Rebuild(conn)
+    click.echo('Daily activity rollup rebuilt.')
+
+
+@users_cli.command('check')
+@click.option('--repair', is_flag=True,
+              help='Recompute the mismatching counters from the sessions.')
+def check(repair: bool):
+    """Check users' signin_count/last_signin_at against their sessions."""
+    rows = User.FindInconsistentCounters()
+    for id, count, last_signin_at, actual_count, actual_last_signin_at in rows:
+        click.echo(f'User {id}: signin_count={count} (expected {actual_count}), '
+                   f'last_signin_at={last_signin_at} (expected {actual_last_signin_at})')
+
+    if not rows:
+        click.echo('All user counters are consistent.')
+    elif repair:
+        User.RepairCounters([row[0] for row in rows])
+        click.echo(f'{len(rows)} user(s) repaired.')
+
+
+def _file_format(file, format: str) -> str:
+    if format:
+        return format
+    return 'csv' if file.name.endswith('.csv') else 'jsonl'
+
+
+def _read_records(file, format: str):
+    if format == 'csv':
+        rows = csv.DictReader(file)
+    else:
+        rows = (json.loads(line) for line in file if line.strip())
+
+    for row in rows:
+        activated = row.get('activated')
+        if isinstance(activated, str):
+            activated = activated.strip().lower() in ('1', 'true', 'yes')
+        yield {
+            'email': (row.get('email') or '').strip(),
+            'password': row.get('password') or '',
+            'nickname': row.get('nickname'),
+            'activated': bool(activated),
+        }
+
+
+@users_cli.command('import')
+@click.argument('input', type=click.File('r'))
+@click.option('--format', type=click.Choice(['csv', 'jsonl']),
+              help='Defaults to the file extension, or jsonl.')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Users inserted per transaction.')
+@click.option('--hash-workers', type=int,
+              help='Processes hashing the passwords (default: HASH_POOL_SIZE).')
+def import_users(input, format: str, batch_size: int, hash_workers: int):
+    """Import users from a CSV/JSONL file of email,password[,nickname,activated]."""
+    if hash_workers is not None:
+        hasher.pool_size = hash_workers
+
+    records = _read_records(input, _file_format(input, format))
+    created = skipped = 0
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            break
+
+        valid = [r for r in batch if '@' in r['email'] and r['password']]
+        count = User.BulkCreate(valid) if valid else 0
+        created += count
+        skipped += len(batch) - count
+        click.echo(f'{created} user(s) imported, {skipped} skipped', err=True)
+
+    hasher.shutdown()
+
+
+@users_cli.command('export')
+@click.argument('output', type=click.File('w'))
+@click.option('--format', type=click.Choice(['csv', 'jsonl']),
+              help='Defaults to the file extension, or jsonl.')
+def export_users(output, format: str):
+    """Export the users (without their passwords) to a CSV/JSONL file."""
+    format = _file_format(output, format)
+    columns = ['id', 'email', 'nickname', 'created_at', 'activated_at',
+               'signin_count', 'last_signin_at']
+
+    writer = csv.writer(output) if format == 'csv' else None
+    if writer:
+        writer.writerow(columns)
+
+    count = 0
+    for row in User.IterExport():
+        values = [v.isoformat() if hasattr(v, 'isoformat') else v for v in row]
+        if writer:
+            writer.writerow(values)
+        else:
+            output.write(json.dumps(dict(zip(columns, values))) + '\n')
+        count += 1
+    click.echo(f'{count} user(s) exported', err=True)
+
+
+@sessions_cli.command('compact')
+@click.option('--retention-days', type=int,
+              help='Sessions kept in the database (default: SESSION_RETENTION_DAYS).')
+@click.option('--archive-dir', type=click.Path(file_okay=False),
+              help='Default: SESSION_ARCHIVE_DIR.')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Sessions deleted per transaction.')
+@click.option('--pause', default=0.05, show_default=True,
+              help='Seconds to wait between two deletes.')
+def compact(retention_days: int, archive_dir: str, batch_size: int,
+            pause: float):
+    """Archive the sessions older than the retention window then delete them."""
+    if retention_days is None:
+        retention_days = current_app.config['SESSION_RETENTION_DAYS']
+    before = datetime.utcnow().date() - timedelta(days=retention_days)
+
+    days = total = 0
+    for day, count in retention.compact_sessions(
+            before, archive_dir or current_app.config['SESSION_ARCHIVE_DIR'],
+            batch_size, pause):
+        click.echo(f'{day}: {count} session(s) archived')
+        days += 1
+        total += count
+    click.echo(f'{total} session(s) of {days} day(s) compacted.')
+
+
+@assets_cli.command('build')
+def build_assets():
+    """Compile the templates and pre-compress the static files."""
+    count = assets.compile_templates(current_app)
+    click.echo(f'{count} template(s) compiled.')
+    for path in assets.compress_static(current_app.static_folder):
+        click.echo(f'Wrote {path}')
+
+
+@mail_cli.command('worker')
+@click.option('--once', is_flag=True, help='Drain the outbox then exit.')
+@click.option('--poll-interval', default=1.0, show_default=True,
+              help='Seconds to wait when the outbox is empty.')
+def worker(once: bool, poll_interval: float):
+    """Send the queued emails over pooled SMTP connections."""
+    if once:
+        while mailer.send_pending():
+            pass
+        mailer.pool.close()
+    else:
+        mailer.run_worker(current_app._get_current_object(), poll_interval)
+
+
+@db_cli.command('upgrade')
+def upgrade():
+    """Create the missing tables and apply the pending migrations."""
+    for id in migrations.upgrade():
+        click.echo(f'Applied {id}')
+    click.echo('Database is up to date.')
+
+
+@db_cli.command('sync-replica')
+@click.option('--interval', type=float,
+              help='Seconds between two syncs (default: sync once).')
+def sync_replica(interval: float):
+    """Copy a SQLite primary into the replica and write the lag heartbeat."""
+    if not replica.enabled:
+        raise click.UsageError('DATABASE_REPLICA_URL is not set.')
+
+    while True:
+        start = time.monotonic()
+        done = sync(db.engine)
+        elapsed = time.monotonic() - start
+        click.echo(f'Replica synced ({done}) in {elapsed * 1000:.0f} ms', err=True)
+        if interval is None:
+            break
+        time.sleep(max(0.0, interval - elapsed))
+
+
+@passwords_cli.command('build')
+@click.argument('input', type=click.Path(exists=True, dir_okay=False))
+@click.argument('output', type=click.Path(dir_okay=False))
+@click.option('--format', type=click.Choice(['sha1', 'plain']), default='sha1',
+              show_default=True,
+              help='Lines starting with a hexadecimal SHA-1, or passwords.')
+@click.option('--fp-rate', default=0.001, show_default=True,
+              help='False positive rate of the filter.')
+@click.option('--entries', type=int,
+              help='Number of entries (default: the lines of INPUT).')
+def build_passwords_filter(input: str, output: str, format: str,
+                           fp_rate: float, entries: int):
+    """Build the Bloom filter of the breached passwords listed in INPUT."""
+    def progress(added: int, total: int) -> None:
+        click.echo(f'{added}/{total} entries', err=True)
+
+    try:
+        stats = breached.build(input, output, fp_rate, entries, format,
+                               progress=progress)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"{stats['entries']} entries, {stats['size'] / 2 ** 20:.1f} MiB, "
+               f"{stats['hashes']} hashes, false positive rate "
+               f"{stats['fp_rate']:.2e}: wrote {output}")
+
+
+def init_app(app) -> None:
+    app.cli.add_command(stats_cli)
+    app.cli.add_command(users_cli)
+    app.cli.add_command(mail_cli)
+    app.cli.add_command(sessions_cli)
+    app.cli.add_command(assets_cli)
+    app.cli.add_command(db_cli)
+    app.cli.add_command(passwords_cli)
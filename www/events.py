@@ -0,0 +1,141 @@
+import asyncio
+import json
+import os
+import queue
+import secrets
+import threading
+from collections import deque
+from datetime import datetime
+from www import aio
+
+
+class Subscriber:
+    def __init__(self, queue_size: int) -> None:
+        self.queue = queue.Queue(queue_size)
+        # Set when the subscriber fell too far behind: events were dropped
+        self.overflowed = False
+
+    def get(self, timeout: float) -> list[tuple]:
+        # Waits for an event, then takes the ones already queued along
+        try:
+            events = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                events.append(self.queue.get_nowait())
+            except queue.Empty:
+                return events
+
+    def put(self, event: tuple) -> None:
+        # Called by the publishers with the broker's lock held
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+
+class AsyncSubscriber(Subscriber):
+    # Stream served on the event loop of www.asgi: it waits for the events
+    # without holding a thread, the publishers hand them over to the loop
+    def __init__(self, queue_size: int) -> None:
+        self.queue = asyncio.Queue(queue_size)
+        self.overflowed = False
+        self._loop = asyncio.get_running_loop()
+
+    def get(self, timeout: float) -> list[tuple]:
+        try:
+            events = [aio.wait(asyncio.wait_for(self.queue.get(), timeout))]
+        except asyncio.TimeoutError:
+            return []
+        while True:
+            try:
+                events.append(self.queue.get_nowait())
+            except asyncio.QueueEmpty:
+                return events
+
+    def put(self, event: tuple) -> None:
+        # Queued by the loop in the order of the calls
+        self._loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event: tuple) -> None:
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+
+class Broker:
+    # In-process fan-out of the dashboard deltas to the connected streams.
+    # Publishing costs one put per subscriber, the last `backlog` events are
+    # kept for the streams which reconnect with a Last-Event-ID.
+    def __init__(self, backlog: int = 256, queue_size: int = 1000) -> None:
+        self.queue_size = queue_size
+        self._backlog = deque(maxlen=backlog)
+        self._subscribers = set()
+        self._reset()
+        # Event ids of a forked process must not follow those of its parent
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self) -> None:
+        self._lock = threading.Lock()
+        self._prefix = secrets.token_hex(4)
+        self._next = 1
+        self._backlog.clear()
+        self._subscribers = set()
+
+    def init_app(self, app) -> None:
+        self.queue_size = app.config.setdefault('EVENTS_QUEUE_SIZE', 1000)
+
+    def publish(self, type: str, data: dict) -> None:
+        with self._lock:
+            event = (f'{self._prefix}-{self._next}', type, data)
+            self._next += 1
+            self._backlog.append(event)
+            for subscriber in self._subscribers:
+                subscriber.put(event)
+
+    def subscribe(self, last_event_id: str = None) -> tuple[Subscriber, bool]:
+        # Returns the subscriber, and whether the events following
+        # `last_event_id` could be replayed
+        subscriber = AsyncSubscriber(self.queue_size) if aio.in_event_loop() \
+            else Subscriber(self.queue_size)
+        with self._lock:
+            replayed = last_event_id is None
+            if not replayed:
+                prefix, _, number = last_event_id.partition('-')
+                oldest = int(self._backlog[0][0].partition('-')[2]) \
+                    if self._backlog else self._next
+                if prefix == self._prefix and number.isdigit() and \
+                        int(number) + 1 >= oldest:
+                    replayed = True
+                    for event in self._backlog:
+                        if int(event[0].partition('-')[2]) > int(number):
+                            subscriber.put(event)
+            self._subscribers.add(subscriber)
+        return subscriber, replayed
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def __len__(self) -> int:
+        return len(self._subscribers)
+
+
+def _default(value):
+    # Datetimes as the dashboard displays them
+    if isinstance(value, datetime):
+        return str(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def format_event(type: str, data: dict, id: str = None) -> str:
+    lines = [f'id: {id}'] if id else []
+    lines.append(f'event: {type}')
+    lines.append(f'data: {json.dumps(data, default=_default)}')
+    return '\n'.join(lines) + '\n\n'
+
+
+broker = Broker()
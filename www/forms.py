@@ -2,30 +2,37 @@ import string
 from flask_wtf import FlaskForm
 from wtforms import EmailField, PasswordField, SubmitField, HiddenField
 from wtforms.validators import InputRequired, Length, Email, EqualTo, ValidationError
+from flask_login import current_user
 from www.models import User
+from www.breached import breached_passwords
+
+LOWERS = frozenset(string.ascii_lowercase)
+UPPERS = frozenset(string.ascii_uppercase)
+DIGITS = frozenset(string.digits)
+SPECIALS = frozenset(string.punctuation)
 
 
 def validate_password(password):
-    lowers = list(string.ascii_lowercase)
-    if not any(s in password.data for s in lowers):
+    if LOWERS.isdisjoint(password.data):
         raise ValidationError(
             'Field must contains at least one lower character.')
 
-    uppers = list(string.ascii_uppercase)
-    if not any(s in password.data for s in uppers):
+    if UPPERS.isdisjoint(password.data):
         raise ValidationError(
             'Field must contains at least one upper character.')
 
-    digits = list(string.digits)
-    if not any(s in password.data for s in digits):
+    if DIGITS.isdisjoint(password.data):
         raise ValidationError(
             'Field must contains at least one digit character.')
 
-    specials = list(string.punctuation)
-    if not any(s in password.data for s in specials):
+    if SPECIALS.isdisjoint(password.data):
         raise ValidationError(
             'Field must contains at least one special character.')
 
+    if password.data in breached_passwords:
+        raise ValidationError(
+            'This password has appeared in a data breach, please choose another one.')
+
 
 class SignupForm(FlaskForm):
     user = HiddenField()
@@ -69,7 +76,6 @@ class ProfileForm(FlaskForm):
 
 
 class ChangePasswordForm(FlaskForm):
-    email = HiddenField()
     old_pwd = PasswordField('Old password', validators=[InputRequired()])
     password = PasswordField('New password', validators=[InputRequired(),
                                                          Length(min=8, max=20),
@@ -79,8 +85,8 @@ class ChangePasswordForm(FlaskForm):
     submit = SubmitField('Change')
 
     def validate_old_pwd(self, old_pwd):
-        user = User.FindByEmail(self.email.data)
-        if not user or not user.check_password(old_pwd.data):
+        # Only displayed to the logged in user, who is already loaded
+        if not current_user.check_password(old_pwd.data):
             raise ValidationError('Incorrect password.')
 
     def validate_password(self, password):
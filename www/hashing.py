@@ -0,0 +1,72 @@
+import bcrypt
+from concurrent.futures import ProcessPoolExecutor
+from www import aio
+from www.instrumentation import timed
+
+
+# Executed in the pool processes, hence module-level functions
+def _hashpw(password: bytes, rounds: int) -> bytes:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _checkpw(password: bytes, hash: bytes) -> bool:
+    return bcrypt.checkpw(password, hash)
+
+
+def _to_bytes(value) -> bytes:
+    return value.encode('utf-8') if isinstance(value, str) else value
+
+
+class PasswordHasher:
+    def __init__(self, rounds: int = 12, pool_size: int = 0) -> None:
+        self.rounds = rounds
+        self.pool_size = pool_size
+        self._executor = None
+
+    def init_app(self, app) -> None:
+        self.rounds = app.config.setdefault('BCRYPT_ROUNDS', self.rounds)
+        self.pool_size = app.config.setdefault('HASH_POOL_SIZE', self.pool_size)
+
+    def _pool(self) -> ProcessPoolExecutor:
+        # Lazily started, processes which never hash don't fork it
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.pool_size)
+        return self._executor
+
+    def _run(self, fn, *args):
+        with timed('bcrypt'):
+            # On the event loop of www.asgi, the hash is awaited
+            if not self.pool_size:
+                return aio.call_in_thread(fn, *args)
+            return aio.result(self._pool().submit(fn, *args))
+
+    def hash(self, password: str) -> bytes:
+        return self._run(_hashpw, password.encode('utf-8'), self.rounds)
+
+    def hash_many(self, passwords: list[str]) -> list[bytes]:
+        passwords = [p.encode('utf-8') for p in passwords]
+        if not self.pool_size:
+            return [_hashpw(p, self.rounds) for p in passwords]
+
+        chunksize = max(1, len(passwords) // (self.pool_size * 4))
+        return list(self._pool().map(_hashpw, passwords,
+                                     [self.rounds] * len(passwords),
+                                     chunksize=chunksize))
+
+    def check(self, password: str, hash) -> bool:
+        return self._run(_checkpw, password.encode('utf-8'), _to_bytes(hash))
+
+    def needs_rehash(self, hash) -> bool:
+        # bcrypt hashes look like b'$2b$12$<salt><checksum>'
+        try:
+            return int(_to_bytes(hash).split(b'$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,86 @@
+import os
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from www import aio
+
+
+class AsyncHTTP:
+    # httpx client sending, on the event loop of www.asgi, the requests made
+    # through http_adapter: the provider calls of Flask-Dance and ours
+    def __init__(self, pool_size: int) -> None:
+        self.pool_size = pool_size
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            import httpx
+            # Like requests, more connections are opened when they're all
+            # busy, `pool_size` of them are kept alive
+            self._client = httpx.AsyncClient(limits=httpx.Limits(
+                max_connections=None, max_keepalive_connections=self.pool_size))
+        return self._client
+
+    async def send(self, request: requests.PreparedRequest,
+                   timeout) -> requests.Response:
+        import httpx
+
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        try:
+            resp = await self._get_client().request(
+                request.method, request.url, headers=dict(request.headers),
+                content=request.body, timeout=timeout)
+        except httpx.TimeoutException as e:
+            raise requests.Timeout(e, request=request)
+        except httpx.HTTPError as e:
+            raise requests.ConnectionError(e, request=request)
+
+        response = requests.Response()
+        response.status_code = resp.status_code
+        response.reason = resp.reason_phrase
+        response.headers = CaseInsensitiveDict(resp.headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = resp.content
+        response.url = request.url
+        response.request = request
+        return response
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    # requests has no session-wide timeout
+    def __init__(self, timeout: tuple, **kwargs) -> None:
+        self.timeout = timeout
+        self.async_http = AsyncHTTP(kwargs.get('pool_maxsize', 10))
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        if aio.in_event_loop():
+            return aio.wait(self.async_http.send(request, kwargs['timeout']))
+        return super().send(request, **kwargs)
+
+
+# Shared by every provider call, so that connections to the providers are
+# kept alive and reused across requests
+http_adapter = TimeoutHTTPAdapter(
+    timeout=(float(os.getenv('OAUTH_CONNECT_TIMEOUT', 3)),
+             float(os.getenv('OAUTH_READ_TIMEOUT', 10))),
+    pool_connections=4,
+    pool_maxsize=int(os.getenv('OAUTH_POOL_SIZE', 20)))
+
+
+def use_pooled_connections(session: requests.Session) -> requests.Session:
+    session.mount('https://', http_adapter)
+    session.mount('http://', http_adapter)
+    return session
+
+
+http = use_pooled_connections(requests.Session())
@@ -1,5 +1,7 @@
-from www import app, db
+from www import app, migrations
+from www.models import db
 
 with app.test_request_context():
     db.drop_all()
     db.create_all()
+    migrations.stamp()
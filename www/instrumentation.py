@@ -0,0 +1,247 @@
+import cProfile
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, request, has_request_context, Response
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from www.cache import cache
+from www.replica import replica
+
+# Set by init_app(), timed() is a no-op until then
+enabled = False
+
+# Upper bounds (seconds) of the request duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Metrics:
+    # Process-wide aggregates, exposed in the Prometheus text format
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.durations = {}
+        self.phases = {}
+        self.statements = {}
+        self.smtp = {'messages': 0, 'seconds': 0.0}
+
+    def observe_request(self, endpoint: str, method: str, status: int,
+                        duration: float, timings: dict,
+                        statements: int) -> None:
+        with self._lock:
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+            buckets, total, count = self.durations.get(
+                endpoint, ([0] * len(DURATION_BUCKETS), 0.0, 0))
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    buckets[i] += 1
+            self.durations[endpoint] = (buckets, total + duration, count + 1)
+
+            for phase, seconds in timings.items():
+                key = (endpoint, phase)
+                self.phases[key] = self.phases.get(key, 0.0) + seconds
+            self.statements[endpoint] = \
+                self.statements.get(endpoint, 0) + statements
+
+    def observe_smtp(self, messages: int, duration: float) -> None:
+        with self._lock:
+            self.smtp['messages'] += messages
+            self.smtp['seconds'] += duration
+
+    def render(self) -> str:
+        lines = []
+
+        def metric(name: str, type: str, help: str) -> None:
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {type}')
+
+        with self._lock:
+            metric('http_requests_total', 'counter', 'Requests handled.')
+            for (endpoint, method, status), count in self.requests.items():
+                lines.append(f'http_requests_total{{endpoint="{endpoint}",'
+                             f'method="{method}",status="{status}"}} {count}')
+
+            metric('http_request_duration_seconds', 'histogram',
+                   'Wall time of the requests.')
+            for endpoint, (buckets, total, count) in self.durations.items():
+                for bound, value in zip(DURATION_BUCKETS, buckets):
+                    lines.append(f'http_request_duration_seconds_bucket{{'
+                                 f'endpoint="{endpoint}",le="{bound}"}} {value}')
+                lines.append(f'http_request_duration_seconds_bucket{{'
+                             f'endpoint="{endpoint}",le="+Inf"}} {count}')
+                lines.append(f'http_request_duration_seconds_sum{{'
+                             f'endpoint="{endpoint}"}} {total:.6f}')
+                lines.append(f'http_request_duration_seconds_count{{'
+                             f'endpoint="{endpoint}"}} {count}')
+
+            metric('http_request_phase_seconds_total', 'counter',
+                   'Time spent in SQL, bcrypt and template rendering.')
+            for (endpoint, phase), seconds in self.phases.items():
+                lines.append(f'http_request_phase_seconds_total{{'
+                             f'endpoint="{endpoint}",phase="{phase}"}} {seconds:.6f}')
+
+            metric('sql_statements_total', 'counter',
+                   'SQL statements executed by the requests.')
+            for endpoint, count in self.statements.items():
+                lines.append(f'sql_statements_total{{endpoint="{endpoint}"}} {count}')
+
+            metric('smtp_messages_total', 'counter', 'Emails sent or attempted.')
+            lines.append(f"smtp_messages_total {self.smtp['messages']}")
+            metric('smtp_seconds_total', 'counter', 'Time spent sending emails.')
+            lines.append(f"smtp_seconds_total {self.smtp['seconds']:.6f}")
+
+        stats = cache.stats()
+        metric('cache_requests_total', 'counter', 'Cache lookups.')
+        lines.append(f'cache_requests_total{{result="hit"}} {stats["hits"]}')
+        lines.append(f'cache_requests_total{{result="miss"}} {stats["misses"]}')
+
+        if replica.enabled:
+            lag = replica.lag()
+            metric('db_replica_lag_seconds', 'gauge',
+                   'Lag of the replica, NaN when unknown.')
+            lines.append(f'db_replica_lag_seconds '
+                         f'{lag if lag is not None else "NaN"}')
+            metric('db_read_only_statements_total', 'counter',
+                   'Statements of the read-only blocks, by database.')
+            for target, count in replica.reads.items():
+                lines.append(f'db_read_only_statements_total{{'
+                             f'database="{target}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def _add_timing(name: str, seconds: float) -> None:
+    timings = g.setdefault('timings', {})
+    timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def timed(name: str):
+    # Adds the time spent in the block to the current request's `name` phase
+    if not enabled or not has_request_context():
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add_timing(name, time.perf_counter() - start)
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = conn.info['query_start'].pop()
+    if has_request_context():
+        _add_timing('sql', time.perf_counter() - start)
+        g.statement_count = g.get('statement_count', 0) + 1
+
+
+def _before_render(app, template, context, **extra):
+    g.setdefault('template_start', []).append(time.perf_counter())
+
+
+def _rendered(app, template, context, **extra):
+    _add_timing('template', time.perf_counter() - g.template_start.pop())
+
+
+def _server_timing(duration: float, timings: dict, statements: int) -> str:
+    parts = [f'app;dur={duration * 1000:.1f}']
+    for name, seconds in timings.items():
+        desc = f';desc="{statements} statements"' if name == 'sql' else ''
+        parts.append(f'{name};dur={seconds * 1000:.1f}{desc}')
+    return ', '.join(parts)
+
+
+def _listen(target, identifier: str, fn) -> None:
+    # The listeners are process-wide, whatever the number of applications
+    if not event.contains(target, identifier, fn):
+        event.listen(target, identifier, fn)
+
+
+def init_app(app) -> None:
+    global enabled
+
+    # Exposes per-request debug data as X-* response headers
+    if app.config.setdefault('DEBUG_HEADERS', app.debug):
+        _listen(Engine, "before_cursor_execute", _count_query)
+
+        @app.after_request
+        def add_debug_headers(response):
+            response.headers['X-Query-Count'] = str(g.get('query_count', 0))
+            # Process-wide counters
+            response.headers['X-Cache-Stats'] = 'hits=%(hits)d; misses=%(misses)d' \
+                % cache.stats()
+            return response
+
+    sample_rate = app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+    if sample_rate:
+        profile_dir = app.config.setdefault('PROFILE_DIR', 'profiles')
+        os.makedirs(profile_dir, exist_ok=True)
+
+        @app.before_request
+        def start_profiler():
+            if random.random() < sample_rate:
+                g.profiler = cProfile.Profile()
+                g.profiler.enable()
+
+        @app.after_request
+        def dump_profile(response):
+            profiler = g.pop('profiler', None)
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(profile_dir, '%s-%d-%d.prof' % (
+                    request.endpoint or 'unknown', time.time() * 1000, os.getpid())))
+            return response
+
+    # Timings, Server-Timing headers and /metrics
+    if not app.config.setdefault('INSTRUMENTATION', False):
+        return
+    enabled = True
+
+    _listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    _listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.get('request_start')
+        if start is None:
+            return response
+
+        duration = time.perf_counter() - start
+        timings = g.get('timings', {})
+        statements = g.get('statement_count', 0)
+        metrics.observe_request(request.endpoint or 'unknown', request.method,
+                                response.status_code, duration, timings,
+                                statements)
+        response.headers['Server-Timing'] = _server_timing(
+            duration, timings, statements)
+        return response
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        return Response(metrics.render(),
+                        content_type='text/plain; version=0.0.4')
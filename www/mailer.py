@@ -1,54 +1,360 @@
-from smtplib import SMTP_SSL
+from smtplib import SMTP, SMTP_SSL, SMTPException, SMTPRecipientsRefused, \
+    SMTPSenderRefused, SMTPDataError
+import asyncio
 import ssl
+import queue
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from flask import render_template, url_for
-from www.models import User
+from www import aio
+from www.models import db, User, OutboxEmail
+from www.instrumentation import metrics
 
 
-class Mailer:
-    def __init__(self, host: str, port: int, password: str, sender: str, logger) -> None:
+class Rejected(Exception):
+    # A message refused by the server, whose connection is still usable.
+    # 5xx replies are permanent, the message is not sent again.
+    def __init__(self, error: Exception, code: int) -> None:
+        super().__init__(str(error))
+        self.code = code
+        self.permanent = 500 <= code < 600
+
+
+def _reply_code(error: Exception) -> int:
+    # Reply to a refused message, from smtplib or aiosmtplib
+    recipients = getattr(error, 'recipients', None)
+    if isinstance(recipients, dict):
+        return min(code for code, _ in recipients.values())
+    if recipients:
+        return min(recipient.code for recipient in recipients)
+    return getattr(error, 'smtp_code', None) or getattr(error, 'code', 0)
+
+
+class SMTPPool:
+    def __init__(self, host: str, port: int, password: str, sender: str,
+                 use_ssl: bool = True, size: int = 2, timeout: int = 30) -> None:
         self.host = host
         self.port = port
         self.password = password
         self.sender = sender
-        self.logger = logger
+        self.use_ssl = use_ssl
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+
+    def _connect(self) -> SMTP:
+        if self.use_ssl:
+            ctx = ssl.create_default_context()
+            server = SMTP_SSL(self.host, port=self.port, context=ctx,
+                              timeout=self.timeout)
+        else:
+            server = SMTP(self.host, port=self.port, timeout=self.timeout)
+
+        # A local debugging server doesn't need (nor support) AUTH
+        if self.password:
+            server.login(self.sender, self.password)
+        return server
+
+    def _acquire(self) -> SMTP:
+        while True:
+            try:
+                server = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+
+            # The server may have dropped the connection while it was idle
+            try:
+                if server.noop()[0] == 250:
+                    return server
+            except (SMTPException, OSError):
+                pass
+            self._quit(server)
+
+    @staticmethod
+    def _quit(server: SMTP) -> None:
+        try:
+            server.quit()
+        except (SMTPException, OSError):
+            server.close()
+
+    @contextmanager
+    def connection(self):
+        server = self._acquire()
+        try:
+            yield server
+        except Exception:
+            self._quit(server)
+            raise
+
+        if self._idle.qsize() < self.size:
+            self._idle.put(server)
+        else:
+            self._quit(server)
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._quit(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+class AsyncSMTPPool(SMTPPool):
+    # Same pool with aiosmtplib connections, for the outbox worker running
+    # on the event loop of www.asgi
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._idle = []
+
+    async def _connect(self):
+        import aiosmtplib
+
+        server = aiosmtplib.SMTP(hostname=self.host, port=self.port,
+                                 use_tls=self.use_ssl, start_tls=False,
+                                 timeout=self.timeout)
+        await server.connect()
+        if self.password:
+            await server.login(self.sender, self.password)
+        return server
+
+    async def _acquire(self):
+        import aiosmtplib
+
+        while self._idle:
+            server = self._idle.pop()
+            try:
+                if (await server.noop())[0] == 250:
+                    return server
+            except (aiosmtplib.SMTPException, OSError):
+                pass
+            await self._quit(server)
+        return await self._connect()
+
+    @staticmethod
+    async def _quit(server) -> None:
+        import aiosmtplib
+
+        try:
+            await server.quit()
+        except (aiosmtplib.SMTPException, OSError):
+            server.close()
+
+    @asynccontextmanager
+    async def connection(self):
+        server = await self._acquire()
+        try:
+            yield server
+        except Exception:
+            await self._quit(server)
+            raise
+
+        if len(self._idle) < self.size:
+            self._idle.append(server)
+        else:
+            await self._quit(server)
+
+    async def close(self) -> None:
+        while self._idle:
+            await self._quit(self._idle.pop())
+
+
+class Mailer:
+    def __init__(self) -> None:
+        self.sender = None
+        self.logger = None
+        self.batch_size = 50
+        self.max_attempts = 5
+        self.retry_delay = 30
+        self.lease = 300
+        self.pool = None
+        self.async_pool = None
+        self._executor = None
+        self._worker = None
+        self._stop = threading.Event()
+
+    def init_app(self, app) -> None:
+        self.sender = app.config.setdefault('MAIL_SENDER', 'my@example.com')
+        self.logger = app.logger
+        self.batch_size = app.config.setdefault('MAIL_BATCH_SIZE', 50)
+        self.max_attempts = app.config.setdefault('MAIL_MAX_ATTEMPTS', 5)
+        self.retry_delay = app.config.setdefault('MAIL_RETRY_DELAY', 30)
+        self.lease = app.config.setdefault('MAIL_LEASE', 300)
+        # No connection is opened until the first email is sent
+        args = (app.config.setdefault('MAIL_HOST', 'smtp.gmail.com'),
+                app.config.setdefault('MAIL_PORT', 465),
+                app.config.setdefault('MAIL_PASSWORD', None),
+                self.sender)
+        kwargs = {'use_ssl': app.config.setdefault('MAIL_USE_SSL', True),
+                  'size': app.config.setdefault('MAIL_POOL_SIZE', 2)}
+        self.pool = SMTPPool(*args, **kwargs)
+        self.async_pool = AsyncSMTPPool(*args, **kwargs)
+
+        if app.config.setdefault('MAIL_WORKER', 'thread') == 'thread':
+            app.before_first_request(lambda: self.start_worker(app))
+
+    def _sender_pool(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.pool.size,
+                                                thread_name_prefix='smtp')
+        return self._executor
 
     def send_verification(self, user: User) -> bool:
-        self.logger.info("send email to <%s>" % user.email)
+        self.logger.info("queue email to <%s>" % user.email)
 
-        message = MIMEMultipart("alternative")
-        message["Subject"] = "Email address verification"
-        message["From"] = self.sender
-        message["To"] = user.email
+        # Only the hash of the key is stored: unless it was just issued (on
+        # signup), the email comes with a new key
+        key = user.issued_activation_key or user.new_activation_key()
+        user.issued_activation_key = None
 
         nickname = user.nickname
-        activate_url = url_for("activate", email=user.email,
-                               key=user.activation_key, _external=True)
+        activate_url = url_for("activate", email=user.email, key=key,
+                               _external=True)
 
         text = render_template(
             'email.txt', nickname=nickname, activate_url=activate_url)
         html = render_template(
             'email.html', nickname=nickname, activate_url=activate_url)
 
+        # The email is actually sent by the outbox worker
+        OutboxEmail.Enqueue(user.email, "Email address verification",
+                            text, html)
+        return True
+
+    def build_message(self, email: OutboxEmail) -> str:
+        message = MIMEMultipart("alternative")
+        message["Subject"] = email.subject
+        message["From"] = self.sender
+        message["To"] = email.recipient
+
         # Turn these into plain/html MIMEText objects
-        part1 = MIMEText(text, "plain")
-        part2 = MIMEText(html, "html")
+        part1 = MIMEText(email.text, "plain")
+        part2 = MIMEText(email.html, "html")
 
         # Add HTML/plain-text parts to MIMEMultipart message
         # The email client will try to render the last part first
         message.attach(part1)
         message.attach(part2)
+        return message.as_string()
 
-        # Create connection with server and send email
+    def _send_chunk(self, messages: list[tuple]) -> dict:
+        # Runs on the SMTP executor: no database access in here
+        results = {}
         try:
-            ctx = ssl.create_default_context()
-            with SMTP_SSL(self.host, port=self.port, context=ctx) as server:
-                server.login(self.sender, self.password)
-                server.sendmail(
-                    self.sender, user.email, message.as_string()
-                )
-                return True
-        except Exception as e:
-            self.logger.error(e)
-            return False
+            with self.pool.connection() as server:
+                for id, recipient, message in messages:
+                    try:
+                        server.sendmail(self.sender, recipient, message)
+                        results[id] = None
+                    except (SMTPRecipientsRefused, SMTPSenderRefused,
+                            SMTPDataError) as e:
+                        # Rejected message, the connection is still usable
+                        results[id] = Rejected(e, _reply_code(e))
+        except (SMTPException, OSError) as e:
+            for id, _, _ in messages:
+                results.setdefault(id, e)
+        return results
+
+    async def _send_chunk_async(self, messages: list[tuple]) -> dict:
+        import aiosmtplib
+
+        results = {}
+        try:
+            async with self.async_pool.connection() as server:
+                for id, recipient, message in messages:
+                    try:
+                        await server.sendmail(self.sender, recipient, message)
+                        results[id] = None
+                    except (aiosmtplib.SMTPRecipientsRefused,
+                            aiosmtplib.SMTPSenderRefused,
+                            aiosmtplib.SMTPDataError) as e:
+                        results[id] = Rejected(e, _reply_code(e))
+        except (aiosmtplib.SMTPException, OSError) as e:
+            for id, _, _ in messages:
+                results.setdefault(id, e)
+        return results
+
+    async def _send_chunks_async(self, chunks: list[list]) -> list[dict]:
+        return await asyncio.gather(*(self._send_chunk_async(c) for c in chunks))
+
+    def send_pending(self) -> int:
+        # Sends one batch of due emails, returns the number of processed emails
+        emails = OutboxEmail.ClaimDue(self.batch_size, self.lease)
+        if not emails:
+            return 0
+
+        messages = [(e.id, e.recipient, self.build_message(e)) for e in emails]
+        chunks = [messages[i::self.pool.size] for i in range(self.pool.size)]
+
+        start = time.perf_counter()
+        results = {}
+        chunks = [c for c in chunks if c]
+        if aio.in_event_loop():
+            chunk_results = aio.wait(self._send_chunks_async(chunks))
+        else:
+            chunk_results = self._sender_pool().map(self._send_chunk, chunks)
+        for chunk_result in chunk_results:
+            results.update(chunk_result)
+        # Emails are sent by the outbox worker, not within requests
+        metrics.observe_smtp(len(messages), time.perf_counter() - start)
+
+        for email in emails:
+            error = results[email.id]
+            if error is None:
+                self.logger.info("email sent to <%s>" % email.recipient)
+                email.mark_sent()
+            else:
+                self.logger.error("failed to send email to <%s>: %s" %
+                                  (email.recipient, error))
+                email.mark_failed(error, self.max_attempts, self.retry_delay,
+                                  getattr(error, 'permanent', False))
+
+        db.session.commit()
+        return len(emails)
+
+    def _poll(self, app) -> int:
+        with app.app_context():
+            try:
+                return self.send_pending()
+            except Exception as e:
+                self.logger.error(e)
+                db.session.rollback()
+                return 0
+            finally:
+                db.session.remove()
+
+    def run_worker(self, app, poll_interval: float = 1.0) -> None:
+        while not self._stop.is_set():
+            if not self._poll(app):
+                self._stop.wait(poll_interval)
+
+        self.pool.close()
+
+    async def run_worker_async(self, app, poll_interval: float = 1.0) -> None:
+        # The same worker as a task of the event loop of www.asgi: the
+        # queries and the SMTP sessions are awaited
+        while not self._stop.is_set():
+            if not await aio.run(self._poll, app):
+                await asyncio.sleep(poll_interval)
+
+        await self.async_pool.close()
+
+    def start_worker(self, app) -> None:
+        if self._worker is not None:
+            return
+
+        self._worker = threading.Thread(target=self.run_worker, args=(app, ),
+                                        name='mailer', daemon=True)
+        self._worker.start()
+
+    def stop_worker(self) -> None:
+        self._stop.set()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+
+
+mailer = Mailer()
@@ -0,0 +1,155 @@
+from datetime import datetime
+from sqlalchemy import inspect
+from www.models import db, User, UserSession, DailyUserActivity, \
+    DailyActivity, HourlyActivity, OutboxEmail
+from www.tokens import hash_token
+
+
+schema_migration = db.Table(
+    'schema_migration',
+    db.Column('id', db.String(255), primary_key=True),
+    db.Column('applied_at', db.DateTime, nullable=False),
+)
+
+
+def _create_missing_indexes(conn, table: db.Table) -> None:
+    existing = {index['name'] for index in inspect(conn).get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(conn)
+
+
+def _user_signin_counters(conn) -> None:
+    # User.signin_count and User.last_signin_at used to be computed from
+    # user_session on every dashboard request
+    table = conn.dialect.identifier_preparer.quote(User.__tablename__)
+    columns = {c['name'] for c in inspect(conn).get_columns(User.__tablename__)}
+    if 'signin_count' not in columns:
+        conn.execute(db.text(f"ALTER TABLE {table} ADD COLUMN "
+                             "signin_count INTEGER DEFAULT 0 NOT NULL"))
+    if 'last_signin_at' not in columns:
+        conn.execute(db.text(f"ALTER TABLE {table} ADD COLUMN "
+                             "last_signin_at TIMESTAMP"))
+
+    conn.execute(db.update(User.__table__).values(
+        signin_count=db.select(db.func.count(UserSession.id))
+        .where(UserSession.user_id == User.id).scalar_subquery(),
+        last_signin_at=db.select(db.func.max(UserSession.logged_at))
+        .where(UserSession.user_id == User.id).scalar_subquery()))
+
+    _create_missing_indexes(conn, User.__table__)
+
+
+def _user_session_indexes(conn) -> None:
+    # Statistics and dashboard queries filter user_session by user/date
+    _create_missing_indexes(conn, UserSession.__table__)
+
+
+def _activity_buckets(conn) -> None:
+    # The analytics API reads signups and hourly logins from the rollups.
+    # hourly_activity itself is created by create_all().
+    columns = {c['name'] for c in inspect(conn).get_columns('daily_activity')}
+    if 'signups' not in columns:
+        conn.execute(db.text("ALTER TABLE daily_activity ADD COLUMN "
+                             "signups INTEGER DEFAULT 0 NOT NULL"))
+
+    day = db.func.date(UserSession.logged_at)
+    hour = db.extract('hour', UserSession.logged_at)
+    conn.execute(HourlyActivity.__table__.delete())
+    conn.execute(HourlyActivity.__table__.insert().from_select(
+        ['day', 'hour', 'login_count'],
+        db.select(day, hour, db.func.count(UserSession.id))
+        .group_by(day, hour)))
+
+    signup_day = db.func.date(User.created_at)
+    conn.execute(db.update(DailyActivity.__table__).values(
+        signups=db.select(db.func.count(User.id))
+        .where(signup_day == DailyActivity.day).scalar_subquery()))
+    conn.execute(db.update(HourlyActivity.__table__).values(
+        signups=db.select(db.func.count(User.id))
+        .where(signup_day == HourlyActivity.day,
+               db.extract('hour', User.created_at) == HourlyActivity.hour)
+        .scalar_subquery()))
+
+
+def _daily_user_last_logged_at(conn) -> None:
+    # Keeps the last sign-in of the users once their sessions are archived
+    columns = {c['name'] for c in inspect(conn).get_columns('daily_user_activity')}
+    if 'last_logged_at' not in columns:
+        conn.execute(db.text("ALTER TABLE daily_user_activity ADD COLUMN "
+                             "last_logged_at TIMESTAMP"))
+
+    conn.execute(db.update(DailyUserActivity.__table__).values(
+        last_logged_at=db.select(db.func.max(UserSession.logged_at))
+        .where(UserSession.user_id == DailyUserActivity.user_id,
+               db.func.date(UserSession.logged_at) == DailyUserActivity.day)
+        .scalar_subquery()))
+
+
+def _hashed_activation_keys(conn) -> None:
+    # Activation keys were stored in clear, users are now looked up by the
+    # hash of the key. Links already sent keep working.
+    user = User.__table__
+    keys = [{'_id': id, '_key': hash_token(key)} for id, key in conn.execute(
+        db.select(user.c.id, user.c.activation_key)
+        .where(user.c.activation_key.isnot(None)))]
+    if keys:
+        conn.execute(user.update()
+                     .where(user.c.id == db.bindparam('_id'))
+                     .values(activation_key=db.bindparam('_key')), keys)
+
+    _create_missing_indexes(conn, user)
+
+
+def _outbox_claim(conn) -> None:
+    # The emails claimed by a worker were told apart by the end of their lease
+    columns = {c['name'] for c in inspect(conn).get_columns(OutboxEmail.__tablename__)}
+    if 'claim' not in columns:
+        conn.execute(db.text("ALTER TABLE outbox_email ADD COLUMN claim VARCHAR(32)"))
+
+
+def _activity_rollups(conn) -> None:
+    # The rollups and counters created along with the previous migrations
+    # are filled from the users and their sessions (as `flask stats
+    # backfill` does), once their columns all exist
+    DailyUserActivity.Rebuild(conn)
+
+
+# Applied in order, each one in its own transaction
+MIGRATIONS = [
+    ('0001_user_signin_counters', _user_signin_counters),
+    ('0002_user_session_indexes', _user_session_indexes),
+    ('0003_activity_buckets', _activity_buckets),
+    ('0004_daily_user_last_logged_at', _daily_user_last_logged_at),
+    ('0005_hashed_activation_keys', _hashed_activation_keys),
+    ('0006_outbox_claim', _outbox_claim),
+    ('0007_activity_rollups', _activity_rollups),
+]
+
+
+def upgrade() -> list[str]:
+    # New tables are created along with their indexes
+    db.create_all()
+
+    with db.engine.connect() as conn:
+        applied = set(conn.execute(db.select(schema_migration.c.id)).scalars())
+
+    done = []
+    for id, migrate in MIGRATIONS:
+        if id in applied:
+            continue
+
+        with db.engine.begin() as conn:
+            migrate(conn)
+            conn.execute(schema_migration.insert().values(
+                id=id, applied_at=datetime.utcnow()))
+        done.append(id)
+    return done
+
+
+def stamp() -> None:
+    # Marks every migration as applied, for a database built by create_all()
+    with db.engine.begin() as conn:
+        conn.execute(schema_migration.delete())
+        conn.execute(schema_migration.insert(), [
+            {'id': id, 'applied_at': datetime.utcnow()} for id, _ in MIGRATIONS])
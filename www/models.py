@@ -1,25 +1,143 @@
-from flask_sqlalchemy import SQLAlchemy
+from flask import g, has_request_context
 from flask_login import UserMixin
-import bcrypt
-import string
-import random
-from datetime import date, timedelta
+import json
+import secrets
+import sqlite3
+from collections import namedtuple
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import date, datetime, time, timedelta
 from sqlalchemy.engine import Engine
-from sqlalchemy import event
-from sqlalchemy.orm import query_expression, with_expression
-from flask_dance.consumer.storage.sqla import OAuthConsumerMixin
-from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, make_transient_to_detached
 from sqlalchemy.orm.collections import attribute_mapped_collection
+from sqlalchemy.ext.mutable import MutableDict
+from www import aio
+from www.hashing import hasher
+from www.cache import cache
+from www.session_store import session_store
+from www.events import broker
+from www.tokens import tokens, hash_token
+from www.replica import RoutingSQLAlchemy, read_only
 
 
 @event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection) and \
+            not aio.is_aiosqlite(dbapi_connection):
+        return
+
+    # Connections are pooled, so this only runs once per pooled connection.
+    # The busy timeout is set through the `timeout` connect argument.
     cursor = dbapi_connection.cursor()
     cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
     cursor.close()
 
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+
+
+# What the dashboard displays of a user
+UserRow = namedtuple('UserRow', 'id created_at signin_count last_signin_at')
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_caches(session):
+    # Flagged by the write paths which change the dashboard figures
+    if session.info.pop('dashboard_changed', False):
+        cache.bump('dashboard')
+
+    # Users whose session snapshot is outdated
+    for user_id in session.info.pop('changed_users', ()):
+        session_store.invalidate(user_id)
+
+    # Deltas of the live dashboards. The users are expired by the commit,
+    # their identity doesn't need a query.
+    for user, signup, logged_at in session.info.pop('user_events', ()):
+        id = inspect(user).identity[0]
+        if signup:
+            # Close enough to created_at, which the database sets
+            broker.publish('signup', {'id': id, 'created_at': logged_at,
+                                      'signin_count': 1,
+                                      'last_signin_at': logged_at})
+        else:
+            broker.publish('login', {'id': id, 'logins': 1,
+                                     'last_signin_at': logged_at})
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_changes(session):
+    session.info.pop('dashboard_changed', None)
+    session.info.pop('changed_users', None)
+    session.info.pop('user_events', None)
+
+
+def _upsert(model, ident: dict, values: dict = None, **deltas) -> None:
+    # Creates the row, or bumps the counters of the existing one (and
+    # overwrites `values`), in a single INSERT ... ON CONFLICT DO UPDATE:
+    # concurrent first writes of a row don't fail on its primary key
+    values = values or {}
+    insert = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}.get(
+        db.engine.dialect.name)
+    if insert is None:
+        _increment(model, ident, values, **deltas)
+        return
+
+    table = model.__table__
+    stmt = insert(table).values(**ident, **values, **deltas)
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=list(ident),
+        set_={**{k: table.c[k] + stmt.excluded[k] for k in deltas},
+              **{k: stmt.excluded[k] for k in values}}))
+
+
+def _increment(model, ident: dict, values: dict = None, **deltas) -> bool:
+    # Bump the counters of an existing row (and overwrite `values`), or
+    # create it. Returns True when the row did not exist yet. Only used by
+    # the databases without an upsert.
+    values = values or {}
+    updated = db.session.query(model).filter_by(**ident).update(
+        {**{getattr(model, k): getattr(model, k) + v for k, v in deltas.items()},
+         **{getattr(model, k): v for k, v in values.items()}},
+        synchronize_session=False)
+    if updated:
+        return False
+    db.session.add(model(**ident, **values, **deltas))
+    return True
+
+
+def _request_users() -> dict:
+    # Users already loaded by the current request, by email. Lookups by id
+    # are served by the session's identity map.
+    if not has_request_context():
+        return {}
+    if 'users_by_email' not in g:
+        g.users_by_email = {}
+    return g.users_by_email
+
+
+# Format of the datetimes in the cursors (SQLAlchemy's SQLite storage)
+CURSOR_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def _encode_cursor(key, id: int) -> str:
+    if isinstance(key, datetime):
+        key = key.strftime(CURSOR_TIME_FORMAT)
+    return urlsafe_b64encode(json.dumps([key, id]).encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> tuple:
+    # The key is a number, a string or null (a NULL datetime)
+    try:
+        key, id = json.loads(urlsafe_b64decode(cursor.encode()))
+        if isinstance(key, bool) or not isinstance(key, (int, str, type(None))):
+            raise TypeError(key)
+        return key, int(id)
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid cursor '{cursor}'")
 
 
 class User(db.Model, UserMixin):
@@ -27,12 +145,14 @@ class User(db.Model, UserMixin):
     created_at = db.Column(db.DateTime,
                            server_default=db.func.current_timestamp(),
                            nullable=False)
-    signin_count = query_expression()
-    last_signin_at = query_expression()
+    signin_count = db.Column(db.Integer, nullable=False, default=0,
+                             server_default='0')
+    last_signin_at = db.Column(db.DateTime, nullable=True)
     email = db.Column(db.String(255), unique=True, nullable=False)
     nickname = db.Column(db.String(255), nullable=False)
     password = db.Column(db.String(255), nullable=True)
     pwd_salt = db.Column(db.String(255), nullable=True)
+    # SHA-256 of the key sent by email
     activation_key = db.Column(db.String(255), nullable=True)
     activated_at = db.Column(db.DateTime, nullable=True)
     sessions = db.relationship(
@@ -48,56 +168,118 @@ class User(db.Model, UserMixin):
         cascade="all, delete",
         passive_deletes=True,
     )
+    __table_args__ = (
+        db.Index('ix_user_signin_count', 'signin_count', 'id'),
+        db.Index('ix_user_last_signin_at', 'last_signin_at', 'id'),
+        db.Index('ix_user_activation_key', 'activation_key', unique=True),
+    )
+
+    ACTIVATION_KEY_LENGTH = 50
+
+    # The plain activation key, only known by the instance which issued it
+    issued_activation_key = None
+
+    # What the session store keeps of a logged in user, along with whether
+    # they have a password. The sign-in counters change on every login, they
+    # are loaded on demand instead, as is the password hash: it is never
+    # copied into the (shared) store.
+    SNAPSHOT_COLUMNS = ('id', 'created_at', 'email', 'nickname',
+                        'activation_key', 'activated_at')
+
+    # Set on the users rebuilt from a snapshot
+    snapshot_has_password = None
 
     def __repr__(self):
         return f"User({self.id}, '{self.nickname}', '{self.email}')"
 
+    def __changed(self) -> None:
+        if self.id is not None:
+            db.session.info.setdefault('changed_users', set()).add(self.id)
+
     def is_activated(self) -> bool:
         return self.activated_at is not None
 
+    def has_password(self) -> bool:
+        # Users signed up through OAuth have none
+        if self.snapshot_has_password is not None and \
+                'password' in inspect(self).unloaded:
+            return self.snapshot_has_password
+        return self.password is not None
+
     def can_send_verification(self) -> bool:
         return not self.is_activated() and self.activation_key is not None
 
-    def update_password(self, password: str) -> None:
-        salt = bcrypt.gensalt()
-        hash = bcrypt.hashpw(password.encode('utf-8'), salt)
+    def __set_password(self, password: str) -> None:
+        hash = hasher.hash(password)
 
         self.password = hash
-        self.pwd_salt = salt
+        # The salt is part of the bcrypt hash: '$2b$<cost>$<22 chars salt>'
+        self.pwd_salt = hash[:29]
+
+        self.__changed()
+
+    def update_password(self, password: str) -> None:
+        self.__set_password(password)
 
         db.session.commit()
 
     def check_password(self, password: str) -> bool:
         if self.password is None:
             return password is None
-        hash = bcrypt.hashpw(password.encode('utf-8'), self.pwd_salt)
-        return hash == self.password
+        if not hasher.check(password, self.password):
+            return False
+
+        # The work factor has changed since this hash was computed, it will
+        # be saved along with the session of this login
+        if hasher.needs_rehash(self.password):
+            self.__set_password(password)
+        return True
 
     def on_logged_in(self) -> None:
         self.add_session()
 
         db.session.commit()
 
-    def activate(self, key: str) -> bool:
-        if key != self.activation_key:
-            return False
+    def new_activation_key(self) -> str:
+        # Only the hash is stored, the key itself is sent by email
+        self.issued_activation_key = tokens.generate(User.ACTIVATION_KEY_LENGTH)
+        self.activation_key = hash_token(self.issued_activation_key)
+        self.__changed()
+        return self.issued_activation_key
 
+    def activate(self) -> None:
         self.activated_at = db.func.current_timestamp()
         self.activation_key = None
 
         self.add_session()
+        self.__changed()
 
         db.session.commit()
-        return True
 
     def update_nickname(self, nickname: str) -> None:
         self.nickname = nickname
+        self.__changed()
 
         db.session.commit()
 
-    def add_session(self) -> None:
-        user_session = UserSession(logged_at=db.func.current_timestamp())
-        self.sessions.append(user_session)
+    def add_session(self, signup: bool = False) -> None:
+        logged_at = datetime.utcnow()
+        # Going through the backref doesn't load the whole sessions collection
+        user_session = UserSession(logged_at=logged_at, user=self)
+        db.session.add(user_session)
+
+        if self.id is None:
+            self.signin_count = (self.signin_count or 0) + 1
+        else:
+            # Increment in SQL so that concurrent logins don't lose updates
+            self.signin_count = User.signin_count + 1
+        self.last_signin_at = logged_at
+
+        DailyUserActivity.Track(self, logged_at, signup)
+
+        db.session.info['dashboard_changed'] = True
+        db.session.info.setdefault('user_events', []).append(
+            (self, signup, logged_at))
 
     def link_oauth(self, oauth: 'OAuth') -> None:
         if self.activated_at is None:
@@ -106,30 +288,95 @@ class User(db.Model, UserMixin):
         oauth.user = self
 
         self.add_session()
+        self.__changed()
 
         db.session.add_all([self, oauth])
         db.session.commit()
 
     @staticmethod
-    def __generate_random_string(length: int) -> str:
-        chars = string.ascii_letters + string.digits
-        return ''.join(random.choice(chars) for _ in range(length))
+    def Add(email: str, password: str) -> 'User':
+        # Same as Create(), left to be committed by the caller (along with
+        # its verification email)
+        user = User(email=email, nickname=email[:email.find("@")])
+        user.__set_password(password)
+
+        user.new_activation_key()
+
+        user.add_session(signup=True)
+
+        _upsert(Counters, {'id': 1}, total_users=1)
+
+        db.session.add(user)
+        return user
 
     @staticmethod
     def Create(email: str, password: str) -> 'User':
-        salt = bcrypt.gensalt()
-        hash = bcrypt.hashpw(password.encode('utf-8'), salt)
+        user = User.Add(email, password)
 
-        user = User(email=email, password=hash, pwd_salt=salt,
-                    nickname=email[:email.find("@")])
+        db.session.commit()
+        return user
 
-        user.activation_key = User.__generate_random_string(50)
+    @staticmethod
+    def BulkCreate(records: list[dict], batch_size: int = 500) -> int:
+        # Inserts a batch of {'email', 'password', 'nickname', 'activated'}
+        # records in one transaction, with executemany-style inserts.
+        # Emails which already exist are skipped. Returns the number of
+        # created users. The emails are looked up `batch_size` at a time,
+        # SQLite limits the number of parameters of a query.
+        emails = [r['email'] for r in records]
+        existing = set()
+        for start in range(0, len(emails), batch_size):
+            existing.update(email for email, in db.session.query(User.email)
+                            .filter(User.email.in_(emails[start:start + batch_size])))
 
-        user.add_session()
+        new_records = {}
+        for record in records:
+            if record['email'] not in existing:
+                new_records.setdefault(record['email'], record)
+        if not new_records:
+            return 0
 
-        db.session.add(user)
+        hashes = hasher.hash_many([r['password'] for r in new_records.values()])
+        now = datetime.utcnow()
+        # Their verification email is sent on demand, with a new key
+        keys = iter(tokens.generate_many(
+            sum(1 for r in new_records.values() if not r.get('activated')),
+            User.ACTIVATION_KEY_LENGTH))
+
+        db.session.execute(User.__table__.insert(), [{
+            'created_at': now,
+            'email': email,
+            'nickname': r.get('nickname') or email[:email.find("@")],
+            'password': hash,
+            'pwd_salt': hash[:29],
+            'activation_key': None if r.get('activated')
+            else hash_token(next(keys)),
+            'activated_at': now if r.get('activated') else None,
+            # Same as Create(): the signup counts as the first session
+            'signin_count': 1,
+            'last_signin_at': now,
+        } for (email, r), hash in zip(new_records.items(), hashes)])
+
+        emails = list(new_records)
+        ids = []
+        for start in range(0, len(emails), batch_size):
+            ids.extend(id for id, in db.session.query(User.id)
+                       .filter(User.email.in_(emails[start:start + batch_size])))
+
+        db.session.execute(UserSession.__table__.insert(), [
+            {'user_id': id, 'logged_at': now} for id in ids])
+        db.session.execute(DailyUserActivity.__table__.insert(), [
+            {'day': now.date(), 'user_id': id, 'login_count': 1,
+             'last_logged_at': now} for id in ids])
+        _upsert(DailyActivity, {'day': now.date()}, active_users=len(ids),
+                login_count=len(ids), signups=len(ids))
+        _upsert(HourlyActivity, {'day': now.date(), 'hour': now.hour},
+                login_count=len(ids), signups=len(ids))
+        _upsert(Counters, {'id': 1}, total_users=len(ids))
+
+        db.session.info['dashboard_changed'] = True
         db.session.commit()
-        return user
+        return len(ids)
 
     @staticmethod
     def CreateWithOAuth(email: str, nickname: str, oauth: 'OAuth') -> 'User':
@@ -139,63 +386,311 @@ class User(db.Model, UserMixin):
         # Associate the new local user account with the OAuth token
         oauth.user = user
 
-        user.add_session()
+        user.add_session(signup=True)
+
+        _upsert(Counters, {'id': 1}, total_users=1)
 
         db.session.add_all([user, oauth])
         db.session.commit()
         return user
 
+    @staticmethod
+    def UpsertWithOAuth(provider: str, provider_user_id, email: str,
+                        nickname: str, token: dict) -> 'User':
+        # The first callbacks of an account race to create its user (unique
+        # email) or its link (unique provider_user_id): the commit of the
+        # losers fails, they find the rows of the winner on the second try
+        try:
+            return User.__upsert_oauth(provider, provider_user_id, email,
+                                       nickname, token)
+        except IntegrityError:
+            db.session.rollback()
+            return User.__upsert_oauth(provider, provider_user_id, email,
+                                       nickname, token)
+
+    @staticmethod
+    def __upsert_oauth(provider: str, provider_user_id, email: str,
+                       nickname: str, token: dict) -> 'User':
+        # The user already linked to this OAuth account, found through the
+        # unique (provider, provider_user_id) index, otherwise the one
+        # owning the email address
+        user = db.session.query(User) \
+            .join(OAuth, OAuth.user_id == User.id) \
+            .filter(OAuth.provider == provider,
+                    OAuth.provider_user_id == str(provider_user_id)) \
+            .first()
+        if user is not None:
+            _request_users()[user.email] = user
+            user.on_logged_in()
+            return user
+
+        user = User.FindByEmail(email)
+        oauth = OAuth.Create(provider, str(provider_user_id), token)
+        if user is None:
+            return User.CreateWithOAuth(email, nickname, oauth)
+
+        user.link_oauth(oauth)
+        return user
+
     @staticmethod
     def FindById(id: int) -> 'User':
-        return User.query.get(id)
+        user = db.session.get(User, id)
+        if user:
+            _request_users()[user.email] = user
+        return user
+
+    @staticmethod
+    def FindLoggedIn(id: int) -> 'User':
+        # Rebuilds the user from its session snapshot without any query,
+        # as a persistent instance which can still be updated
+        version = session_store.version(id)
+        snapshot = session_store.get(id, version)
+        if snapshot is None:
+            user = User.FindById(id)
+            if user:
+                session_store.set(id, version, tuple(
+                    getattr(user, c) for c in User.SNAPSHOT_COLUMNS) +
+                    (user.password is not None, ))
+            return user
+
+        *values, has_password = snapshot
+        user = User(**dict(zip(User.SNAPSHOT_COLUMNS, values)))
+        make_transient_to_detached(user)
+        user = db.session.merge(user, load=False)
+        user.snapshot_has_password = has_password
+        _request_users()[user.email] = user
+        return user
+
+    @staticmethod
+    def FindByActivationKey(key: str) -> 'User':
+        return User.query.filter_by(activation_key=hash_token(key)).first()
 
     @staticmethod
     def FindByEmail(email: str) -> 'User':
-        return User.query.filter_by(email=email).first()
+        users = _request_users()
+        user = users.get(email)
+        if user is None:
+            user = User.query.filter_by(email=email).first()
+            if user:
+                users[email] = user
+        return user
+
+    SORT_OPTIONS = ('signup', 'logins', 'last_signin')
+
+    @staticmethod
+    def __sort_key(sort: str) -> tuple:
+        # (column, descending)
+        return {
+            'signup': (User.id, False),
+            'logins': (User.signin_count, True),
+            'last_signin': (User.last_signin_at, True),
+        }[sort]
+
+    @staticmethod
+    @read_only()
+    def FetchAll(sort: str = 'signup', after: str = None,
+                 limit: int = 50) -> tuple[list[UserRow], str]:
+        # Returns one page of users ordered by `sort` and starting after the
+        # `after` cursor, along with the cursor of the next page (None on
+        # the last one). Raises ValueError for a malformed cursor.
+        key, descending = User.__sort_key(sort)
+        # SQLite stores datetimes as text, with or without microseconds: the
+        # cursors carry them as stored so that ties compare exactly
+        raw = isinstance(key.type, db.DateTime) and \
+            db.engine.dialect.name == 'sqlite'
+        sort_key = db.type_coerce(key, db.String) if raw else key
+
+        query = db.session.query(User.id, User.created_at, User.signin_count,
+                                 User.last_signin_at, sort_key)
+
+        # NULL keys (users who never signed in) sort before any other one,
+        # after them in descending order, as in the read model
+        if after is not None:
+            value, id = _decode_cursor(after)
+            if key is User.id:
+                query = query.filter(User.id > id)
+            else:
+                value = User.__cursor_key(key, value, raw, after)
+                if value is None and descending:
+                    query = query.filter(sort_key.is_(None), User.id < id)
+                elif value is None:
+                    query = query.filter(db.or_(
+                        sort_key.isnot(None),
+                        db.and_(sort_key.is_(None), User.id > id)))
+                elif descending:
+                    query = query.filter(db.or_(
+                        sort_key < value,
+                        db.and_(sort_key == value, User.id < id),
+                        sort_key.is_(None)))
+                else:
+                    query = query.filter(db.or_(
+                        sort_key > value,
+                        db.and_(sort_key == value, User.id > id)))
+
+        if not key.nullable:
+            order = sort_key.desc() if descending else sort_key
+        elif descending:
+            order = sort_key.desc().nullslast()
+        else:
+            order = sort_key.asc().nullsfirst()
+        query = query.order_by(order, User.id.desc() if descending else User.id)
+
+        rows = query.limit(limit + 1).all()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = _encode_cursor(rows[-1][-1], rows[-1].id)
+
+        return [UserRow(*row[:-1]) for row in rows], next_cursor
+
+    @staticmethod
+    def __cursor_key(key, value, raw: bool, cursor: str):
+        # The key of a cursor, checked against the type of the sort column
+        try:
+            if isinstance(key.type, db.DateTime):
+                if value is None and key.nullable:
+                    return None
+                parsed = datetime.fromisoformat(value)
+                return value if raw else parsed
+            if isinstance(value, int):
+                return value
+        except (ValueError, TypeError):
+            pass
+        raise ValueError(f"Invalid cursor '{cursor}'")
 
     @staticmethod
-    def FetchAll() -> list['User']:
-        return db.session.query(User).options(
-            with_expression(User.signin_count, db.func.count(UserSession.id))
-            .with_expression(User.last_signin_at, db.func.max(UserSession.logged_at))) \
-            .join(UserSession, User.id == UserSession.user_id) \
-            .group_by(User.id) \
+    def IterAll(sort: str = 'signup', batch_size: int = 500):
+        # Streams (created_at, signin_count, last_signin_at) rows of every
+        # user, without building ORM instances nor buffering the result
+        key, descending = User.__sort_key(sort)
+
+        query = db.session.query(
+            User.created_at, User.signin_count, User.last_signin_at)
+
+        if descending:
+            query = query.order_by(key.desc(), User.id.desc())
+        else:
+            query = query.order_by(key, User.id)
+
+        # Executed right away, on the replica
+        with read_only():
+            return iter(query.yield_per(batch_size))
+
+    @staticmethod
+    def __actual_counters():
+        # Sign-in count and last sign-in of the users, from their sessions
+        # and, for the days whose sessions were archived, from the rollup
+        parts = [db.select(
+            UserSession.user_id.label('user_id'),
+            db.func.count(UserSession.id).label('signin_count'),
+            db.func.max(UserSession.logged_at).label('last_signin_at'))
+            .group_by(UserSession.user_id)]
+
+        compacted_before = SessionArchive.CompactedBefore()
+        if compacted_before is not None:
+            parts.append(db.select(
+                DailyUserActivity.user_id,
+                db.func.sum(DailyUserActivity.login_count),
+                db.func.max(DailyUserActivity.last_logged_at))
+                .where(DailyUserActivity.day < compacted_before)
+                .group_by(DailyUserActivity.user_id))
+
+        union = db.union_all(*parts).subquery()
+        return db.select(
+            union.c.user_id,
+            db.func.sum(union.c.signin_count).label('signin_count'),
+            db.func.max(union.c.last_signin_at).label('last_signin_at')) \
+            .group_by(union.c.user_id) \
+            .subquery()
+
+    @staticmethod
+    def FindInconsistentCounters() -> list:
+        # Users whose denormalized signin_count/last_signin_at don't match
+        # their sessions, as (id, stored count, stored last signin, actual
+        # count, actual last signin)
+        counters = User.__actual_counters()
+        actual_count = db.func.coalesce(counters.c.signin_count, 0)
+
+        return db.session.query(
+            User.id, User.signin_count, User.last_signin_at,
+            actual_count, counters.c.last_signin_at) \
+            .outerjoin(counters, counters.c.user_id == User.id) \
+            .filter(db.or_(
+                User.signin_count != actual_count,
+                User.last_signin_at.is_distinct_from(
+                    counters.c.last_signin_at))) \
             .all()
 
     @staticmethod
-    def GetStatistics() -> dict:
-        # Total number of users who have signed up
-        # Total number of users with active sessions today
-        total_active_today_query = db.session.query(db.func.count(db.distinct(UserSession.user_id))) \
-            .select_from(UserSession) \
-            .filter(db.func.date(UserSession.logged_at) == date.today())
-
-        total_users, total_active_today = db.session.query(
-            db.func.count(User.id).label('total_users'),
-            total_active_today_query.label('total_active_today')) \
-            .select_from(User) \
-            .first()
+    def RepairCounters(ids: list[int], batch_size: int = 500) -> None:
+        # Updated by batches of ids: a statement stays below the bound
+        # parameters limit of SQLite, and a transaction stays short
+        signin_count = db.select(db.func.count(UserSession.id)) \
+            .where(UserSession.user_id == User.id) \
+            .scalar_subquery()
+        last_signin_at = db.select(db.func.max(UserSession.logged_at)) \
+            .where(UserSession.user_id == User.id) \
+            .scalar_subquery()
 
-        # Average number of active session users in the last 7 days
+        # Archived days all precede the remaining sessions
+        compacted_before = SessionArchive.CompactedBefore()
+        if compacted_before is not None:
+            archived = db.and_(DailyUserActivity.user_id == User.id,
+                               DailyUserActivity.day < compacted_before)
+            signin_count = signin_count + db.select(
+                db.func.coalesce(db.func.sum(DailyUserActivity.login_count), 0)) \
+                .where(archived).scalar_subquery()
+            last_signin_at = db.func.coalesce(last_signin_at, db.select(
+                db.func.max(DailyUserActivity.last_logged_at))
+                .where(archived).scalar_subquery())
+
+        for start in range(0, len(ids), batch_size):
+            db.session.query(User) \
+                .filter(User.id.in_(ids[start:start + batch_size])) \
+                .update({
+                    User.signin_count: signin_count,
+                    User.last_signin_at: last_signin_at,
+                }, synchronize_session=False)
+            db.session.commit()
+
+    @staticmethod
+    def IterExport(batch_size: int = 1000):
+        query = db.session.query(
+            User.id, User.email, User.nickname, User.created_at,
+            User.activated_at, User.signin_count, User.last_signin_at) \
+            .order_by(User.id)
+        with read_only():
+            return iter(query.yield_per(batch_size))
+
+    @staticmethod
+    @read_only()
+    def GetStatistics() -> dict:
+        # Everything is read from the rollup tables maintained by
+        # add_session(), so this never touches user_session
         nb_last_days = 7
-        end_date = date.today()
+        end_date = datetime.utcnow().date()
         start_date = end_date - timedelta(days=nb_last_days - 1)
 
-        logged_date = db.func.date(UserSession.logged_at).label('logged_date')
-        count = db.func.count(UserSession.id).label('count')
+        counters = db.session.get(Counters, 1)
+        days = DailyActivity.query \
+            .filter(DailyActivity.day.between(start_date, end_date)) \
+            .all()
+
+        # Total number of users who have signed up
+        total_users = counters.total_users if counters else 0
 
-        q = db.session.query(logged_date, count) \
-            .select_from(UserSession) \
-            .filter(db.text(f"{logged_date.name} BETWEEN '{start_date}' AND '{end_date}'")) \
-            .group_by(logged_date.name, UserSession.user_id)
+        # Total number of users with active sessions today
+        total_active_today = next(
+            (d.active_users for d in days if d.day == end_date), 0)
 
-        sum = db.session.query(db.func.sum(db.text(count.name))) \
-            .select_from(q).first()[0]
+        # Average number of active session users in the last 7 days
+        total_logins = sum(d.login_count for d in days)
 
         return {
             'total_users': total_users,
             'total_active_today': total_active_today,
-            'avg_last_days': sum / nb_last_days
+            'avg_last_days': total_logins / nb_last_days
         }
 
 
@@ -208,9 +703,367 @@ class UserSession(db.Model):
     logged_at = db.Column(db.DateTime,
                           server_default=db.func.current_timestamp(),
                           nullable=False)
+    __table_args__ = (
+        db.Index('ix_user_session_user_id_logged_at', 'user_id', 'logged_at'),
+        db.Index('ix_user_session_logged_at', 'logged_at'),
+    )
+
+    @staticmethod
+    def OldestDay() -> date:
+        logged_at = db.session.query(db.func.min(UserSession.logged_at)).scalar()
+        return logged_at.date() if logged_at else None
 
+    @staticmethod
+    def MaxId() -> int:
+        return db.session.query(db.func.max(UserSession.id)).scalar() or 0
+
+    @staticmethod
+    def UserIdsBetween(after_id: int, last_id: int) -> list[int]:
+        # Users of the sessions added since `after_id`, up to `last_id`
+        return [user_id for user_id, in db.session.query(UserSession.user_id)
+                .filter(UserSession.id > after_id, UserSession.id <= last_id)
+                .distinct()]
 
-class OAuth(OAuthConsumerMixin, db.Model):
+    @staticmethod
+    def __day_range(day: date) -> tuple:
+        start = datetime.combine(day, time())
+        return UserSession.logged_at >= start, \
+            UserSession.logged_at < start + timedelta(days=1)
+
+    @staticmethod
+    def IterDay(day: date, batch_size: int = 1000):
+        return db.session.query(
+            UserSession.id, UserSession.user_id, UserSession.logged_at) \
+            .filter(*UserSession.__day_range(day)) \
+            .order_by(UserSession.id) \
+            .yield_per(batch_size)
+
+    @staticmethod
+    def DeleteBatch(day: date, batch_size: int) -> int:
+        # Bounded deletes, so that writers only wait for one short transaction
+        ids = db.session.query(UserSession.id) \
+            .filter(*UserSession.__day_range(day)) \
+            .order_by(UserSession.id) \
+            .limit(batch_size) \
+            .subquery()
+        deleted = db.session.query(UserSession) \
+            .filter(UserSession.id.in_(db.select(ids.c.id))) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+
+class DailyUserActivity(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey(User.id, ondelete="CASCADE"),
+                        primary_key=True)
+    user = db.relationship(User)
+    login_count = db.Column(db.Integer, nullable=False, default=0)
+    last_logged_at = db.Column(db.DateTime, nullable=True)
+
+    @staticmethod
+    def Track(user: User, logged_at: datetime, signup: bool = False) -> None:
+        day = logged_at.date()
+        if user.id is not None:
+            _upsert(DailyUserActivity, {'day': day, 'user_id': user.id},
+                    {'last_logged_at': logged_at}, login_count=1)
+            # The user is new to the day when its row has just been created,
+            # read back by the statement counting the active users
+            active = db.select(db.case(
+                (DailyUserActivity.login_count == 1, 1), else_=0)) \
+                .where(DailyUserActivity.day == day,
+                       DailyUserActivity.user_id == user.id) \
+                .scalar_subquery()
+        else:
+            # The user is not flushed yet, so this is its very first session
+            db.session.add(DailyUserActivity(day=day, user=user, login_count=1,
+                                             last_logged_at=logged_at))
+            active = 1
+
+        _upsert(DailyActivity, {'day': day}, active_users=active, login_count=1,
+                signups=1 if signup else 0)
+        _upsert(HourlyActivity, {'day': day, 'hour': logged_at.hour},
+                login_count=1, signups=1 if signup else 0)
+
+    @staticmethod
+    def RebuildDay(day: date) -> None:
+        # Recomputes the rows of a day from its sessions
+        db.session.query(DailyUserActivity) \
+            .filter(DailyUserActivity.day == day) \
+            .delete(synchronize_session=False)
+        db.session.execute(DailyUserActivity.__table__.insert().from_select(
+            ['day', 'user_id', 'login_count', 'last_logged_at'],
+            db.select(db.literal(day), UserSession.user_id,
+                      db.func.count(UserSession.id),
+                      db.func.max(UserSession.logged_at))
+            .where(UserSession.logged_at >= datetime.combine(day, time()),
+                   UserSession.logged_at < datetime.combine(
+                       day + timedelta(days=1), time()))
+            .group_by(UserSession.user_id)))
+
+    @staticmethod
+    def Rebuild(conn) -> None:
+        # Rebuilds every rollup and counter on `conn`, within its
+        # transaction. The sessions of the days before the compaction
+        # watermark have been archived, the rollups of these days are kept
+        # as they are.
+        compacted_before = SessionArchive.CompactedBefore(conn)
+        since = datetime.combine(compacted_before or date.min, time())
+
+        day = db.func.date(UserSession.logged_at)
+        hour = db.extract('hour', UserSession.logged_at)
+        signup_day = db.func.date(User.created_at)
+        signup_hour = db.extract('hour', User.created_at)
+
+        daily_user = DailyUserActivity.__table__.delete()
+        hourly = HourlyActivity.__table__.delete()
+        if compacted_before is not None:
+            daily_user = daily_user.where(DailyUserActivity.day >= compacted_before)
+            hourly = hourly.where(HourlyActivity.day >= compacted_before)
+        conn.execute(daily_user)
+        conn.execute(hourly)
+        conn.execute(DailyActivity.__table__.delete())
+        conn.execute(Counters.__table__.delete())
+
+        conn.execute(DailyUserActivity.__table__.insert().from_select(
+            ['day', 'user_id', 'login_count', 'last_logged_at'],
+            db.select(day, UserSession.user_id, db.func.count(UserSession.id),
+                      db.func.max(UserSession.logged_at))
+            .where(UserSession.logged_at >= since)
+            .group_by(day, UserSession.user_id)))
+
+        conn.execute(DailyActivity.__table__.insert().from_select(
+            ['day', 'active_users', 'login_count'],
+            db.select(DailyUserActivity.day,
+                      db.func.count(DailyUserActivity.user_id),
+                      db.func.sum(DailyUserActivity.login_count))
+            .group_by(DailyUserActivity.day)))
+
+        conn.execute(HourlyActivity.__table__.insert().from_select(
+            ['day', 'hour', 'login_count'],
+            db.select(day, hour, db.func.count(UserSession.id))
+            .where(UserSession.logged_at >= since)
+            .group_by(day, hour)))
+
+        # Every signup comes with a session, so its buckets already exist
+        conn.execute(DailyActivity.__table__.update().values(
+            signups=db.select(db.func.count(User.id))
+            .where(signup_day == DailyActivity.day).scalar_subquery()))
+        conn.execute(HourlyActivity.__table__.update().values(
+            signups=db.select(db.func.count(User.id))
+            .where(signup_day == HourlyActivity.day,
+                   signup_hour == HourlyActivity.hour).scalar_subquery()))
+
+        conn.execute(Counters.__table__.insert().from_select(
+            ['id', 'total_users'],
+            db.select(db.literal(1), db.func.count(User.id))))
+
+
+class DailyActivity(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    active_users = db.Column(db.Integer, nullable=False, default=0)
+    login_count = db.Column(db.Integer, nullable=False, default=0)
+    signups = db.Column(db.Integer, nullable=False, default=0,
+                        server_default='0')
+
+    BUCKETS = ('hour', 'day', 'week')
+
+    @staticmethod
+    def __active_users(start: date, end: date) -> int:
+        return db.session.query(
+            db.func.count(db.distinct(DailyUserActivity.user_id))) \
+            .filter(DailyUserActivity.day.between(start, end)) \
+            .scalar()
+
+    @staticmethod
+    @read_only()
+    def GetAnalytics(start: date, end: date, bucket: str) -> dict:
+        # Buckets are summed from the daily/hourly rollups, so the cost
+        # depends on the number of days, not on the number of sessions.
+        # Days are UTC, weeks start on Monday.
+        if bucket == 'hour':
+            rows = HourlyActivity.query \
+                .filter(HourlyActivity.day.between(start, end)).all()
+            found = {datetime.combine(r.day, time(r.hour)): r for r in rows}
+            keys = [datetime.combine(start, time()) + timedelta(hours=i)
+                    for i in range(((end - start).days + 1) * 24)]
+        else:
+            rows = DailyActivity.query \
+                .filter(DailyActivity.day.between(start, end)).all()
+            found = {r.day: r for r in rows}
+            keys = [start + timedelta(days=i)
+                    for i in range((end - start).days + 1)]
+
+        buckets = {}
+        for key in keys:
+            if bucket == 'week':
+                bucket_start = key - timedelta(days=key.weekday())
+            else:
+                bucket_start = key
+            totals = buckets.setdefault(bucket_start, {
+                'start': bucket_start.isoformat(), 'logins': 0, 'signups': 0})
+
+            row = found.get(key)
+            if row is not None:
+                totals['logins'] += row.login_count
+                totals['signups'] += row.signups
+            if bucket == 'day':
+                # Distinct users can't be summed over several days
+                totals['active_users'] = row.active_users if row else 0
+
+        last_day = found.get(end) if bucket != 'hour' else \
+            db.session.get(DailyActivity, end)
+        counters = db.session.get(Counters, 1)
+
+        return {
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'bucket': bucket,
+            'total_users': counters.total_users if counters else 0,
+            # Active users as of the last day of the range
+            'dau': last_day.active_users if last_day else 0,
+            'wau': DailyActivity.__active_users(end - timedelta(days=6), end),
+            'mau': DailyActivity.__active_users(end - timedelta(days=29), end),
+            'buckets': list(buckets.values()),
+        }
+
+
+class HourlyActivity(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    # 0-23, UTC
+    hour = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    login_count = db.Column(db.Integer, nullable=False, default=0)
+    signups = db.Column(db.Integer, nullable=False, default=0)
+
+
+class Counters(db.Model):
+    # Single row (id=1) of global counters
+    id = db.Column(db.Integer, primary_key=True)
+    total_users = db.Column(db.Integer, nullable=False, default=0)
+
+
+class ReplicaHeartbeat(db.Model):
+    # Single row (id=1), written to the primary by `flask db sync-replica`
+    # and read back from the replica to measure its lag
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    beat_at = db.Column(db.DateTime, nullable=False)
+
+    @staticmethod
+    def Beat() -> None:
+        db.session.merge(ReplicaHeartbeat(id=1, beat_at=datetime.utcnow()))
+        db.session.commit()
+
+
+class SessionArchive(db.Model):
+    # Days of user sessions archived to a file then deleted. Their sessions
+    # only remain in the daily_user_activity rollup.
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, unique=True, nullable=False)
+    path = db.Column(db.String(1024), nullable=False)
+    row_count = db.Column(db.Integer, nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False,
+                            default=datetime.utcnow)
+
+    @staticmethod
+    def CompactedBefore(conn=None) -> date:
+        # Days are compacted in order, so every day before the one following
+        # the last archived day has been compacted
+        day = (conn or db.session).execute(
+            db.select(db.func.max(SessionArchive.day))).scalar()
+        return day + timedelta(days=1) if day else None
+
+    @staticmethod
+    def Record(day: date, path: str, row_count: int) -> None:
+        db.session.add(SessionArchive(day=day, path=path, row_count=row_count))
+        db.session.commit()
+
+
+class OutboxEmail(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime,
+                           server_default=db.func.current_timestamp(),
+                           nullable=False)
+    recipient = db.Column(db.String(255), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    text = db.Column(db.Text, nullable=False)
+    html = db.Column(db.Text, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    # NULL once the email is sent or given up on
+    next_attempt_at = db.Column(db.DateTime, nullable=True, index=True,
+                                default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    # Token of the latest claim of the email by a worker
+    claim = db.Column(db.String(32), nullable=True)
+
+    def mark_sent(self) -> None:
+        self.sent_at = datetime.utcnow()
+        self.next_attempt_at = None
+
+    def mark_failed(self, error: Exception, max_attempts: int,
+                    retry_delay: int, permanent: bool = False) -> None:
+        self.attempts += 1
+        self.last_error = str(error)
+        if permanent or self.attempts >= max_attempts:
+            self.next_attempt_at = None
+        else:
+            # Exponential backoff: retry_delay, 2 * retry_delay, 4 * ...
+            delay = retry_delay * 2 ** (self.attempts - 1)
+            self.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+
+    @staticmethod
+    def Enqueue(recipient: str, subject: str, text: str, html: str) -> 'OutboxEmail':
+        # Committed along with the pending changes of the session (the new
+        # user, its activation key): the email is queued if and only if they
+        # are saved
+        email = OutboxEmail(recipient=recipient, subject=subject,
+                            text=text, html=html)
+
+        db.session.add(email)
+        db.session.commit()
+        return email
+
+    @staticmethod
+    def ClaimDue(limit: int, lease: int) -> list['OutboxEmail']:
+        # Due emails are leased to the calling worker: their next attempt is
+        # pushed `lease` seconds ahead, the workers of the other processes
+        # skip them meanwhile. The UPDATE only takes the rows still due, not
+        # those claimed since by another worker. The emails of a worker which
+        # died while sending them are retried once the lease has expired.
+        now = datetime.utcnow()
+        ids = [id for id, in db.session.query(OutboxEmail.id)
+               .filter(OutboxEmail.next_attempt_at <= now)
+               .order_by(OutboxEmail.next_attempt_at)
+               .limit(limit)]
+        if not ids:
+            return []
+
+        # A random token identifies the rows of this claim
+        claim = secrets.token_hex(16)
+        db.session.query(OutboxEmail) \
+            .filter(OutboxEmail.id.in_(ids),
+                    OutboxEmail.next_attempt_at <= now) \
+            .update({OutboxEmail.next_attempt_at: now + timedelta(seconds=lease),
+                     OutboxEmail.claim: claim},
+                    synchronize_session=False)
+        db.session.commit()
+
+        return OutboxEmail.query \
+            .filter(OutboxEmail.id.in_(ids), OutboxEmail.claim == claim) \
+            .order_by(OutboxEmail.id) \
+            .all()
+
+
+class OAuth(db.Model):
+    # Columns of Flask-Dance's OAuthConsumerMixin, which isn't imported along
+    # with the models: Flask-Dance is only loaded when OAuth is configured
+    __tablename__ = 'flask_dance_oauth'
+    id = db.Column(db.Integer, primary_key=True)
+    provider = db.Column(db.String(50), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow,
+                           nullable=False)
+    token = db.Column(MutableDict.as_mutable(db.JSON), nullable=False)
     provider_user_id = db.Column(db.String(255), nullable=False)
     user_id = db.Column(db.Integer,
                         db.ForeignKey(User.id, ondelete="CASCADE"),
@@ -218,16 +1071,6 @@ class OAuth(OAuthConsumerMixin, db.Model):
     user = db.relationship(User, back_populates="oauths")
     __table_args__ = (db.UniqueConstraint('provider', 'provider_user_id'), )
 
-    @staticmethod
-    def FindUser(provider: str, user_id: int) -> User:
-        query = OAuth.query.filter_by(
-            provider=provider, provider_user_id=user_id)
-
-        try:
-            return query.one().user
-        except NoResultFound:
-            return None
-
     @staticmethod
     def Create(provider: str, user_id: int, token: str) -> 'OAuth':
         return OAuth(provider=provider,
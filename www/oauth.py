@@ -1,73 +1,83 @@
 import json
+import hashlib
+import os
 from os import path
-from flask import flash
+from urllib.parse import urljoin
+from flask import flash, g
 from flask_login import current_user, login_user
-from flask_dance.contrib.google import make_google_blueprint
-from flask_dance.contrib.facebook import make_facebook_blueprint
-from flask_dance.consumer import oauth_authorized, oauth_error
-from flask_dance.consumer.storage.sqla import SQLAlchemyStorage
 from .models import db, OAuth, User
-import os
-
-
-google_config = {}
-try:
-    google_filepath = path.join(path.dirname(__file__), "../google.json")
-    with open(google_filepath) as f:
-        web_config = json.load(f)['web']
-        if 'client_id' in web_config and 'client_secret' in web_config:
-            google_config = {
-                'client_id': web_config['client_id'],
-                'client_secret': web_config['client_secret']
-            }
-except:
-    flash("Failed to read 'google.json'")
-
-google_blueprint = make_google_blueprint(
-    **google_config,
-    reprompt_consent=True,
-    scope=["profile", "email"],
-    storage=SQLAlchemyStorage(OAuth, db.session, user=current_user)
-)
-
-
-facebook_config = {}
-fb_cid = os.getenv('FACEBOOK_OAUTH_CLIENT_ID', None)
-fb_cs = os.getenv('FACEBOOK_OAUTH_CLIENT_SECRET', None)
-if fb_cid and fb_cs:
-    facebook_config = {
-        'client_id': fb_cid,
-        'client_secret': fb_cs
-    }
-
-facebook_blueprint = make_facebook_blueprint(
-    **facebook_config,
-    scope=["public_profile", "email"],
-    storage=SQLAlchemyStorage(OAuth, db.session, user=current_user)
-)
+from .cache import cache
 
+# Flask-Dance and requests are only imported by init_app(), when at least one
+# provider is configured
 
 endpoints = {
-    google_blueprint.name: "/oauth2/v1/userinfo",
-    facebook_blueprint.name: "/me?fields=id,name,email"
+    'google': "/oauth2/v1/userinfo",
+    'facebook': "/me?fields=id,name,email"
 }
 
+# Seconds a provider's userinfo is cached for a given access token
+userinfo_ttl = int(os.getenv('OAUTH_USERINFO_TTL', 300))
+
+
+def load_google_config(filepath: str) -> dict:
+    try:
+        with open(filepath) as f:
+            web_config = json.load(f)['web']
+    except (OSError, ValueError, KeyError):
+        return {}
+
+    if 'client_id' in web_config and 'client_secret' in web_config:
+        return {
+            'client_id': web_config['client_id'],
+            'client_secret': web_config['client_secret']
+        }
+    return {}
+
+
+def load_facebook_config() -> dict:
+    fb_cid = os.getenv('FACEBOOK_OAUTH_CLIENT_ID', None)
+    fb_cs = os.getenv('FACEBOOK_OAUTH_CLIENT_SECRET', None)
+    if fb_cid and fb_cs:
+        return {
+            'client_id': fb_cid,
+            'client_secret': fb_cs
+        }
+    return {}
+
+
+def fetch_userinfo(blueprint, token: dict) -> dict:
+    # Raises requests.RequestException when the provider call fails
+    from www.httpclient import http
+
+    token_hash = hashlib.sha256(token['access_token'].encode()).hexdigest()
+
+    # Flask-Dance keeps a single provider session (and token) per blueprint,
+    # which concurrent callbacks would share: the token is passed explicitly
+    def fetch():
+        resp = http.get(urljoin(blueprint.base_url, endpoints[blueprint.name]),
+                        headers={'Authorization': f"Bearer {token['access_token']}"})
+        resp.raise_for_status()
+        return resp.json()
+
+    return cache.get_or_set(f'oauth:userinfo:{blueprint.name}:{token_hash}',
+                            fetch, userinfo_ttl)
+
 
 # create/login local user on successful OAuth login
-@oauth_authorized.connect_via(google_blueprint)
-@oauth_authorized.connect_via(facebook_blueprint)
 def oauth_authorized_fn(blueprint, token):
+    from requests import RequestException
+
     if not token:
         flash("Failed to log in.")
         return False
 
-    resp = blueprint.session.get(endpoints[blueprint.name])
-    if not resp.ok:
+    try:
+        oauth_info = fetch_userinfo(blueprint, token)
+    except (RequestException, ValueError):
         flash("Failed to fetch user info.")
         return False
 
-    oauth_info = resp.json()
-
     # for key, value in oauth_info.items():
     #     print(key, value)
 
@@ -90,33 +100,85 @@ def oauth_authorized_fn(blueprint, token):
         flash("This application requires your email address.")
         return False
 
-    provider_user_id = oauth_info['id']
-    user = OAuth.FindUser(blueprint.name, provider_user_id)
-    if user:
-        user.on_logged_in()
-        login_user(user, remember=True)
-    else:
-        oauth = OAuth.Create(blueprint.name, provider_user_id, token)
-
-        email = oauth_info['email']
-        user = User.FindByEmail(email)
-        if user:
-            user.link_oauth(oauth)
-        else:
-            nickname = oauth_info.get('name', email[:email.find("@")])
-            user = User.CreateWithOAuth(email, nickname, oauth)
-
-        login_user(user, remember=True)
+    email = oauth_info['email']
+    nickname = oauth_info.get('name', email[:email.find("@")])
+    user = User.UpsertWithOAuth(blueprint.name, oauth_info['id'], email,
+                                nickname, token)
+    login_user(user, remember=True)
 
     # Disable Flask-Dance's default behavior for saving the OAuth token
     return False
 
 
 # notify on OAuth provider error
-@oauth_error.connect_via(google_blueprint)
-@oauth_error.connect_via(facebook_blueprint)
 def oauth_error_fn(blueprint, message, response):
     msg = ("OAuth error from {name}! " "message={message} response={response}").format(
         name=blueprint.name, message=message, response=response
     )
     flash(msg)
+
+
+def use_request_sessions(blueprint) -> None:
+    # Flask-Dance caches its provider session on the blueprint, where the
+    # concurrent callbacks (threads, or www.asgi's event loop) would share
+    # its OAuth state: each request gets its own, kept in `g`
+    blueprint_class = type(blueprint)
+    create_session = blueprint_class.session.fget
+    key = f'oauth_session_{blueprint.name}'
+
+    class RequestSessionBlueprint(blueprint_class):
+        @property
+        def session(self):
+            if key not in g:
+                setattr(g, key, create_session(self))
+            return g.get(key)
+
+        @session.deleter
+        def session(self):
+            g.pop(key, None)
+
+    blueprint.__class__ = RequestSessionBlueprint
+
+
+def init_app(app) -> None:
+    google_config = load_google_config(app.config.setdefault(
+        'GOOGLE_OAUTH_CONFIG', path.join(app.root_path, "../google.json")))
+    facebook_config = load_facebook_config()
+    if not google_config and not facebook_config:
+        app.logger.info("No OAuth provider configured")
+        return
+
+    from flask_dance.contrib.google import make_google_blueprint
+    from flask_dance.contrib.facebook import make_facebook_blueprint
+    from flask_dance.consumer import oauth_authorized, oauth_error
+    from flask_dance.consumer.storage.sqla import SQLAlchemyStorage
+    from www.httpclient import use_pooled_connections
+
+    blueprints = []
+    if google_config:
+        blueprints.append(make_google_blueprint(
+            **google_config,
+            reprompt_consent=True,
+            scope=["profile", "email"],
+            storage=SQLAlchemyStorage(OAuth, db.session, user=current_user)
+        ))
+    if facebook_config:
+        blueprints.append(make_facebook_blueprint(
+            **facebook_config,
+            scope=["public_profile", "email"],
+            storage=SQLAlchemyStorage(OAuth, db.session, user=current_user)
+        ))
+
+    provider_url = app.config.setdefault('OAUTH_PROVIDER_URL', None)
+
+    for blueprint in blueprints:
+        blueprint.session_created = use_pooled_connections
+        use_request_sessions(blueprint)
+        if provider_url:
+            blueprint.base_url = provider_url.rstrip('/') + '/'
+            blueprint.authorization_url = provider_url.rstrip('/') + '/authorize'
+            blueprint.token_url = provider_url.rstrip('/') + '/token'
+
+        oauth_authorized.connect(oauth_authorized_fn, sender=blueprint)
+        oauth_error.connect(oauth_error_fn, sender=blueprint)
+        app.register_blueprint(blueprint, url_prefix="/login")
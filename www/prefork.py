@@ -0,0 +1,190 @@
+import argparse
+import gc
+import logging
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+# Backends holding their state in the memory of each process, unless
+# STATE_DIR is set: with several workers, every one of them would cache,
+# throttle and snapshot the users on its own
+PROCESS_LOCAL = ('CACHE_URL', 'SESSION_STORE_URL', 'RATELIMIT_URL')
+
+# A worker dying sooner than that after its start is respawned with a delay
+MIN_UPTIME = 1.0
+
+
+def warm_up(app) -> None:
+    # Loads what the first requests would (modules, compiled templates, the
+    # cached login/signup pages, the dashboard read model, the mapping of
+    # the breached passwords), once, before forking: the workers share these
+    # pages of memory copy-on-write
+    from www import assets
+    from www.models import db
+    from www.readmodel import read_model
+    from www.replica import replica
+    from www.breached import breached_passwords
+
+    assets.compile_templates(app)
+    client = app.test_client()
+    for url in ('/login', '/signup'):
+        client.get(url)
+    if read_model.enabled:
+        with app.app_context():
+            read_model.snapshot()
+    breached_passwords.open()
+
+    # Pooled connections can't be shared by the processes
+    with app.app_context():
+        db.engine.dispose()
+    replica.dispose()
+
+
+def bind(host: str, port: int, backlog: int) -> socket.socket:
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    return socket.create_server((host, port), family=family, backlog=backlog)
+
+
+def serve(app, sock: socket.socket, host: str, port: int) -> None:
+    from werkzeug.serving import make_server
+
+    server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+    # shutdown() waits for serve_forever() to return, it can't run in its thread
+    signal.signal(signal.SIGTERM, lambda *args: threading.Thread(
+        target=server.shutdown).start())
+    server.serve_forever()
+
+
+def send_emails(app, poll_interval: float) -> None:
+    from www.mailer import mailer
+
+    signal.signal(signal.SIGTERM, lambda *args: mailer.stop_worker())
+    mailer.run_worker(app, poll_interval)
+
+
+class Master:
+    def __init__(self) -> None:
+        self.children = {}
+        self.stopping = False
+
+    def spawn(self, name: str, target, *args) -> None:
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (name, target, args, time.monotonic())
+            return
+
+        # Ctrl-C reaches the whole process group, the master stops the children
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        code = 0
+        try:
+            target(*args)
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+
+    def stop(self, *args) -> None:
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self) -> None:
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        while self.children:
+            pid, status = os.wait()
+            if pid not in self.children:
+                continue
+
+            name, target, args, started_at = self.children.pop(pid)
+            if self.stopping:
+                continue
+
+            logger.warning("%s (pid %d) exited with status %d, restarting",
+                           name, pid, os.waitstatus_to_exitcode(status))
+            if time.monotonic() - started_at < MIN_UPTIME:
+                time.sleep(MIN_UPTIME)
+            self.spawn(name, target, *args)
+
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog='python -m www.prefork',
+        description="Serves the app from preforked worker processes.")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='number of web worker processes')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--backlog', type=int, default=128,
+                        help='pending connections of the listening socket')
+    parser.add_argument('--state-dir', default=os.getenv('STATE_DIR'),
+                        help='directory of the state shared by the workers '
+                             '(default with several workers: a temporary one)')
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help='seconds between two outbox polls of the mail worker')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(process)d] %(levelname)s %(message)s')
+
+    # The outbox is drained by a dedicated child rather than by a thread of
+    # each web worker
+    send_mail = os.getenv('MAIL_WORKER', 'thread') == 'thread'
+    os.environ['MAIL_WORKER'] = 'prefork'
+
+    # Caches, user snapshots and rate limit counters are kept in SQLite
+    # files shared by the workers
+    state_dir, temporary = args.state_dir, False
+    if not state_dir and args.workers > 1:
+        state_dir, temporary = tempfile.mkdtemp(prefix='www-state-'), True
+    if state_dir:
+        os.environ['STATE_DIR'] = state_dir
+    if args.workers > 1:
+        # The workers already hash passwords in parallel, in their requests
+        os.environ.setdefault('HASH_POOL_SIZE', '0')
+
+    from www import create_app
+
+    app = create_app()
+    if args.workers > 1:
+        for key in PROCESS_LOCAL:
+            if app.config.get(key, 'memory://') == 'memory://':
+                logger.warning("%s is memory://, each worker has its own", key)
+
+    warm_up(app)
+    sock = bind(args.host, args.port, args.backlog)
+
+    # Moves the objects allocated so far out of the collector's reach, the
+    # collections of the workers don't write to their (shared) pages anymore
+    gc.freeze()
+
+    master = Master()
+    if send_mail:
+        master.spawn('mail worker', send_emails, app, args.poll_interval)
+    for i in range(args.workers):
+        master.spawn(f'worker {i}', serve, app, sock, args.host, args.port)
+    logger.info("Serving on %s:%d with %d worker(s)", args.host, args.port,
+                args.workers)
+
+    try:
+        master.run()
+    finally:
+        sock.close()
+        if temporary:
+            shutil.rmtree(state_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
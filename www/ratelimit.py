@@ -0,0 +1,129 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import request, session, abort, make_response, render_template
+from www.cache import create_backend
+
+# Attempts allowed per period (seconds) and key
+DEFAULT_LIMITS = {
+    'login:ip': (20, 60),
+    'login:email': (10, 900),
+    'signup:ip': (10, 3600),
+    'resend:ip': (5, 3600),
+    'resend:user': (3, 3600),
+    'activate:ip': (20, 60),
+}
+
+
+class MemoryWindows:
+    # Per key, the counts of the current and previous fixed windows: three
+    # integers whatever the number of attempts. The least recently used
+    # keys are dropped beyond `max_keys`.
+    def __init__(self, max_keys: int = 10000) -> None:
+        self.max_keys = max_keys
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key: str, window: int, period: int) -> tuple:
+        # Returns the counts of the previous and current window
+        with self._lock:
+            start, previous, current = self._windows.get(key, (window, 0, 0))
+            if start == window - 1:
+                previous, current = current, 0
+            elif start != window:
+                previous, current = 0, 0
+
+            current += 1
+            self._windows[key] = (window, previous, current)
+            self._windows.move_to_end(key)
+            while len(self._windows) > self.max_keys:
+                self._windows.popitem(last=False)
+        return previous, current
+
+
+class SharedWindows:
+    # Counts kept in a cache backend, shared by every process using it
+    def __init__(self, backend) -> None:
+        self.backend = backend
+
+    def hit(self, key: str, window: int, period: int) -> tuple:
+        current = self.backend.incr(f'ratelimit:{key}:{window}', 1, period * 2)
+        previous = self.backend.incr(f'ratelimit:{key}:{window - 1}', 0)
+        return previous, current
+
+
+class RateLimiter:
+    def __init__(self) -> None:
+        self.enabled = True
+        self.limits = dict(DEFAULT_LIMITS)
+        self.windows = MemoryWindows()
+
+    def init_app(self, app) -> None:
+        self.enabled = app.config.setdefault('RATELIMIT_ENABLED', True)
+        self.limits.update(app.config.setdefault('RATELIMITS', {}))
+
+        url = app.config.setdefault('RATELIMIT_URL', 'memory://')
+        if url == 'memory://':
+            self.windows = MemoryWindows(
+                app.config.setdefault('RATELIMIT_MAX_KEYS', 10000))
+        else:
+            self.windows = SharedWindows(create_backend(url))
+
+        @app.errorhandler(429)
+        def too_many_requests(e):
+            response = make_response(render_template('429.html'), 429)
+            if e.retry_after:
+                response.headers['Retry-After'] = str(e.retry_after)
+            return response
+
+    def hit(self, rule: str, value: str) -> int:
+        # Sliding window approximation: the previous window's count weighs
+        # for the part of it still within the period. Returns the seconds to
+        # wait when the limit is exceeded, otherwise 0.
+        limit, period = self.limits[rule]
+        now = time.time()
+        window = int(now // period)
+        key = f'{rule}:{value}'
+
+        previous, current = self.windows.hit(key, window, period)
+
+        elapsed = now - window * period
+        if previous * (1 - elapsed / period) + current <= limit:
+            return 0
+        return max(1, math.ceil(period - elapsed))
+
+    def check(self, rules: dict) -> None:
+        # Aborts with a 429 when any of the {rule: value} is over its limit
+        if not self.enabled:
+            return
+
+        retry_after = 0
+        for rule, value in rules.items():
+            if value:
+                retry_after = max(retry_after, self.hit(rule, value))
+        if retry_after:
+            abort(429, retry_after=retry_after)
+
+    def limit(self, name: str, methods: tuple = ('POST', ), email_field: str = None):
+        # Throttles the view by client IP, and by the submitted email and the
+        # logged in user id when `email_field`/a `<name>:user` rule is set.
+        # Runs before the view, so before any query or password hashing.
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if request.method in methods:
+                    rules = {f'{name}:ip': request.remote_addr}
+                    if email_field:
+                        email = request.form.get(email_field, '')
+                        rules[f'{name}:email'] = email.strip().lower()
+                    if f'{name}:user' in self.limits:
+                        rules[f'{name}:user'] = session.get('_user_id')
+                    self.check(rules)
+                return view(*args, **kwargs)
+            return wrapper
+        return decorator
+
+
+limiter = RateLimiter()
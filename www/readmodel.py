@@ -0,0 +1,260 @@
+import importlib.util
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from www.models import db, User, UserRow, UserSession, DailyActivity, \
+    CURSOR_TIME_FORMAT, _encode_cursor, _decode_cursor
+from www.cache import cache, MemoryCache, NullCache
+from www.replica import read_only
+
+# numpy is an optional dependency, imported with the first load
+np = None
+
+EPOCH = datetime(1970, 1, 1)
+# Microseconds standing for a NULL timestamp, sorted before any other one
+NULL_TIME = -2 ** 63
+
+# One row per user, in id order: int32 ids and counts, int64 microseconds
+# since the epoch, 24 bytes per user
+Columns = namedtuple('Columns', 'ids created_at signin_count last_signin_at')
+
+# Users sorted by (key, id) ascending: the int32 positions in Columns, the
+# sorted keys and ids that cursors are searched in
+Order = namedtuple('Order', 'positions keys ids')
+
+
+def _to_micros(value: datetime) -> int:
+    if value is None:
+        return NULL_TIME
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def _to_datetime(micros: int) -> datetime:
+    if micros == NULL_TIME:
+        return None
+    return EPOCH + timedelta(microseconds=int(micros))
+
+
+class ReadModel:
+    # Columnar copy of the dashboard figures of the users, sorted, paginated
+    # and aggregated with numpy instead of SQL. Refreshed from the users of
+    # the new user_session rows whenever the dashboard cache is invalidated,
+    # and fully reloaded every `reload_interval` seconds.
+    # The version of an in-process cache is only bumped by the writes of its
+    # process (never with null://): the model is then also refreshed every
+    # `refresh_interval` seconds.
+    SORT_COLUMNS = {
+        'signup': 'ids',
+        'logins': 'signin_count',
+        'last_signin': 'last_signin_at',
+    }
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.reload_interval = 600
+        self.refresh_interval = None
+        self.batch_size = 500
+        # The columns and their sorted orders, replaced together
+        self._snapshot = None
+        self._version = None
+        self._watermark = 0
+        self._loaded_at = 0.0
+        self._refreshed_at = 0.0
+        self._lock = threading.Lock()
+
+    def init_app(self, app) -> None:
+        self.reload_interval = app.config.setdefault('READ_MODEL_RELOAD', 600)
+        # As stale as the pages cached by the other processes
+        if isinstance(cache.backend, MemoryCache):
+            self.refresh_interval = app.config.setdefault('CACHE_TTL', 60)
+        elif isinstance(cache.backend, NullCache):
+            self.refresh_interval = 0
+        else:
+            self.refresh_interval = None
+        if not app.config.setdefault('READ_MODEL', True):
+            return
+        if importlib.util.find_spec('numpy') is None:
+            app.logger.info("numpy is not installed, the dashboard is read from SQL")
+            return
+        self.enabled = True
+
+    def _build(self, rows: list) -> Columns:
+        ids, created_at, signin_count, last_signin_at = zip(*rows) if rows \
+            else ((), (), (), ())
+        # NULL datetimes become NaT, whose integer value is NULL_TIME
+        return Columns(np.array(ids, dtype=np.int32),
+                       np.array(created_at, dtype='datetime64[us]').view(np.int64),
+                       np.array(signin_count, dtype=np.int32),
+                       np.array(last_signin_at, dtype='datetime64[us]').view(np.int64))
+
+    @staticmethod
+    def _select(*criteria) -> list:
+        # Core rows rather than ORM ones. The datetimes are parsed by numpy:
+        # SQLite's text values are read as they are.
+        user = User.__table__
+        return db.session.execute(db.select(
+            user.c.id, db.type_coerce(user.c.created_at, db.String),
+            user.c.signin_count, db.type_coerce(user.c.last_signin_at, db.String))
+            .where(*criteria).order_by(user.c.id)).all()
+
+    def reset(self) -> None:
+        # Dropped, loaded again by the next read
+        with self._lock:
+            self._snapshot = None
+
+    def _load(self) -> None:
+        global np
+        if np is None:
+            import numpy as np
+
+        # Loaded from the replica, if any, then refreshed from the primary.
+        # Sessions added meanwhile will be applied by the next refresh.
+        with read_only():
+            self._watermark = UserSession.MaxId()
+            self._snapshot = (self._build(self._select()), {})
+        self._loaded_at = time.monotonic()
+
+    def _refresh(self) -> None:
+        columns, _ = self._snapshot
+        last_id = int(columns.ids[-1]) if len(columns.ids) else 0
+
+        watermark = UserSession.MaxId()
+        user_ids = UserSession.UserIdsBetween(self._watermark, watermark)
+        self._watermark = watermark
+
+        # The counters are read from the user rows, not summed up from the
+        # sessions: applying them twice is harmless
+        changed = [id for id in user_ids if id <= last_id]
+        rows = []
+        for i in range(0, len(changed), self.batch_size):
+            rows += self._select(
+                User.__table__.c.id.in_(changed[i:i + self.batch_size]))
+        new_rows = self._select(User.__table__.c.id > last_id)
+        if not rows and not new_rows:
+            return
+
+        updates = self._build(rows)
+        positions = np.searchsorted(columns.ids, updates.ids)
+        columns = Columns(*(column.copy() for column in columns))
+        for name in ('created_at', 'signin_count', 'last_signin_at'):
+            getattr(columns, name)[positions] = getattr(updates, name)
+
+        if new_rows:
+            added = self._build(new_rows)
+            columns = Columns(*(np.concatenate((column, new))
+                                for column, new in zip(columns, added)))
+
+        self._snapshot = (columns, {})
+
+    def snapshot(self) -> tuple:
+        # The dashboard cache version changes with every sign-up and login
+        version = cache.key('dashboard', 'read_model')
+        with self._lock:
+            now = time.monotonic()
+            if self._snapshot is None or \
+                    now - self._loaded_at > self.reload_interval:
+                self._load()
+                self._refreshed_at = now
+            elif version != self._version or (
+                    self.refresh_interval is not None and
+                    now - self._refreshed_at >= self.refresh_interval):
+                self._refresh()
+                self._refreshed_at = now
+            self._version = version
+            return self._snapshot
+
+    def _order(self, columns: Columns, orders: dict, sort: str) -> Order:
+        order = orders.get(sort)
+        if order is None:
+            keys = getattr(columns, self.SORT_COLUMNS[sort])
+            positions = np.lexsort((columns.ids, keys)).astype(np.int32)
+            order = Order(positions, keys[positions], columns.ids[positions])
+            orders[sort] = order
+        return order
+
+    def _decode_key(self, sort: str, value):
+        if sort == 'last_signin':
+            return _to_micros(datetime.strptime(value, CURSOR_TIME_FORMAT)) \
+                if value is not None else NULL_TIME
+        return int(value)
+
+    def _encode_key(self, sort: str, value):
+        if sort == 'last_signin':
+            value = _to_datetime(value)
+            return value.strftime(CURSOR_TIME_FORMAT) if value else None
+        return int(value)
+
+    def fetch(self, sort: str = 'signup', after: str = None,
+              limit: int = 50) -> tuple[list[UserRow], str]:
+        # Same pages and cursors as User.FetchAll()
+        columns, orders = self.snapshot()
+        n = len(columns.ids)
+
+        if sort == 'signup':
+            start = 0
+            if after is not None:
+                _, id = _decode_cursor(after)
+                start = int(np.searchsorted(columns.ids, id, 'right'))
+            positions = np.arange(start, min(n, start + limit + 1))
+        else:
+            order = self._order(columns, orders, sort)
+            # Descending order: the page ends right before the cursor in the
+            # ascending one
+            end = n
+            if after is not None:
+                value, id = _decode_cursor(after)
+                try:
+                    key = self._decode_key(sort, value)
+                except (ValueError, TypeError):
+                    raise ValueError(f"Invalid cursor '{after}'")
+                lo = int(np.searchsorted(order.keys, key, 'left'))
+                hi = int(np.searchsorted(order.keys, key, 'right'))
+                end = lo + int(np.searchsorted(order.ids[lo:hi], id, 'left'))
+            positions = order.positions[max(0, end - limit - 1):end][::-1]
+
+        rows = [UserRow(int(columns.ids[i]), _to_datetime(columns.created_at[i]),
+                        int(columns.signin_count[i]),
+                        _to_datetime(columns.last_signin_at[i]))
+                for i in positions.tolist()]
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = positions[limit - 1]
+            key = getattr(columns, self.SORT_COLUMNS[sort])[last]
+            next_cursor = _encode_cursor(self._encode_key(sort, key), rows[-1].id)
+        return rows, next_cursor
+
+    def statistics(self) -> dict:
+        # Same figures as User.GetStatistics(): the users and today's active
+        # ones are counted from the columns, only the logins of the last days
+        # come from the rollups
+        columns, _ = self.snapshot()
+        nb_last_days = 7
+        end_date = datetime.utcnow().date()
+        start_date = end_date - timedelta(days=nb_last_days - 1)
+        today = _to_micros(datetime.combine(end_date, datetime.min.time()))
+
+        with read_only():
+            total_logins = db.session.query(
+                db.func.coalesce(db.func.sum(DailyActivity.login_count), 0)) \
+                .filter(DailyActivity.day.between(start_date, end_date)) \
+                .scalar()
+
+        return {
+            'total_users': len(columns.ids),
+            'total_active_today': int(np.count_nonzero(
+                columns.last_signin_at >= today)),
+            'avg_last_days': total_logins / nb_last_days
+        }
+
+    def nbytes(self) -> int:
+        if self._snapshot is None:
+            return 0
+        columns, orders = self._snapshot
+        return sum(c.nbytes for c in columns) + sum(
+            c.nbytes for order in orders.values() for c in order)
+
+
+read_model = ReadModel()
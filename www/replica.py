@@ -0,0 +1,208 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from flask import g, has_request_context, session as flask_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql.dml import UpdateBase
+from www import aio
+from www.cache import cache
+
+logger = logging.getLogger(__name__)
+
+# Set by read_only() blocks
+_read_only = ContextVar('read_only', default=False)
+
+
+@contextmanager
+def read_only():
+    # The SELECTs of the block (or of the decorated function) may be sent to
+    # the replica
+    token = _read_only.set(True)
+    try:
+        yield
+    finally:
+        _read_only.reset(token)
+
+
+class Replica:
+    # Read-only copy of the database, lagging behind the primary. Its lag is
+    # measured from a heartbeat row written to the primary and read back
+    # from the replica.
+    def __init__(self) -> None:
+        self.enabled = False
+        self.engine = None
+        self.max_lag = 5.0
+        self.check_interval = 1.0
+        self._lag = None
+        self._checked_at = None
+        self._lagging = False
+        self._lock = threading.Lock()
+        # Statements of the read_only() blocks, by database
+        self.reads = {'replica': 0, 'primary': 0}
+
+    def init_app(self, app) -> None:
+        from www import engine_options
+
+        self.max_lag = app.config.setdefault('REPLICA_MAX_LAG', 5.0)
+        self.check_interval = app.config.setdefault('REPLICA_LAG_CHECK', 1.0)
+        url = app.config.setdefault('DATABASE_REPLICA_URL', None)
+        if not url:
+            return
+
+        # Relative SQLite paths are resolved like Flask-SQLAlchemy does
+        sa_url = make_url(url)
+        if sa_url.drivername == 'sqlite' and sa_url.database and \
+                sa_url.database != ':memory:':
+            url = sa_url.set(database=os.path.join(app.root_path,
+                                                   sa_url.database))
+        self.engine = create_engine(url, **engine_options(str(url)))
+        self.enabled = True
+
+        # A user reads from the primary for a while after their own writes,
+        # until the replica is known to have them
+        if not event.contains(orm.Session, 'after_commit', self._pin):
+            event.listen(orm.Session, 'after_commit', self._pin)
+
+        if app.config.get('DEBUG_HEADERS'):
+            @app.after_request
+            def add_replica_headers(response):
+                lag = self.lag()
+                response.headers['X-Replica-Lag'] = \
+                    f'{lag:.3f}' if lag is not None else 'unknown'
+                response.headers['X-Replica-Reads'] = str(g.get('replica_reads', 0))
+                return response
+
+    def _pin(self, session) -> None:
+        session.info['pinned'] = True
+        if has_request_context():
+            flask_session['primary_until'] = \
+                time.time() + self.max_lag + self.check_interval
+
+    def _measure(self):
+        from www.models import ReplicaHeartbeat
+
+        try:
+            with self.engine.connect() as conn:
+                beat_at = conn.execute(select(ReplicaHeartbeat.beat_at)).scalar()
+        except SQLAlchemyError as e:
+            logger.warning("Could not read the replica heartbeat: %s", e)
+            return None
+        if beat_at is None:
+            return None
+        return max(0.0, (datetime.utcnow() - beat_at).total_seconds())
+
+    def lag(self):
+        # Seconds behind the primary, measured every `check_interval`
+        # seconds at most. None when unknown.
+        if not self.enabled:
+            return None
+        with self._lock:
+            now = time.monotonic()
+            if self._checked_at is None or \
+                    now - self._checked_at >= self.check_interval:
+                self._lag = self._measure()
+                self._checked_at = now
+            return self._lag
+
+    def usable(self, session) -> bool:
+        # Called for the statements of the read_only() blocks
+        if not self.enabled or session.info.get('pinned'):
+            return False
+        if has_request_context() and \
+                flask_session.get('primary_until', 0) > time.time():
+            return False
+
+        lag = self.lag()
+        lagging = lag is None or lag > self.max_lag
+        if lagging != self._lagging:
+            self._lagging = lagging
+            if lagging:
+                logger.warning("Replica lag is %s, reading from the primary",
+                               f'{lag:.1f}s' if lag is not None else 'unknown')
+            else:
+                logger.info("Replica lag is %.1fs, reading from the replica", lag)
+        return not lagging
+
+    def target(self) -> str:
+        # Where the read_only() blocks of the current request read from
+        if not self.enabled:
+            return 'primary'
+        from www.models import db
+        return 'replica' if self.usable(db.session) else 'primary'
+
+    def cache_ttl(self, target: str) -> int:
+        # What's computed from the replica expires before it's more than
+        # `max_lag` seconds behind the primary
+        if target != 'replica':
+            return None
+        return max(1, min(cache.default_ttl,
+                          int(self.max_lag - (self.lag() or 0))))
+
+    def dispose(self) -> None:
+        if self.engine is not None:
+            self.engine.dispose()
+
+
+replica = Replica()
+
+
+class RoutingSession(SignallingSession):
+    # Sends the SELECTs of the read_only() blocks to the replica while it's
+    # usable, everything else (flushes, updates, deletes) to the primary.
+    # On the event loop of www.asgi, everything goes to its async engine.
+    def get_bind(self, mapper=None, clause=None):
+        if aio.database.engine is not None and aio.in_event_loop():
+            return aio.database.engine.sync_engine
+        if _read_only.get() and not self._flushing and \
+                not isinstance(clause, UpdateBase):
+            if replica.usable(self):
+                replica.reads['replica'] += 1
+                if has_request_context():
+                    g.replica_reads = g.get('replica_reads', 0) + 1
+                return replica.engine
+            replica.reads['primary'] += 1
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def _sqlite_path(url) -> str:
+    url = make_url(url)
+    if url.drivername != 'sqlite' or url.database in (None, '', ':memory:'):
+        return None
+    return url.database
+
+
+def sync(primary_engine) -> str:
+    # Writes a heartbeat to the primary, then copies a SQLite primary into a
+    # SQLite replica. Other databases replicate themselves, only the
+    # heartbeat is needed to measure their lag.
+    from www.models import ReplicaHeartbeat
+
+    ReplicaHeartbeat.Beat()
+    source = _sqlite_path(primary_engine.url)
+    target = _sqlite_path(replica.engine.url)
+    if source is None or target is None:
+        return 'heartbeat'
+
+    # The copy is made in a single step: it's consistent, and the readers of
+    # the replica (WAL mode) keep reading the previous copy meanwhile
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(target, timeout=30)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+    return 'copy'
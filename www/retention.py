@@ -0,0 +1,68 @@
+import gzip
+import json
+import os
+import time
+from datetime import date
+from www.models import db, UserSession, DailyUserActivity, SessionArchive
+
+
+def archive_path(archive_dir: str, day: date) -> str:
+    return os.path.join(archive_dir, f'user_session-{day.isoformat()}.jsonl.gz')
+
+
+def _count_lines(path: str) -> int:
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return sum(1 for _ in f)
+
+
+def archive_day(day: date, archive_dir: str, batch_size: int) -> tuple:
+    # Writes the sessions of the day to a gzipped JSONL file, returns its
+    # path and number of rows. The file only appears once complete, so an
+    # existing one holds every session of the day: deletion may have started.
+    path = archive_path(archive_dir, day)
+    if os.path.exists(path):
+        return path, _count_lines(path)
+
+    os.makedirs(archive_dir, exist_ok=True)
+    tmp_path = path + '.tmp'
+    count = 0
+    with open(tmp_path, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+            for id, user_id, logged_at in UserSession.IterDay(day, batch_size):
+                f.write(json.dumps({'id': id, 'user_id': user_id,
+                                    'logged_at': logged_at.isoformat()})
+                        .encode('utf-8') + b'\n')
+                count += 1
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+    return path, count
+
+
+def compact_day(day: date, archive_dir: str, batch_size: int = 1000,
+                pause: float = 0.0) -> int:
+    # Once the archive exists, some sessions of the day may be gone already:
+    # the rollup must not be recomputed from them anymore
+    if not os.path.exists(archive_path(archive_dir, day)):
+        DailyUserActivity.RebuildDay(day)
+        db.session.commit()
+
+    path, count = archive_day(day, archive_dir, batch_size)
+
+    while UserSession.DeleteBatch(day, batch_size):
+        if pause:
+            time.sleep(pause)
+
+    SessionArchive.Record(day, path, count)
+    return count
+
+
+def compact_sessions(before: date, archive_dir: str, batch_size: int = 1000,
+                     pause: float = 0.0):
+    # Compacts the sessions older than `before`, day by day from the oldest.
+    # Yields the (day, number of archived sessions) as they are done.
+    while True:
+        day = UserSession.OldestDay()
+        if day is None or day >= before:
+            return
+        yield day, compact_day(day, archive_dir, batch_size, pause)
@@ -1,32 +1,226 @@
-from www import app, mailer
-from www.oauth import google_config, facebook_config
-from www.models import User
-from flask import render_template, request, url_for, redirect
+import hashlib
+import json
+import time
+from datetime import date, datetime, timedelta
+from www.mailer import mailer
+from www.models import db, User, DailyActivity
+from www.cache import cache
+from www.ratelimit import limiter
+from www.readmodel import read_model
+from www.replica import replica
+from www.events import broker, format_event
+from flask import current_app, render_template, request, url_for, redirect, abort, \
+    Response, stream_with_context, jsonify, session
+from flask_wtf.csrf import generate_csrf
 from www.forms import SignupForm, LoginForm, ProfileForm, ChangePasswordForm
 from flask_login import login_user, logout_user, current_user, login_required
 
+# Registered on each application by init_app()
+_routes = []
+_error_handlers = []
 
-@app.route('/', methods=('GET', 'POST'))
+
+def route(rule: str, **options):
+    def decorator(view):
+        _routes.append((rule, view, options))
+        return view
+    return decorator
+
+
+def errorhandler(code: int):
+    def decorator(handler):
+        _error_handlers.append((code, handler))
+        return handler
+    return decorator
+
+
+def init_app(app) -> None:
+    for rule, view, options in _routes:
+        app.add_url_rule(rule, view_func=view, **options)
+    for code, handler in _error_handlers:
+        app.register_error_handler(code, handler)
+
+
+def stream_template(template_name: str, **context) -> Response:
+    # Render the template chunk by chunk while the response is being sent
+    current_app.update_template_context(context)
+    stream = current_app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(16)
+    return Response(stream_with_context(stream))
+
+
+def dashboard_statistics() -> dict:
+    # Figures read from the replica and from the primary (right after the
+    # user's own writes) are cached apart
+    source = replica.target()
+    return cache.get_or_set(
+        cache.key('dashboard', 'statistics', source),
+        read_model.statistics if read_model.enabled else User.GetStatistics,
+        replica.cache_ttl(source))
+
+
+@route('/', methods=('GET', 'POST'))
 def index():
     users = None
+    next_cursor = None
     form = None
     statistics = None
-    if current_user.is_authenticated and current_user.is_activated():
-        users = User.FetchAll()
-        statistics = User.GetStatistics()
+    sort = request.args.get('sort', 'signup')
+    if sort not in User.SORT_OPTIONS:
+        abort(400)
 
-        if current_user.password is not None:
+    if current_user.is_authenticated and current_user.is_activated():
+        if current_user.has_password():
             form = ChangePasswordForm()
-            form.email.data = current_user.email
 
             if form.validate_on_submit():
                 current_user.update_password(form.password.data)
                 return redirect(url_for('index'))
 
-    return render_template('index.html', users=users, form=form, statistics=statistics)
+        statistics = dashboard_statistics()
+
+        if request.args.get('stream'):
+            return stream_template('index.html', users=User.IterAll(sort),
+                                   form=form, statistics=statistics, sort=sort)
+
+        after = request.args.get('after')
+        size = request.args.get('size', current_app.config['DASHBOARD_PAGE_SIZE'],
+                                type=int)
+        size = max(1, min(size, 500))
+        try:
+            if read_model.enabled:
+                users, next_cursor = read_model.fetch(sort, after, size)
+            else:
+                source = replica.target()
+                users, next_cursor = cache.get_or_set(
+                    cache.key('dashboard', 'users', sort, after, size, source),
+                    lambda: User.FetchAll(sort, after, size),
+                    replica.cache_ttl(source))
+        except ValueError:
+            abort(400)
+
+    return render_template('index.html', users=users, next_cursor=next_cursor,
+                           form=form, statistics=statistics, sort=sort)
+
+
+@route('/events')
+@login_required
+def events():
+    # Server-Sent Events of the dashboard: the signups and logins committed
+    # by this process as they happen, and the statistics whenever they
+    # change (including through the other processes, with a shared cache)
+    if not current_user.is_activated():
+        abort(403)
+
+    subscriber, replayed = broker.subscribe(request.headers.get('Last-Event-ID'))
+    poll_interval = current_app.config['EVENTS_POLL_INTERVAL']
+    keepalive = current_app.config['EVENTS_KEEPALIVE']
+
+    def stream():
+        try:
+            if not replayed:
+                # The events missed since the last connection are gone
+                yield format_event('reset', {})
+                return
+
+            version = None
+            sent_at = time.monotonic()
+            while True:
+                for id, type, data in subscriber.get(poll_interval):
+                    yield format_event(type, data, id)
+                    sent_at = time.monotonic()
+                if subscriber.overflowed:
+                    yield format_event('reset', {})
+                    return
+
+                # Computed once per change by all the streams together
+                if cache.key('dashboard') != version:
+                    version = cache.key('dashboard')
+                    yield format_event('statistics', dashboard_statistics())
+                    sent_at = time.monotonic()
+                    # The stream must not hold a pooled connection
+                    db.session.remove()
+                elif time.monotonic() - sent_at >= keepalive:
+                    yield ': keepalive\n\n'
+                    sent_at = time.monotonic()
+        finally:
+            broker.unsubscribe(subscriber)
+
+    response = Response(stream_with_context(stream()),
+                        mimetype='text/event-stream')
+    response.cache_control.no_cache = True
+    # Proxies would buffer the events
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+CSRF_PLACEHOLDER = '__csrf_token__'
+
+
+def render_anonymous_page(template_name: str, **context) -> str:
+    # The blank login/signup forms only differ by their CSRF token: they are
+    # rendered once, then the token of the request is put in
+    if request.method != 'GET' or session.get('_flashes'):
+        return render_template(template_name, **context)
+
+    token = generate_csrf() if current_app.config.get('WTF_CSRF_ENABLED', True) else None
+
+    def render() -> str:
+        html = render_template(template_name, **context)
+        return html.replace(token, CSRF_PLACEHOLDER) if token else html
+
+    html = cache.get_or_set(cache.key('pages', request.endpoint), render)
+    return html.replace(CSRF_PLACEHOLDER, token) if token else html
+
+
+def parse_date(name: str, default: date) -> date:
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        abort(400, f"Invalid '{name}' date, expected YYYY-MM-DD")
+
+
+@route('/api/analytics')
+@login_required
+def analytics():
+    end = parse_date('end', datetime.utcnow().date())
+    start = parse_date('start', end - timedelta(days=6))
+    bucket = request.args.get('bucket', 'day')
+    if bucket not in DailyActivity.BUCKETS:
+        abort(400, f"Invalid bucket, expected one of {DailyActivity.BUCKETS}")
+    if start > end or (end - start).days >= current_app.config['ANALYTICS_MAX_DAYS']:
+        abort(400, "Invalid date range")
+
+    def render() -> tuple:
+        body = json.dumps(DailyActivity.GetAnalytics(start, end, bucket))
+        return body, hashlib.sha1(body.encode()).hexdigest()
+
+    # Invalidated along with the dashboard, on every signup/login
+    source = replica.target()
+    body, etag = cache.get_or_set(
+        cache.key('dashboard', 'analytics', start, end, bucket, source),
+        render, replica.cache_ttl(source))
+
+    response = Response(body, content_type='application/json')
+    response.set_etag(etag)
+    # Polling clients revalidate every time, a 304 costs no query
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@errorhandler(400)
+def bad_request(e):
+    if request.path.startswith('/api/'):
+        return jsonify(error=e.description), 400
+    return e
 
 
-@app.route('/signup', methods=('GET', 'POST'))
+@route('/signup', methods=('GET', 'POST'))
+@limiter.limit('signup')
 def signup():
     if current_user.is_authenticated:
         return redirect(url_for('index'))
@@ -38,18 +232,21 @@ def signup():
             # SignupForm has retrieved a user created from OAuth query
             user.update_password(form.password.data)
         else:
-            user = User.Create(form.email.data, form.password.data)
+            # The user and its verification email are committed together
+            user = User.Add(form.email.data, form.password.data)
             mailer.send_verification(user)
         login_user(user, remember=True)
         return redirect(url_for('index'))
 
-    return render_template('signup.html',
-                           form=form,
-                           show_google_btn=True if google_config else False,
-                           show_facebook_btn=True if facebook_config else False)
+    return render_anonymous_page(
+        'signup.html',
+        form=form,
+        show_google_btn='google' in current_app.blueprints,
+        show_facebook_btn='facebook' in current_app.blueprints)
 
 
-@app.route('/login', methods=('GET', 'POST'))
+@route('/login', methods=('GET', 'POST'))
+@limiter.limit('login', email_field='email')
 def login():
     if current_user.is_authenticated:
         return redirect(url_for('index'))
@@ -61,19 +258,20 @@ def login():
         next_page = request.args.get('next')
         return redirect(next_page) if next_page else redirect(url_for('index'))
 
-    return render_template('login.html',
-                           form=form,
-                           show_google_btn=True if google_config else False,
-                           show_facebook_btn=True if facebook_config else False)
+    return render_anonymous_page(
+        'login.html',
+        form=form,
+        show_google_btn='google' in current_app.blueprints,
+        show_facebook_btn='facebook' in current_app.blueprints)
 
 
-@app.route('/logout')
+@route('/logout')
 def logout():
     logout_user()
     return redirect(url_for('index'))
 
 
-@app.route('/profile', methods=('GET', 'POST'))
+@route('/profile', methods=('GET', 'POST'))
 @login_required
 def profile():
     form = ProfileForm()
@@ -85,7 +283,8 @@ def profile():
     return render_template('profile.html', user=current_user, form=form)
 
 
-@app.route('/resend')
+@route('/resend')
+@limiter.limit('resend', methods=('GET', ))
 @login_required
 def resend():
     if current_user.can_send_verification():
@@ -93,21 +292,23 @@ def resend():
     return redirect(url_for('index'))
 
 
-@app.route('/activate/<email>/<key>')
+@route('/activate/<email>/<key>')
+@limiter.limit('activate', methods=('GET', ))
 def activate(email: str = None, key: str = None):
     if email is not None and key is not None:
-        user = User.FindByEmail(email)
-        if user and not user.is_activated() and user.activate(key):
+        user = User.FindByActivationKey(key)
+        if user and user.email == email and not user.is_activated():
+            user.activate()
             login_user(user, remember=True)
 
     return redirect(url_for('index'))
 
 
-@app.errorhandler(404)
+@errorhandler(404)
 def page_not_found(e):
     return render_template('404.html'), 404
 
 
-@app.errorhandler(500)
+@errorhandler(500)
 def page_not_found(e):
     return render_template('500.html'), 500
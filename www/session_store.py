@@ -0,0 +1,35 @@
+from www.cache import create_backend
+
+
+class SessionStore:
+    # Keeps a snapshot of the logged in users, so that loading them on each
+    # request doesn't hit the database. Backends are the cache ones.
+    def __init__(self) -> None:
+        self.backend = create_backend('memory://')
+        self.ttl = 3600
+
+    def init_app(self, app) -> None:
+        self.ttl = app.config.setdefault('SESSION_STORE_TTL', 3600)
+        self.backend = create_backend(
+            app.config.setdefault('SESSION_STORE_URL', 'memory://'),
+            app.config.setdefault('SESSION_STORE_MAX_ENTRIES', 10000))
+
+    def version(self, user_id: int) -> int:
+        # Snapshots are stored under the version of the user read before
+        # loading it: one loaded before a change, but stored after it, is
+        # never read back
+        return self.backend.incr(f'user:{user_id}:version', 0)
+
+    def get(self, user_id: int, version: int) -> tuple:
+        return self.backend.get(f'user:{user_id}:{version}')
+
+    def set(self, user_id: int, version: int, snapshot: tuple) -> None:
+        self.backend.set(f'user:{user_id}:{version}', snapshot, self.ttl)
+
+    def invalidate(self, user_id: int) -> None:
+        # The version never expires: back to 0, the next versions would be
+        # those of snapshots which may still be live
+        self.backend.incr(f'user:{user_id}:version')
+
+
+session_store = SessionStore()
@@ -0,0 +1,75 @@
+import hashlib
+import os
+import secrets
+import string
+import threading
+
+ALPHABET = string.ascii_letters + string.digits
+
+# Random bytes are mapped to base62 characters by a single bytes.translate():
+# the bytes below 248 (4 * 62) map to ALPHABET[byte % 62], the others are
+# dropped so that every character is equally likely
+_UNBIASED = 256 - 256 % len(ALPHABET)
+_TABLE = bytes(ord(ALPHABET[i % len(ALPHABET)]) if i < _UNBIASED else 0
+               for i in range(256))
+_REJECTED = bytes(range(_UNBIASED, 256))
+
+
+def encode(data: bytes) -> str:
+    # About 3% of the bytes are dropped
+    return data.translate(_TABLE, _REJECTED).decode('ascii')
+
+
+def hash_token(token: str) -> str:
+    # Tokens carry ~6 bits of entropy per character, a fast unsalted hash is
+    # enough and keeps them searchable through an index. Keys received in
+    # URLs can hold any character, which are no match for any token.
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+class TokenPool:
+    # Base62 characters drawn from the OS CSPRNG by batches of `batch_size`
+    # bytes, handed out as tokens
+    def __init__(self, batch_size: int = 8192) -> None:
+        self.batch_size = batch_size
+        self._chars = ''
+        self._pos = 0
+        self._lock = threading.Lock()
+        # A forked process must not hand out the tokens of its parent
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._clear)
+
+    def init_app(self, app) -> None:
+        self.batch_size = app.config.setdefault('TOKEN_BATCH_SIZE', 8192)
+
+    def _clear(self) -> None:
+        self._chars = ''
+        self._pos = 0
+        self._lock = threading.Lock()
+
+    def _take(self, length: int) -> str:
+        # Called with the lock held. Characters are never handed out twice.
+        end = self._pos + length
+        if end > len(self._chars):
+            chars = self._chars[self._pos:]
+            while len(chars) < length:
+                chars += encode(secrets.token_bytes(
+                    max(self.batch_size, length * 2)))
+            self._chars, self._pos, end = chars, 0, length
+
+        token = self._chars[self._pos:end]
+        self._pos = end
+        return token
+
+    def generate(self, length: int) -> str:
+        with self._lock:
+            return self._take(length)
+
+    def generate_many(self, count: int, length: int) -> list[str]:
+        # A bulk import draws all its tokens at once
+        with self._lock:
+            chars = self._take(count * length)
+        return [chars[i:i + length] for i in range(0, count * length, length)]
+
+
+tokens = TokenPool()